@@ -1,9 +1,11 @@
+import os
 import re
 
 from lxml import etree
 from pyramid.settings import asbool
 
 from .exception import ConfigurationError
+from .models import MAX_IDENTIFIER_PREFIXES
 
 def clean_oai_settings(settings):
     """Parse and validate OAI app settings in a dictionary.
@@ -18,6 +20,13 @@ def clean_oai_settings(settings):
         repository_descriptions
         repository_name
         sqlalchemy.url
+    Optional settings are:
+        identifier_filter
+        oai_serializer
+        record_cache_size
+        response_cache_file
+        response_cache_size
+        template_cache_directory
 
     Parameters
     ----------
@@ -32,13 +41,27 @@ def clean_oai_settings(settings):
     cleaners = {
         'admin_emails': _clean_admin_emails,
         'deleted_records': _clean_deleted_records,
+        'identifier_filter': _clean_boolean,
         'item_list_limit': _clean_item_list_limit,
         'logging_config': _clean_unicode,
+        'oai_serializer': _clean_serializer,
+        'record_cache_size': _clean_record_cache_size,
+        'response_cache_file': _clean_path,
+        'response_cache_size': _clean_response_cache_size,
         'repository_descriptions': _load_repository_descriptions,
         'repository_name': _clean_unicode,
         'sqlalchemy.url': _clean_unicode,
+        'template_cache_directory': _clean_path,
     }
-    _clean_settings(settings, cleaners)
+    defaults = {
+        'identifier_filter': 'no',
+        'oai_serializer': 'chameleon',
+        'record_cache_size': '0',
+        'response_cache_file': '',
+        'response_cache_size': '100000000',
+        'template_cache_directory': '',
+    }
+    _clean_settings(settings, cleaners, defaults)
 
 
 def clean_importer_settings(settings):
@@ -55,6 +78,18 @@ def clean_importer_settings(settings):
         timestamp_file
         metadata_provider_class
         metadata_provider_args
+    Optional settings are:
+        harvest_commit_interval
+        harvest_commit_timeout
+        harvest_journal
+        harvest_stream_items
+        harvest_worker_processes
+        harvest_workers
+        identifier_prefixes
+        purge_vacuum
+        report_file
+        shadow_build
+        watch_delay
 
     Parameters
     ----------
@@ -70,16 +105,40 @@ def clean_importer_settings(settings):
         'deleted_records': _clean_deleted_records,
         'dry_run': _clean_boolean,
         'force_update': _clean_boolean,
+        'harvest_commit_interval': _clean_commit_interval,
+        'harvest_commit_timeout': _clean_commit_timeout,
+        'harvest_journal': _clean_boolean,
+        'harvest_stream_items': _clean_boolean,
+        'harvest_worker_processes': _clean_boolean,
+        'harvest_workers': _clean_harvest_workers,
+        'identifier_prefixes': _clean_identifier_prefixes,
         'logging_config': _clean_unicode,
         'sqlalchemy.url': _clean_unicode,
         'timestamp_file': _clean_unicode,
         'metadata_provider_args': _clean_unicode,
         'metadata_provider_class': _clean_provider_class,
+        'purge_vacuum': _clean_boolean,
+        'report_file': _clean_unicode,
+        'shadow_build': _clean_boolean,
+        'watch_delay': _clean_watch_delay,
+    }
+    defaults = {
+        'harvest_commit_interval': '1',
+        'harvest_commit_timeout': '',
+        'harvest_journal': 'no',
+        'harvest_stream_items': 'no',
+        'harvest_worker_processes': 'no',
+        'harvest_workers': '1',
+        'identifier_prefixes': '',
+        'purge_vacuum': 'no',
+        'report_file': '',
+        'shadow_build': 'no',
+        'watch_delay': '2',
     }
-    return _clean_settings(settings, cleaners)
+    return _clean_settings(settings, cleaners, defaults)
 
 
-def _clean_settings(settings, cleaners):
+def _clean_settings(settings, cleaners, defaults=None):
     """Check that settings are ok.
 
     The parameter `cleaners` is a dict from setting names to functions.
@@ -88,19 +147,28 @@ def _clean_settings(settings, cleaners):
     and otherwise return a cleaned value. The old value gets replaced by
     the cleaned value.
 
+    Settings that are missing from `settings` but have a value in
+    `defaults` are set to the default value before cleaning.
+
     Parameters
     ----------
     settings: dict from str to str
         The settings dictionary.
     cleaners: dict from str to callable
         Mapping from setting names to cleaner functions.
+    defaults: dict from str to str or None
+        Default values of optional settings.
 
     Raises
     ------
     ConfigurationError:
         If any setting is missing or invalid.
     """
+    if defaults is None:
+        defaults = {}
     for name, func in cleaners.iteritems():
+        if name not in settings and name in defaults:
+            settings[name] = defaults[name]
         if name not in settings:
             raise ConfigurationError('missing setting {0}'.format(name))
 
@@ -140,6 +208,16 @@ def _clean_deleted_records(value):
     return unicode(value)
 
 
+def _clean_serializer(value):
+    """Check that value is one of "chameleon", "lxml"."""
+    allowed_values = ['chameleon', 'lxml']
+    if value not in allowed_values:
+        raise ValueError('oai_serializer must be one of {0}'.format(
+            allowed_values
+        ))
+    return unicode(value)
+
+
 def _clean_boolean(value):
     """Return the value as a bool."""
     return asbool(value)
@@ -153,6 +231,69 @@ def _clean_item_list_limit(value):
     return int_value
 
 
+def _clean_record_cache_size(value):
+    """Check that value is a non-negative integer."""
+    int_value = int(value)
+    if int_value < 0:
+        raise ValueError('record_cache_size must not be negative')
+    return int_value
+
+
+def _clean_response_cache_size(value):
+    """Check that value is a positive integer."""
+    int_value = int(value)
+    if int_value <= 0:
+        raise ValueError('response_cache_size must be positive')
+    return int_value
+
+
+def _clean_commit_interval(value):
+    """Check that value is a positive integer."""
+    int_value = int(value)
+    if int_value <= 0:
+        raise ValueError('harvest_commit_interval must be positive')
+    return int_value
+
+
+def _clean_commit_timeout(value):
+    """Check that value is empty or a positive number of seconds."""
+    if not value.strip():
+        return None
+    float_value = float(value)
+    if float_value <= 0:
+        raise ValueError('harvest_commit_timeout must be positive')
+    return float_value
+
+
+def _clean_watch_delay(value):
+    """Check that value is a positive number of seconds."""
+    float_value = float(value)
+    if float_value <= 0:
+        raise ValueError('watch_delay must be positive')
+    return float_value
+
+
+def _clean_harvest_workers(value):
+    """Check that value is a positive integer."""
+    int_value = int(value)
+    if int_value <= 0:
+        raise ValueError('harvest_workers must be positive')
+    return int_value
+
+
+def _clean_identifier_prefixes(value):
+    """Return the whitespace-separated prefixes as a sorted list."""
+    prefixes = sorted(set(_clean_unicode(value).split()))
+    if len(prefixes) > MAX_IDENTIFIER_PREFIXES:
+        raise ValueError('at most {0} identifier_prefixes are allowed'
+                         ''.format(MAX_IDENTIFIER_PREFIXES))
+    for first, second in zip(prefixes, prefixes[1:]):
+        if second.startswith(first):
+            raise ValueError('identifier_prefixes must not start with '
+                             'each other')
+    return prefixes
+
+
 def _clean_unicode(value):
     """Return the value as a unicode."""
     if isinstance(value, str):
@@ -161,6 +302,14 @@ def _clean_unicode(value):
         return unicode(value)
 
 
+def _clean_path(value):
+    """Return the value as an absolute path, or None if it is empty."""
+    path = _clean_unicode(value).strip()
+    if not path:
+        return None
+    return os.path.abspath(path)
+
+
 def _clean_provider_class(value):
     """Split the value to module name and classname."""
     modulename, classname = value.split(':')
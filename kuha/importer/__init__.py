@@ -9,18 +9,24 @@ from pyramid.scripts.common import parse_vars
 
 from ..exception import HarvestError
 from ..config import clean_importer_settings
+from .. import models
 from ..models import create_engine, ensure_oai_dc_exists
 from ..util import (
     datestamp_now,
     parse_date,
     format_datestamp,
 )
-from ..importer.harvest import update
+from ..importer.harvest import update, update_changed
+from ..importer.report import ImportReport
+from ..importer.shadow import install, staging_settings
 
 def usage(argv):
-    usage_string = '''Usage: {0} <config_uri> [var=value]...
+    usage_string = '''Usage: {0} [--watch] <config_uri> [var=value]...
 Update the Kuha database.
 
+With --watch, keep running after the update and apply the changes
+reported by the metadata provider as they happen.
+
 See the sample configuration file for details.'''
     cmd = os.path.basename(argv[0])
     print(usage_string.format(cmd))
@@ -68,7 +74,67 @@ def write_timestamp(path, time):
         )
 
 
+def write_report(path, report):
+    log = logging.getLogger(__name__)
+
+    if not path:
+        return
+
+    try:
+        report.write(path)
+    except IOError as error:
+        log.error(
+            'Failed to write import report to "{0}": {1}'
+            ''.format(path, error)
+        )
+
+
+def watch_changes(provider, settings, purge, dry_run):
+    """Apply the changes reported by the provider until interrupted."""
+    log = logging.getLogger(__name__)
+
+    batches = provider.watch(settings['watch_delay'])
+    log.info('Watching for changes...')
+    try:
+        for changed, removed in batches:
+            # Get timestamp before the update, like in main.
+            timestamp = datestamp_now()
+            log.info(
+                '{0} item{1} changed and {2} removed.'.format(
+                    len(changed), '' if len(changed) == 1 else 's',
+                    len(removed))
+            )
+            report = ImportReport()
+            try:
+                update_changed(provider,
+                               changed,
+                               removed,
+                               purge,
+                               dry_run,
+                               settings['harvest_workers'],
+                               settings['harvest_worker_processes'],
+                               settings['harvest_commit_interval'],
+                               settings['harvest_commit_timeout'],
+                               report)
+            except HarvestError as error:
+                # The changes are applied by the next full update.
+                log.error(
+                    'Failed to apply changes: {0}'
+                    ''.format(error)
+                )
+                continue
+
+            if not dry_run:
+                write_timestamp(settings['timestamp_file'], timestamp)
+            report.finish()
+            write_report(settings['report_file'], report)
+    except KeyboardInterrupt:
+        log.info('Stopped watching for changes.')
+
+
 def main(argv=sys.argv):
+    watch = '--watch' in argv[1:]
+    argv = [arg for arg in argv if arg != '--watch']
     if len(argv) < 2:
         usage(argv)
     config_uri = argv[1]
@@ -95,10 +161,32 @@ def main(argv=sys.argv):
     # Get timestamp before harvest.
     new_timestamp = datestamp_now()
 
-    create_engine(settings)
+    journal = settings['harvest_journal'] and not dry_run
+    shadow = (settings['shadow_build'] and settings['force_update'] and
+              not dry_run)
+    live_settings = settings
+    if shadow:
+        settings, staging_path, live_path = staging_settings(settings,
+                                                             journal)
+        log.info('Building a new database in {0}...'.format(staging_path))
+
+    # A journaled import must survive crashes to be resumed.
+    create_engine(settings, bulk_load=shadow and not journal,
+                  identifier_prefixes=settings['identifier_prefixes'],
+                  savepoints=True)
     if not dry_run:
         ensure_oai_dc_exists()
 
+    if journal:
+        started = models.ImportCheckpoint.begin(new_timestamp)
+        models.commit()
+        if started != new_timestamp:
+            log.info('Resuming the import started at {0} UTC.'
+                     ''.format(format_datestamp(started)))
+            # Items processed before the interruption may have changed
+            # after the original start time.
+            new_timestamp = started
+
     log.debug('Loading the metadata provider...')
     try:
         modulename, classname = settings['metadata_provider_class']
@@ -116,17 +204,66 @@ def main(argv=sys.argv):
         )
         raise
 
+    if watch and not hasattr(metadata_provider, 'watch'):
+        log.critical('The metadata provider cannot watch for changes.')
+        sys.exit(1)
+
     log.debug('Harvesting metadata...')
+    report = ImportReport()
+    report_file = settings['report_file']
     try:
-        update(metadata_provider, old_timestamp, purge, dry_run)
-    except HarvestError as error:
-        log.critical(
-            'Failed to harvest metadata: {0}'
-            ''.format(error)
-        )
-        raise
+        try:
+            update(metadata_provider,
+                   old_timestamp,
+                   purge,
+                   dry_run,
+                   settings['harvest_workers'],
+                   settings['harvest_worker_processes'],
+                   settings['harvest_commit_interval'],
+                   settings['harvest_commit_timeout'],
+                   settings['harvest_stream_items'],
+                   journal,
+                   report)
+        except HarvestError as error:
+            log.critical(
+                'Failed to harvest metadata: {0}'
+                ''.format(error)
+            )
+            raise
 
-    if not dry_run:
-        write_timestamp(timestamp_file, new_timestamp)
+        if journal:
+            models.ImportCheckpoint.end()
+            models.commit()
+
+        # A shadow database is built without purged records.
+        if purge and settings['purge_vacuum'] and not dry_run and not shadow:
+            log.debug('Vacuuming the database...')
+            models.optimize(vacuum=True)
+
+        if shadow:
+            try:
+                install(staging_path, live_path, keep_deleted=not purge)
+            except HarvestError as error:
+                log.critical(
+                    'Failed to replace the database: {0}'
+                    ''.format(error)
+                )
+                raise
+            settings = live_settings
+            create_engine(settings, savepoints=True)
+
+        if not dry_run:
+            write_timestamp(timestamp_file, new_timestamp)
+    except Exception as error:
+        report.error = '{0}'.format(error)
+        raise
+    finally:
+        # The report is written for failed imports too.
+        report.finish()
+        report.log_summary(log)
+        write_report(report_file, report)
 
     log.info('Done.')
+
+    if watch:
+        watch_changes(metadata_provider, settings, purge, dry_run)
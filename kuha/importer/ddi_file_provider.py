@@ -1,18 +1,55 @@
+import collections
+import errno
+import hashlib
+import json
 import os
 import logging
+import stat as stat_module
+import sys
+import tempfile
+import time
 from datetime import datetime
 
 from lxml import etree
+from pyramid.settings import asbool
+
+from . import inotify
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+"""File information stored in the directory index. `modified` is the
+time when the file was last modified as a POSIX timestamp."""
+_FileInfo = collections.namedtuple('_FileInfo', ['path', 'size', 'modified'])
 
 class DdiFileProvider(object):
     """
     Metadata provider for DDI Codebook XML files.
 
     This provider scans a directory for XML files and converts them from
-    DDI Codebook to OAI DC.
+    DDI Codebook to OAI DC. If enabled, DDI Codebook 2.5 documents are
+    also disseminated as is in the `ddi_c` format. Large files are then
+    always parsed as a whole, while otherwise only the sections needed
+    for OAI DC are read from them.
+
+    The directory is scanned once by `identifiers`, which indexes the
+    path, modification times and size of each file. `has_changed`,
+    `changed_since` and `get_record` use the index instead of accessing
+    the file system again. The index is not copied to worker processes.
+    `watch` keeps the index up to date with inotify.
+
+    A file is modified when its modification or status change time
+    changes. If a digest cache is given, the contents of such files are
+    compared with their digests from the previous scan, and the files
+    are only considered modified if their contents have changed. Copying,
+    restoring or changing the permissions of the files then does not
+    cause their records to be converted again.
     """
 
-    def __init__(self, domain_name='example.org', directory='.'):
+    def __init__(self, domain_name='example.org', directory='.',
+                 digest_cache=None, pass_through=False):
         """
         Initialize the metadata provider.
 
@@ -22,9 +59,31 @@ class DdiFileProvider(object):
             Path of the directory to scan for DDI files.
         domain_name: str
             The domain name part of the OAI identifiers.
+        digest_cache: str or NoneType
+            Path of the file in which to keep the digests of the files,
+            or `None` or ``-`` to detect modifications from the file
+            times only.
+        pass_through: bool or str
+            Whether to disseminate DDI Codebook 2.5 documents in the
+            `ddi_c` format. Strings such as ``yes`` and ``no`` are
+            accepted too.
         """
+        if digest_cache == '-':
+            digest_cache = None
         self.oai_identifier_prefix = 'oai:{0}:'.format(domain_name)
         self.directory = directory
+        self.pass_through = asbool(pass_through)
+        self._index = None
+        self._digests = (None if digest_cache is None else
+                         _DigestCache(digest_cache, directory))
+
+    def __getstate__(self):
+        # Do not send the index to worker processes with each task. The
+        # workers only need the file times if `changed_since` fails.
+        state = self.__dict__.copy()
+        state['_index'] = None
+        state['_digests'] = None
+        return state
 
     def formats(self):
         """
@@ -36,11 +95,13 @@ class DdiFileProvider(object):
             Mapping from metadata prefixes to (namespace, schema location)
             tuples.
         """
-        # Only OAI DC is available from this provider.
-        return {
+        formats = {
             'oai_dc': ('http://www.openarchives.org/OAI/2.0/oai_dc/',
                        'http://www.openarchives.org/OAI/2.0/oai_dc.xsd'),
         }
+        if self.pass_through:
+            formats[DDI_PREFIX] = (DDI_NAMESPACE, DDI_SCHEMA)
+        return formats
 
     def identifiers(self):
         """
@@ -54,14 +115,18 @@ class DdiFileProvider(object):
         logging.debug('Scanning directory {0} for XML files...'
                       ''.format(self.directory))
         # List all xml files and turn the filenames into identifiers.
-        file_count = 0
-        for subdir, _, files in os.walk(self.directory):
-            for filename in files:
-                if filename.lower().endswith('.xml'):
-                    path = os.path.join(subdir, filename)
-                    yield self.make_identifier(path)
-                    file_count += 1
-        if file_count == 0:
+        index = {}
+        for path, stat in _scan_xml_files(self.directory):
+            identifier = self.make_identifier(path)
+            index[identifier] = (None if stat is None else
+                                 self._file_info(path, stat))
+            yield identifier
+        self._index = index
+        if self._digests is not None:
+            self._digests.retain(info.path for info in index.itervalues()
+                                 if info is not None)
+            self._digests.save()
+        if len(index) == 0:
             logging.warning('No XML files found in {0}'
                             ''.format(self.directory))
 
@@ -82,12 +147,60 @@ class DdiFileProvider(object):
             `True`, if metadata or sets of the item have change since the
             given time. Otherwise `False`.
         """
-        filename = self.get_filename(identifier)
-        path = os.path.join(self.directory, filename)
-        mtime = os.path.getmtime(path)
-        ctime = os.path.getctime(path)
-        datestamp = datetime.utcfromtimestamp(max(mtime, ctime))
-        return datestamp >= since
+        return _modified(self.get_file_info(identifier)) >= since
+
+    def changed_since(self, since):
+        """
+        List the items modified since the given time.
+
+        Parameters
+        ----------
+        since: datetime.datetime
+            Ignore modifications before this date/time.
+
+        Return
+        ------
+        iterable of unicode:
+            OAI identifiers of the modified items.
+        """
+        if self._index is None:
+            # Scan the directory.
+            for _ in self.identifiers():
+                pass
+        # Files which could not be accessed are reported as changed, so
+        # that the error is logged when fetching them.
+        return [identifier
+                for identifier, info in self._index.iteritems()
+                if info is None or _modified(info) >= since]
+
+    def watch(self, delay=2.0):
+        """
+        Watch the directory for changed files with inotify.
+
+        The watches are set up before returning, and the files found
+        while setting them up are compared with the index, so that the
+        changes made since the last scan are reported too. After that,
+        the index is updated from the events without scanning the
+        directory again.
+
+        Parameters
+        ----------
+        delay: float
+            Seconds to wait for more events after an event, so that files
+            changed together are reported in one batch.
+
+        Return
+        ------
+        iterable of (list of unicode, list of unicode):
+            (changed identifiers, removed identifiers) tuples for each
+            batch of changes. The iteration blocks until files change.
+
+        Raises
+        ------
+        OSError:
+            If inotify is not available.
+        """
+        return _Watcher(self).batches(delay)
 
     def get_sets(self, identifier):
         """
@@ -132,14 +245,51 @@ class DdiFileProvider(object):
         Exception:
             If converting or reading the metadata fails.
         """
-        if metadata_prefix != 'oai_dc':
-            return None
+        return self.get_all_records(identifier,
+                                    [metadata_prefix])[metadata_prefix]
+
+    def get_all_records(self, identifier, metadata_prefixes):
+        """
+        Fetch the metadata of an item in several formats, reading its
+        file only once.
+
+        Parameters
+        ----------
+        identifier: unicode
+            The OAI identifier (as returned by identifiers()) of the item.
+        metadata_prefixes: list of unicode
+            The metadata prefixes (as returned by formats()) of the
+            formats.
+
+        Return
+        ------
+        dict from unicode to str or NoneType:
+            Mapping from the metadata prefixes to XML fragments, or to
+            `None` if the format is not available for the item.
+
+        Raises
+        ------
+        Exception:
+            If converting or reading the metadata fails.
+        """
+        records = dict.fromkeys(metadata_prefixes)
+        pass_through = self.pass_through and DDI_PREFIX in records
+        if 'oai_dc' not in records and not pass_through:
+            return records
+
+        info = self.get_file_info(identifier)
+        with open(info.path, 'rb') as file_:
+            # The whole document is needed for passing it through.
+            if pass_through or info.size < STREAMING_THRESHOLD:
+                codebook = etree.parse(file_).getroot()
+            else:
+                codebook = read_ddi(file_)
 
-        filename = self.get_filename(identifier)
-        path = os.path.join(self.directory, filename)
-        with open(path, 'r') as file_:
-            xmltree = etree.parse(file_)
-        return etree.tostring(convert_to_dc(xmltree))
+        if 'oai_dc' in records:
+            records['oai_dc'] = etree.tostring(convert_to_dc(codebook))
+        if pass_through:
+            records[DDI_PREFIX] = _pass_through(codebook)
+        return records
 
     def make_identifier(self, filename):
         """
@@ -157,65 +307,571 @@ class DdiFileProvider(object):
             raise ValueError('invalid identifier')
         return identifier[len(self.oai_identifier_prefix):] + '.xml'
 
+    def get_file_info(self, identifier):
+        """
+        Find the file of an item from the index, or from the file system
+        if the directory has not been scanned.
 
-def convert_to_dc(record):
-    # Namespaces.
+        Return
+        ------
+        _FileInfo:
+            The path, modification times and size of the file.
+
+        Raises
+        ------
+        ValueError:
+            If the identifier is not valid.
+        OSError:
+            If the file does not exist.
+        """
+        if self._index is not None:
+            info = self._index.get(identifier)
+            if info is not None:
+                return info
+        path = os.path.join(self.directory, self.get_filename(identifier))
+        return self._file_info(path, os.stat(path))
+
+    def _file_info(self, path, stat):
+        """Make the index entry of a file."""
+        if self._digests is not None:
+            modified = self._digests.modified(path, stat)
+        else:
+            modified = max(stat.st_mtime, stat.st_ctime)
+        return _FileInfo(path, stat.st_size, modified)
+
+
+class _DigestCache(object):
+    """
+    SHA-1 digests of the contents of files, stored in a JSON file.
+
+    The entries are keyed by the path of the file relative to the
+    directory. Each entry contains the size, modification time and
+    status change time of the file when its digest was computed, the
+    digest, and the time when the contents were last seen to change.
+    """
+
+    def __init__(self, path, directory):
+        self.path = path
+        self._directory = directory
+        self._entries = self._load()
+        self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as file_:
+                return json.load(file_)
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        except ValueError as error:
+            logging.warning('Ignoring invalid digest cache {0}: {1}'
+                            ''.format(self.path, error))
+        return {}
+
+    def _key(self, path):
+        return os.path.relpath(path, self._directory)
+
+    def modified(self, path, stat):
+        """
+        Return the time when the contents of a file last changed.
+
+        The file is only read if its size or times have changed since
+        its digest was computed.
+        """
+        key = self._key(path)
+        entry = self._entries.get(key)
+        times = [stat.st_size, stat.st_mtime, stat.st_ctime]
+        if entry is not None and entry[:3] == times:
+            return entry[4]
+
+        try:
+            digest = _digest(path)
+        except (IOError, OSError):
+            # Reading fails again when the file is converted, and the
+            # error is logged then.
+            return max(stat.st_mtime, stat.st_ctime)
+        if entry is not None and entry[3] == digest:
+            modified = entry[4]
+        else:
+            modified = max(stat.st_mtime, stat.st_ctime)
+        self._entries[key] = times + [digest, modified]
+        self._dirty = True
+        return modified
+
+    def remove(self, path):
+        """Forget a removed file."""
+        if self._entries.pop(self._key(path), None) is not None:
+            self._dirty = True
+
+    def retain(self, paths):
+        """Forget all files except the given ones."""
+        keys = set(self._key(path) for path in paths)
+        for key in self._entries.keys():
+            if key not in keys:
+                del self._entries[key]
+                self._dirty = True
+
+    def save(self):
+        """Write the cache to its file, if it has changed."""
+        if not self._dirty:
+            return
+        # Replace the file atomically, so that an interrupted write does
+        # not lose the cache.
+        fd, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'wb') as file_:
+                json.dump(self._entries, file_)
+            os.rename(temporary, self.path)
+        except Exception:
+            os.remove(temporary)
+            raise
+        self._dirty = False
+
+
+def _digest(path):
+    """Compute the SHA-1 digest of the contents of a file."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file_:
+        for block in iter(lambda: file_.read(64 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+"""The DDI Codebook 2.5 format, disseminated as is."""
+DDI_PREFIX = 'ddi_c'
+DDI_NAMESPACE = 'ddi:codebook:2_5'
+DDI_SCHEMA = ('http://www.ddialliance.org/Specification/DDI-Codebook/2.5/'
+              'XMLSchema/codebook.xsd')
+
+
+def _pass_through(codebook):
+    """
+    Serialize a DDI Codebook 2.5 document as is.
+
+    Return
+    ------
+    str or NoneType:
+        The document, or `None` if it is not in the DDI Codebook 2.5
+        namespace or does not refer to its schema.
+    """
+    if etree.QName(codebook).namespace != DDI_NAMESPACE:
+        return None
+    schema_location = codebook.get(
+        '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation')
+    if schema_location is None or DDI_SCHEMA not in schema_location.split():
+        return None
+    return etree.tostring(codebook)
+
+
+"""Sections of DDI Codebooks used by the DC crosswalk."""
+DDI_SECTIONS = frozenset(['stdyDscr', 'fileDscr'])
+
+"""Size in bytes of the smallest DDI files read with `read_ddi`. Smaller
+files are parsed faster as a whole."""
+STREAMING_THRESHOLD = 1024 * 1024
+
+
+def read_ddi(file_, sections=DDI_SECTIONS):
+    """
+    Parse the given top-level sections of a DDI Codebook.
+
+    The document is parsed incrementally, and the elements of the other
+    sections (e.g. the variables in `dataDscr`) are discarded as soon as
+    they have been parsed. Memory use therefore depends on the size of
+    the kept sections, not the whole document.
+
+    Parameters
+    ----------
+    file_: file or str
+        The file object or path of the document.
+    sections: collection of str
+        Tags of the children of the root element to keep, without
+        namespaces.
+
+    Return
+    ------
+    lxml.etree._Element:
+        The root element containing only the kept sections.
+    """
+    root = None
+    depth = 0
+    keep = True
+    for event, element in etree.iterparse(file_, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = element
+            elif depth == 2:
+                keep = etree.QName(element).localname in sections
+            continue
+
+        depth -= 1
+        if keep or depth == 0:
+            continue
+        if depth == 1:
+            # End of a discarded section.
+            element.clear()
+            root.remove(element)
+        else:
+            element.clear()
+            # Delete the preceding siblings, which have been cleared
+            # already.
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+    return root
+
+
+def _modified(info):
+    """Return the time when a file was last modified in UTC."""
+    return datetime.utcfromtimestamp(info.modified)
+
+
+"""Events which may change the XML files of a watched directory."""
+_WATCH_MASK = (inotify.IN_ATTRIB | inotify.IN_CLOSE_WRITE |
+               inotify.IN_CREATE | inotify.IN_DELETE |
+               inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+               inotify.IN_ONLYDIR | inotify.IN_DONT_FOLLOW)
+
+"""The longest time in seconds to collect events into one batch."""
+_MAX_BATCH_DELAY = 60
+
+
+class _Watcher(object):
+    """
+    Watch the directory tree of a `DdiFileProvider` and keep its index
+    up to date.
+    """
+
+    def __init__(self, provider):
+        self._provider = provider
+        self._inotify = inotify.Inotify()
+        # Mapping from watch descriptors to directories.
+        self._directories = {}
+        self._overflowed = False
+        try:
+            paths = self._watch_tree(provider.directory)
+            if provider._index is None:
+                # Nothing has been reported yet.
+                provider._index = {}
+                self._update(paths)
+                self._pending = ([], [])
+            else:
+                paths.update(self._indexed_paths(provider.directory))
+                self._pending = self._update(paths)
+        except Exception:
+            self._inotify.close()
+            raise
+
+    def batches(self, delay):
+        """Yield (changed, removed) identifiers for each batch."""
+        try:
+            changed, removed = self._pending
+            while True:
+                if changed or removed:
+                    yield changed, removed
+                changed, removed = self._update(self._collect(delay))
+        finally:
+            self._inotify.close()
+
+    def _collect(self, delay):
+        """Wait for events and return the paths of changed files."""
+        paths = set()
+        events = self._inotify.read_events()
+        deadline = time.time() + _MAX_BATCH_DELAY
+        while events:
+            for event in events:
+                self._handle(event, paths)
+            timeout = min(delay, deadline - time.time())
+            if timeout <= 0:
+                break
+            events = self._inotify.read_events(timeout)
+
+        if self._overflowed:
+            logging.warning('Missed file system events, scanning {0} '
+                            'for changes...'.format(self._provider.directory))
+            self._overflowed = False
+            paths.update(self._watch_tree(self._provider.directory))
+            paths.update(self._indexed_paths(self._provider.directory))
+        return paths
+
+    def _handle(self, event, paths):
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            self._overflowed = True
+            return
+        if event.mask & inotify.IN_IGNORED:
+            # The directory was removed.
+            self._directories.pop(event.wd, None)
+            return
+        directory = self._directories.get(event.wd)
+        if directory is None:
+            return
+
+        path = os.path.join(directory, self._decode(event.name))
+        if not event.mask & inotify.IN_ISDIR:
+            if path.lower().endswith('.xml'):
+                paths.add(path)
+        elif event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+            # Files may have been added before the watch.
+            paths.update(self._watch_tree(path))
+        elif event.mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self._unwatch_tree(path)
+            paths.update(self._indexed_paths(path))
+
+    def _decode(self, name):
+        """Decode a file name like os.listdir does for unicode paths."""
+        if not isinstance(self._provider.directory, unicode):
+            return name
+        try:
+            return name.decode(sys.getfilesystemencoding())
+        except UnicodeDecodeError:
+            return name
+
+    def _watch_tree(self, directory):
+        """
+        Watch a directory and its subdirectories.
+
+        Return
+        ------
+        set of str:
+            Paths of the XML files found in the directories.
+        """
+        paths = set()
+        try:
+            wd = self._inotify.add_watch(directory, _WATCH_MASK)
+            self._directories[wd] = directory
+            entries = list(scandir(directory))
+        except OSError:
+            # The directory was removed or replaced. That is reported by
+            # the events of its parent.
+            return paths
+        for entry in entries:
+            if entry.is_dir():
+                # Do not follow symbolic links, like _scan_xml_files.
+                if not entry.is_symlink():
+                    paths.update(self._watch_tree(entry.path))
+            elif entry.name.lower().endswith('.xml'):
+                paths.add(entry.path)
+        return paths
+
+    def _unwatch_tree(self, directory):
+        """Stop watching a moved or removed directory tree."""
+        prefix = os.path.join(directory, '')
+        for wd, path in self._directories.items():
+            if path == directory or path.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._directories[wd]
+
+    def _indexed_paths(self, directory):
+        """List the paths of the indexed files in a directory tree."""
+        prefix = os.path.join(directory, '')
+        paths = []
+        for identifier, info in self._provider._index.iteritems():
+            if info is not None:
+                path = info.path
+            else:
+                path = os.path.join(self._provider.directory,
+                                    self._provider.get_filename(identifier))
+            if path.startswith(prefix):
+                paths.append(path)
+        return paths
+
+    def _update(self, paths):
+        """
+        Update the index entries of the given files.
+
+        Return
+        ------
+        (list of unicode, list of unicode):
+            Identifiers of the changed and removed files.
+        """
+        index = self._provider._index
+        digests = self._provider._digests
+        changed = []
+        removed = []
+        for path in paths:
+            identifier = self._provider.make_identifier(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                if not os.path.lexists(path):
+                    if identifier in index:
+                        del index[identifier]
+                        removed.append(identifier)
+                    if digests is not None:
+                        digests.remove(path)
+                    continue
+                # Files which cannot be accessed are reported as changed,
+                # like in `changed_since`.
+                info = None
+            else:
+                if stat_module.S_ISDIR(stat.st_mode):
+                    continue
+                info = self._provider._file_info(path, stat)
+            if info is None or index.get(identifier) != info:
+                index[identifier] = info
+                changed.append(identifier)
+        if digests is not None:
+            digests.save()
+        return changed, removed
+
+
+def _scan_xml_files(directory, top=True):
+    """
+    Find XML files in a directory tree with a single scan.
+
+    Subdirectories which cannot be read are skipped, like os.walk
+    does.
+
+    Return
+    ------
+    iterable of (str, os.stat_result or None):
+        Paths and stats of the files. The stat is `None` if the file
+        could not be accessed, e.g. if it is a broken symbolic link.
+
+    Raises
+    ------
+    OSError:
+        If `directory` itself cannot be read.
+    """
+    try:
+        entries = list(scandir(directory))
+    except OSError as error:
+        if top:
+            raise
+        logging.warning('Skipping directory {0}: {1}'
+                        ''.format(directory, error))
+        return
+    subdirectories = []
+    for entry in entries:
+        if entry.is_dir():
+            # Do not follow symbolic links, like os.walk.
+            if not entry.is_symlink():
+                subdirectories.append(entry.path)
+        elif entry.name.lower().endswith('.xml'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                stat = None
+            yield entry.path, stat
+    for subdirectory in subdirectories:
+        for result in _scan_xml_files(subdirectory, top=False):
+            yield result
+
+
+class Crosswalk(object):
+    """
+    A crosswalk from an XML format to OAI DC, compiled once and reused
+    for all records.
+
+    The paths of each DC element are compiled to XPath expressions, and
+    the qualified names of the DC elements are formed in advance.
+    """
+
+    """Namespaces of the OAI DC format."""
     nsmap = {
         'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
         'dc': 'http://purl.org/dc/elements/1.1/',
         'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
     }
 
-    # Mapping from DDI Version 2 to Dublin Core
-    # (http://www.ddialliance.org/resources/tools/dc).
-    mapping = {
-        'title': ['stdyDscr/citation/titlStmt/titl'],
-        'creator': ['stdyDscr/citation/rspStmt/AuthEnty'],
-        'subject': [
-            'stdyDscr/stdyInfo/subject/keyword',
-            'stdyDscr/stdyInfo/subject/topcClas',
-        ],
-        'description': ['stdyDscr/stdyInfo/abstract/p'],
-        'publisher': ['stdyDscr/citation/prodStmt/producer'],
-        'contributor': ['stdyDscr/citation/rspStmt/othId/p'],
-        'date': ['stdyDscr/citation/prodStmt/prodDate'],
-        'type': ['stdyDscr/stdyInfo/sumDscr/dataKind'],
-        'format': ['fileDscr/fileTxt/fileType'],
-        'identifier': ['stdyDscr/citation/titlStmt/IDNo'],
-        'source': ['stdyDscr/method/dataColl/sources/dataSrc'],
-        'language': [],
-        'relation': [
-            'stdyDscr/othrStdyMat/relMat',
-            'stdyDscr/othrStdyMat/relStdy',
-            'stdyDscr/othrStdyMat/relPubl',
-        ],
-        'coverage': [
-            'stdyDscr/stdyInfo/sumDscr/timePrd',
-            'stdyDscr/stdyInfo/sumDscr/collDate',
-            'stdyDscr/stdyInfo/sumDscr/nation',
-            'stdyDscr/stdyInfo/sumDscr/geogCover',
-        ],
-        'rights': ['stdyDscr/citation/prodStmt/copyright'],
-    }
+    def __init__(self, mapping, namespace=None):
+        """
+        Compile the crosswalk.
 
-    root = etree.Element('{{{oai_dc}}}dc'.format(**nsmap), nsmap=nsmap)
-    root.set('{{{xsi}}}schemaLocation'.format(**nsmap),
-        ('http://www.openarchives.org/OAI/2.0/oai_dc/ '
-         'http://www.openarchives.org/OAI/2.0/oai_dc.xsd')
-    )
-
-    def add_field(name, text):
-        """Add a field to the DC XML tree."""
-        if text is not None and len(text) > 0 and not text.isspace():
-            element = root.makeelement(
-                '{{{dc}}}{name}'.format(name=name, **nsmap)
-            )
-            element.text = text
-            root.append(element)
-
-    for dc_tag, ddi_paths in mapping.iteritems():
-        for ddi_path in ddi_paths:
-            for element in record.findall(ddi_path):
-                add_field(dc_tag, element.text)
+        Parameters
+        ----------
+        mapping: dict from str to list of str
+            Mapping from DC element names to paths of the source elements
+            relative to the root element.
+        namespace: str or NoneType
+            If given, the paths match elements both without a namespace
+            and in this namespace.
+        """
+        self._fields = [
+            ('{{{dc}}}{name}'.format(name=name, **self.nsmap),
+             self._compile(path, namespace))
+            for name, paths in mapping.iteritems()
+            for path in paths
+        ]
+        self._root_tag = '{{{oai_dc}}}dc'.format(**self.nsmap)
+        self._schema_location_attribute = (
+            '{{{xsi}}}schemaLocation'.format(**self.nsmap))
 
-    return root
+    @staticmethod
+    def _compile(path, namespace):
+        if namespace is None:
+            return etree.XPath(path)
+        qualified = '/'.join('src:' + step for step in path.split('/'))
+        return etree.XPath('{0} | {1}'.format(path, qualified),
+                           namespaces={'src': namespace})
+
+    def convert(self, record):
+        """
+        Convert a record to OAI DC.
+
+        Parameters
+        ----------
+        record: lxml.etree._ElementTree or lxml.etree._Element
+            The source document or its root element.
+
+        Return
+        ------
+        lxml.etree._Element:
+            The root element of the OAI DC document.
+        """
+        if hasattr(record, 'getroot'):
+            record = record.getroot()
+
+        root = etree.Element(self._root_tag, nsmap=self.nsmap)
+        root.set(self._schema_location_attribute,
+            ('http://www.openarchives.org/OAI/2.0/oai_dc/ '
+             'http://www.openarchives.org/OAI/2.0/oai_dc.xsd')
+        )
+
+        for tag, xpath in self._fields:
+            for element in xpath(record):
+                text = element.text
+                if text is not None and len(text) > 0 and not text.isspace():
+                    etree.SubElement(root, tag).text = text
+
+        return root
+
+
+# Mapping from DDI Version 2 to Dublin Core
+# (http://www.ddialliance.org/resources/tools/dc).
+DDI_TO_DC = Crosswalk({
+    'title': ['stdyDscr/citation/titlStmt/titl'],
+    'creator': ['stdyDscr/citation/rspStmt/AuthEnty'],
+    'subject': [
+        'stdyDscr/stdyInfo/subject/keyword',
+        'stdyDscr/stdyInfo/subject/topcClas',
+    ],
+    'description': ['stdyDscr/stdyInfo/abstract/p'],
+    'publisher': ['stdyDscr/citation/prodStmt/producer'],
+    'contributor': ['stdyDscr/citation/rspStmt/othId/p'],
+    'date': ['stdyDscr/citation/prodStmt/prodDate'],
+    'type': ['stdyDscr/stdyInfo/sumDscr/dataKind'],
+    'format': ['fileDscr/fileTxt/fileType'],
+    'identifier': ['stdyDscr/citation/titlStmt/IDNo'],
+    'source': ['stdyDscr/method/dataColl/sources/dataSrc'],
+    'language': [],
+    'relation': [
+        'stdyDscr/othrStdyMat/relMat',
+        'stdyDscr/othrStdyMat/relStdy',
+        'stdyDscr/othrStdyMat/relPubl',
+    ],
+    'coverage': [
+        'stdyDscr/stdyInfo/sumDscr/timePrd',
+        'stdyDscr/stdyInfo/sumDscr/collDate',
+        'stdyDscr/stdyInfo/sumDscr/nation',
+        'stdyDscr/stdyInfo/sumDscr/geogCover',
+    ],
+    'rights': ['stdyDscr/citation/prodStmt/copyright'],
+}, namespace=DDI_NAMESPACE)
+
+
+def convert_to_dc(record):
+    """Convert a DDI Codebook document to OAI DC."""
+    return DDI_TO_DC.convert(record)
@@ -1,9 +1,29 @@
+import collections
+import functools
+import heapq
+import itertools
 import logging
+import multiprocessing
+import multiprocessing.pool
+import tempfile
+import time
+import traceback
 
 from .. import models
 from ..exception import HarvestError
-
-def update(provider, since=None, purge=False, dry_run=False):
+from .report import ImportReport
+
+def update(provider,
+           since=None,
+           purge=False,
+           dry_run=False,
+           workers=1,
+           processes=False,
+           commit_interval=1,
+           commit_timeout=None,
+           stream_items=False,
+           journal=False,
+           report=None):
     """Update metadata formats, items, records and sets.
 
     Parameters
@@ -33,6 +53,36 @@ def update(provider, since=None, purge=False, dry_run=False):
                 cannot be disseminated in the specified format, return
                 None.
 
+        The provider may also have the following method:
+
+            sorted_identifiers(): iterable of unicode
+                OAI identifiers of all items in ascending order. Used
+                instead of `identifiers` if `stream_items` is `True`.
+
+            changed_since(since: datetime): iterable of unicode
+                OAI identifiers of the items that have changed since the
+                given time. Used instead of `has_changed`.
+
+            get_records(identifiers: list of unicode, prefix: unicode):
+                    iterable of unicode or None
+                Disseminate the metadata of the specified items in the
+                specified format, in the order of `identifiers`. Used
+                instead of `get_record`.
+
+            get_all_records(identifier: unicode,
+                            prefixes: list of unicode):
+                    dict from unicode to unicode or None
+                Disseminate the metadata of the specified item in all the
+                specified formats at once, e.g. from a single read of the
+                source document. Used instead of `get_records` and
+                `get_record`.
+
+            watch(delay: float):
+                    iterable of (list of unicode, list of unicode)
+                Watch the metadata for changes, and yield the identifiers
+                of the changed and removed items in batches. Used by
+                `update_changed` in the watch mode of the importer.
+
     since: datetime.datetime or None
         Time of the last update in UTC, or `None`.
     purge: bool
@@ -41,6 +91,28 @@ def update(provider, since=None, purge=False, dry_run=False):
     dry_run: bool
         If `True`, fetch records as usual but do not actually change the
         database.
+    workers: int
+        Number of workers fetching records from the provider
+        concurrently. See `update_records`.
+    processes: bool
+        If `True`, run the workers in separate processes instead of
+        threads.
+    commit_interval: int
+        Commit the updated records after this many records.
+    commit_timeout: float or None
+        Commit the updated records after this many seconds, even if
+        `commit_interval` records have not been updated yet.
+    stream_items: bool
+        If `True`, compare the items of the provider and the database as
+        sorted streams instead of loading them in memory. See
+        `update_items`.
+    journal: bool
+        If `True`, record the processed items in the database and skip
+        the items processed by an interrupted import. See
+        `update_records`.
+    report: ImportReport or None
+        The report to which the timings and counters of the import are
+        added.
 
     Raises
     ------
@@ -48,9 +120,78 @@ def update(provider, since=None, purge=False, dry_run=False):
         If the provider raises an exception and the harvest cannot be
         continued.
     """
-    prefixes = update_formats(provider, purge, dry_run)
-    identifiers = update_items(provider, purge, dry_run)
-    update_records(provider, identifiers, prefixes, since, dry_run)
+    if report is None:
+        report = ImportReport()
+    with report.timed('update_formats'):
+        prefixes = update_formats(provider, purge, dry_run)
+    with report.timed('update_items'):
+        identifiers = update_items(provider, purge, dry_run, stream_items)
+    with report.timed('update_records'):
+        update_records(provider, identifiers, prefixes, since, dry_run,
+                       workers, processes, commit_interval, commit_timeout,
+                       journal, report)
+
+
+def update_changed(provider,
+                   changed,
+                   removed,
+                   purge=False,
+                   dry_run=False,
+                   workers=1,
+                   processes=False,
+                   commit_interval=1,
+                   commit_timeout=None,
+                   report=None):
+    """Update the given items without listing all items of the provider.
+
+    The changed items are added to the database if they are new, and all
+    their records are updated. The removed items are marked as deleted.
+    This is used to apply the changes reported by the `watch` method of
+    the provider. See `update` for the other parameters.
+
+    Parameters
+    ----------
+    changed: list of unicode
+        Identifiers of the added and modified items.
+    removed: list of unicode
+        Identifiers of the removed items.
+
+    Raises
+    ------
+    HarvestError:
+        If updating the items fails.
+    """
+    log = logging.getLogger(__name__)
+    log.debug('Updating {0} changed and {1} removed item{2}...'.format(
+        len(changed), len(removed), '' if len(removed) == 1 else 's'))
+    if report is None:
+        report = ImportReport()
+
+    with report.timed('update_items'):
+        try:
+            prefixes = provider.formats().keys()
+            if not dry_run:
+                for identifier in changed:
+                    models.Item.create_or_update(identifier)
+                models.Item.mark_many_as_deleted(removed)
+        except Exception as e:
+            models.rollback()
+            log.exception('Failed to update items: {0}'.format(e))
+            raise HarvestError(e.message)
+        else:
+            if dry_run:
+                models.rollback()
+            else:
+                models.commit()
+                if purge:
+                    _purge_deleted()
+            log.info('Removed {0} item{1}.'.format(
+                len(removed), '' if len(removed) == 1 else 's'))
+
+    with report.timed('update_records'):
+        update_records(provider, changed, prefixes, None, dry_run,
+                       workers, processes, commit_interval, commit_timeout,
+                       False, report)
 
 
 def update_formats(provider, purge=False, dry_run=False):
@@ -68,12 +209,10 @@ def update_formats(provider, purge=False, dry_run=False):
             for format_ in models.Format.list(ignore_deleted=True)
         )
 
-        removed = 0
-        for prefix, format_ in old_formats.iteritems():
-            if prefix not in new_formats:
-                if not dry_run:
-                    format_.mark_as_deleted()
-                removed += 1
+        removed = [prefix for prefix in old_formats
+                   if prefix not in new_formats]
+        if not dry_run:
+            models.Format.mark_many_as_deleted(removed)
 
         added = 0
         for prefix, (namespace, schema) in new_formats.iteritems():
@@ -81,9 +220,6 @@ def update_formats(provider, purge=False, dry_run=False):
                 models.Format.create_or_update(prefix, namespace, schema)
             if prefix not in old_formats:
                 added += 1
-
-        if purge and not dry_run:
-            models.purge_deleted()
     except Exception as e:
         models.rollback()
         log.exception('Failed to update metadata formats: {0}'.format(e))
@@ -94,11 +230,13 @@ def update_formats(provider, purge=False, dry_run=False):
             models.rollback()
         else:
             models.commit()
+            if purge:
+                _purge_deleted()
         # TODO: log number of changed formats
         log.info(
             'Removed {0} format{1} and added {2} format{3}.'
             ''.format(
-                removed, '' if removed == 1 else 's',
+                len(removed), '' if len(removed) == 1 else 's',
                 added,   '' if added   == 1 else 's',
             )
         )
@@ -106,36 +244,33 @@ def update_formats(provider, purge=False, dry_run=False):
         return new_formats.keys()
 
 
-def update_items(provider, purge=False, dry_run=False):
+def update_items(provider, purge=False, dry_run=False, streaming=False):
+    """Add new items and mark removed items as deleted.
+
+    By default, the identifiers of the provider and the items of the
+    database are loaded in memory. If `streaming` is `True`, the sorted
+    identifiers of the provider are instead merged with the identifiers
+    of the database read in order, and the changes are written in bulk.
+    Identifiers of providers without a `sorted_identifiers` method are
+    sorted in temporary files if there are too many of them to sort in
+    memory.
+
+    Return
+    ------
+    iterable of unicode:
+        The identifiers of the provider. In streaming mode, they are read
+        back from a temporary file in ascending order.
+    """
     log = logging.getLogger(__name__)
     log.debug('Looking for added and removed items...')
 
     try:
-        new_identifiers = frozenset(map(unicode, provider.identifiers()))
-
-        old_items = dict(
-            (item.identifier, item)
-            for item in models.Item.list(ignore_deleted=True)
-        )
-
-        removed = 0
-        for identifier, item in old_items.iteritems():
-            if identifier not in new_identifiers:
-                if not dry_run:
-                    item.mark_as_deleted()
-                log.debug('deleted {0}'.format(identifier))
-                removed += 1
-
-        added = 0
-        for identifier in new_identifiers:
-            if not dry_run:
-                models.Item.create_or_update(identifier)
-            if identifier not in old_items:
-                log.debug('added {0}'.format(identifier))
-                added += 1
-
-        if purge and not dry_run:
-            models.purge_deleted()
+        if streaming:
+            new_identifiers, removed, added = _merge_items(provider,
+                                                           dry_run)
+        else:
+            new_identifiers, removed, added = _diff_items(provider,
+                                                          dry_run)
     except Exception as e:
         models.rollback()
         log.exception('Failed to update items: {0}'.format(e))
@@ -145,6 +280,8 @@ def update_items(provider, purge=False, dry_run=False):
             models.rollback()
         else:
             models.commit()
+            if purge:
+                _purge_deleted()
         log.info(
             'Removed {0} item{1} and added {2} item{3}.'
             ''.format(
@@ -156,86 +293,720 @@ def update_items(provider, purge=False, dry_run=False):
         return new_identifiers
 
 
-def update_sets(provider, identifier, dry_run=False):
+def _purge_deleted():
+    """Purge the deleted rows after the changes have been committed.
+
+    The purge commits after each batch, so it is not run inside the
+    blocks which roll back the changes if they fail.
+    """
     log = logging.getLogger(__name__)
-    log.debug('Updating sets...')
+    try:
+        models.purge_deleted(after_batch=models.commit)
+    except Exception as e:
+        models.rollback()
+        log.exception('Failed to purge deleted rows: {0}'.format(e))
+        raise HarvestError(e.message)
+
+
+def _diff_items(provider, dry_run):
+    """Compare the items of the provider and the database in memory."""
+    log = logging.getLogger(__name__)
+
+    new_identifiers = frozenset(map(unicode, provider.identifiers()))
 
-    # Remove the item from old sets.
-    item = None
+    old_items = dict(
+        (item.identifier, item)
+        for item in models.Item.list(ignore_deleted=True)
+    )
+
+    removed = [identifier for identifier in old_items
+               if identifier not in new_identifiers]
+    for identifier in removed:
+        log.debug(u'deleted {0}'.format(identifier))
     if not dry_run:
-        item = models.Item.get(identifier)
-        item.clear_sets()
+        models.Item.mark_many_as_deleted(removed)
+
+    added = 0
+    for identifier in new_identifiers:
+        if not dry_run:
+            models.Item.create_or_update(identifier)
+        if identifier not in old_items:
+            log.debug(u'added {0}'.format(identifier))
+            added += 1
+
+    return new_identifiers, len(removed), added
+
+
+"""Number of items written to the database at a time."""
+_ITEM_BATCH_SIZE = 500
+
+"""Number of identifiers sorted in memory before spilling them to disk."""
+_SORT_BUFFER_SIZE = 100000
+
+
+def _merge_items(provider, dry_run):
+    """Compare the items of the provider and the database as sorted
+    streams."""
+    log = logging.getLogger(__name__)
+
+    if hasattr(provider, 'sorted_identifiers'):
+        new_identifiers = itertools.imap(unicode,
+                                         provider.sorted_identifiers())
+    else:
+        new_identifiers = _sort_identifiers(provider.identifiers(),
+                                            _SORT_BUFFER_SIZE)
+    old_items = models.Item.iter_identifiers(_ITEM_BATCH_SIZE)
+
+    writer = _ItemWriter(_ITEM_BATCH_SIZE, dry_run)
+    identifiers = _IdentifierFile()
+    removed = 0
+    added = 0
+    merged = _merge_join(_check_order(new_identifiers, 'provider'),
+                         _check_order(old_items, 'database',
+                                      key=lambda (i, _): i))
+    for identifier, is_new, old_deleted in merged:
+        if is_new:
+            identifiers.append(identifier)
+            if old_deleted is None:
+                writer.create(identifier)
+            elif old_deleted:
+                writer.undelete(identifier)
+            if old_deleted is not False:
+                log.debug(u'added {0}'.format(identifier))
+                added += 1
+        elif old_deleted is False:
+            writer.delete(identifier)
+            log.debug(u'deleted {0}'.format(identifier))
+            removed += 1
+    writer.flush()
+
+    return identifiers, removed, added
+
+
+def _merge_join(new_identifiers, old_items):
+    """Merge sorted identifiers with sorted (identifier, deleted) tuples.
+
+    Return
+    ------
+    iterable of (unicode, bool, bool or None):
+        (identifier, found in `new_identifiers`, deleted flag from
+        `old_items` or `None` if not found there) tuples in ascending
+        order of identifiers.
+    """
+    new = next(new_identifiers, None)
+    old = next(old_items, None)
+    while new is not None or old is not None:
+        if old is None or (new is not None and new < old[0]):
+            yield new, True, None
+            new = next(new_identifiers, None)
+        elif new is None or old[0] < new:
+            yield old[0], False, old[1]
+            old = next(old_items, None)
+        else:
+            yield new, True, old[1]
+            new = next(new_identifiers, None)
+            old = next(old_items, None)
+
+
+def _check_order(iterable, source, key=None):
+    """Skip duplicates and make sure that the values are sorted.
+
+    Raises
+    ------
+    ValueError:
+        If the values are not in ascending order.
+    """
+    previous = None
+    for value in iterable:
+        current = value if key is None else key(value)
+        if previous is not None and current <= previous:
+            if current == previous:
+                continue
+            raise ValueError(
+                '{0} identifiers are not sorted: "{1}" after "{2}"'
+                ''.format(source, current, previous))
+        previous = current
+        yield value
+
+
+def _sort_identifiers(identifiers, buffer_size):
+    """Sort identifiers in runs of `buffer_size` identifiers, spilling
+    the runs to temporary files, and merge the runs."""
+    runs = []
+    buffer_ = []
+    for identifier in identifiers:
+        buffer_.append(unicode(identifier))
+        if len(buffer_) >= buffer_size:
+            run = _IdentifierFile()
+            for value in sorted(buffer_):
+                run.append(value)
+            runs.append(iter(run))
+            buffer_ = []
+    buffer_.sort()
+    if not runs:
+        return iter(buffer_)
+    runs.append(iter(buffer_))
+    return heapq.merge(*runs)
+
+
+class _IdentifierFile(object):
+    """Identifiers stored in a temporary file, one per line."""
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+
+    def append(self, identifier):
+        # Escape line breaks and non-ASCII characters.
+        self._file.write(identifier.encode('unicode_escape') + '\n')
+
+    def __iter__(self):
+        self._file.seek(0)
+        for line in self._file:
+            yield line[:-1].decode('unicode_escape')
+
+
+class _ItemWriter(object):
+    """Create, undelete and delete items in batches."""
+
+    def __init__(self, batch_size, dry_run):
+        self._batch_size = batch_size
+        self._dry_run = dry_run
+        self._created = []
+        self._undeleted = []
+        self._deleted = []
+
+    def create(self, identifier):
+        self._add(self._created, identifier)
+
+    def undelete(self, identifier):
+        self._add(self._undeleted, identifier)
+
+    def delete(self, identifier):
+        self._add(self._deleted, identifier)
+
+    def _add(self, batch, identifier):
+        batch.append(identifier)
+        if len(batch) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the pending changes to the database."""
+        if not self._dry_run:
+            models.Item.create_many(self._created)
+            models.Item.undelete_many(self._undeleted)
+            models.Item.mark_many_as_deleted(self._deleted)
+        self._created = []
+        self._undeleted = []
+        self._deleted = []
+
+
+def update_sets(provider, identifier, dry_run=False, cache=None):
+    """Update the sets of an item.
+
+    Only the memberships which have changed are written to the
+    database.
+
+    Parameters
+    ----------
+    cache: SetCache or None
+        The sets written and the memberships loaded during this update.
+        If `None`, the memberships of the item are loaded and all its
+        sets are written.
+    """
+    log = logging.getLogger(__name__)
+    log.debug('Updating sets...')
 
     sets = provider.get_sets(identifier)
-    if len(sets) == 0:
+    if dry_run:
         return
+    if cache is None:
+        cache = SetCache()
+
     # Sort set specs by level.
     sets.sort(key=lambda (spec, _): spec.count(u':'))
     # TODO: make sure that sets contain the parent sets of all sets
+    new_specs = set()
     for spec, name in sets:
-        if not dry_run:
-            set_ = models.Set.create_or_update(spec, name)
-            item.add_to_set(set_)
+        cache.write_set(spec, name)
+        new_specs.add(spec)
+    old_specs = cache.memberships(identifier)
+    added = new_specs - old_specs
+    removed = old_specs - new_specs
+    if added or removed:
+        models.Item.update_memberships(identifier, added, removed,
+                                       models.leaf_set_specs(new_specs))
+
+
+class SetCache(object):
+    """Sets and set memberships of items cached during an update.
+
+    Each set is created or renamed once, instead of once for each item
+    in it. The memberships of items can be loaded in bulk with `load`
+    before updating their sets.
+    """
+
+    def __init__(self):
+        self._names = {}
+        self._memberships = {}
+
+    def load(self, identifiers):
+        """Load the memberships of the given items."""
+        self._memberships.update(models.Item.set_memberships(identifiers))
+
+    def memberships(self, identifier):
+        """Return the specs of the sets which contain an item, and
+        forget them."""
+        if identifier not in self._memberships:
+            self.load([identifier])
+        return self._memberships.pop(identifier, set())
+
+    def write_set(self, spec, name):
+        """Create or rename a set, unless already done."""
+        if self._names.get(spec) != name:
+            models.Set.create_or_update(spec, name)
+            self._names[spec] = name
+
+    def clear(self):
+        """Forget everything, e.g. after rolling back changes."""
+        self._names.clear()
+        self._memberships.clear()
 
 
 def update_records(provider,
                    identifiers,
                    prefixes,
                    since=None,
-                   dry_run=False):
+                   dry_run=False,
+                   workers=1,
+                   processes=False,
+                   commit_interval=1,
+                   commit_timeout=None,
+                   journal=False,
+                   report=None):
+    """Fetch records from the provider and update them to the database.
+
+    If `workers` is greater than one, the records are fetched from the
+    provider (`has_changed` and `get_record`) by a pool of workers. The
+    provider must then be thread-safe, or picklable if `processes` is
+    `True`. The results are written to the database by the calling
+    thread in the order of `identifiers`.
+
+    If the provider has the optional `changed_since`, `get_all_records`
+    or `get_records` methods, they are used instead of `has_changed` and
+    `get_record`. The records are then fetched in batches of items. If
+    `get_records` fails, the records of the batch are fetched one at a
+    time.
+
+    The transaction is committed after every `commit_interval` records
+    or `commit_timeout` seconds, whichever comes first. Each item and
+    record is written inside a savepoint, so a failing record is rolled
+    back alone without losing the other records of the batch.
+
+    If `journal` is `True`, each changed or failed item is recorded as a
+    `models.ProcessedItem` in the same transaction as its records, and
+    the items already recorded by an interrupted import are skipped.
+    Unchanged items are not recorded; an interrupted import checks them
+    again.
+    The caller must clear the journal when the import is finished.
+
+    The counters, provider call latencies and database write time are
+    added to `report`, if given. The time spent in `update_sets` is
+    recorded as a part of the `update_records` stage.
+    """
     log = logging.getLogger(__name__)
     if since is not None:
         log.info('Updating records modified since {0} UTC...'
                  ''.format(since))
     else:
         log.info('Updating all records...')
+    if report is None:
+        report = ImportReport()
 
-    updated = 0
+    if since is not None and hasattr(provider, 'changed_since'):
+        start = time.time()
+        try:
+            changed = frozenset(map(unicode, provider.changed_since(since)))
+            report.add_provider_calls(
+                [('changed_since', time.time() - start)])
+        except Exception as e:
+            log.warning(
+                'Failed to list changed items, checking them one at a '
+                'time: {0}'.format(e))
+        else:
+            identifiers = itertools.ifilter(changed.__contains__,
+                                            identifiers)
+            since = None
+
+    if journal and not dry_run:
+        processed = models.ProcessedItem.identifiers()
+        if processed:
+            log.info('Skipping {0} item{1} processed by an interrupted '
+                     'import.'.format(len(processed),
+                                      '' if len(processed) == 1 else 's'))
+            identifiers = itertools.ifilterfalse(processed.__contains__,
+                                                 identifiers)
+    else:
+        journal = False
+
+    fetch = functools.partial(_fetch_items,
+                              provider,
+                              prefixes=prefixes,
+                              since=since)
+    batches = _batches(identifiers, _RECORD_BATCH_SIZE)
+    pool = None
+    if workers > 1:
+        log.debug('Fetching records with {0} worker {1}...'.format(
+            workers, 'processes' if processes else 'threads'))
+        if processes:
+            pool = multiprocessing.Pool(workers)
+        else:
+            pool = multiprocessing.pool.ThreadPool(workers)
+        fetched = _bounded_imap(pool, fetch, batches,
+                                _BATCHES_PER_WORKER * workers)
+    else:
+        fetched = itertools.imap(fetch, batches)
+    fetched = _add_provider_calls(fetched, report)
+
+    committer = _Committer(commit_interval, commit_timeout, dry_run,
+                           report)
+    try:
+        updated = _write_records(provider, fetched, committer, dry_run,
+                                 journal, report)
+        committer.commit()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # End the transaction in case no records were updated.
+    models.rollback()
+
+    # TODO: log number of added records
+    log.info('Updated {0} record{1}.'
+             ''.format(updated, '' if updated == 1 else 's'))
+
+
+"""Number of items fetched from the provider at a time."""
+_RECORD_BATCH_SIZE = 100
+
+"""Number of batches fetched ahead of the writer for each worker."""
+_BATCHES_PER_WORKER = 2
+
+
+def _bounded_imap(pool, func, iterable, limit):
+    """Like `pool.imap`, but submit at most `limit` values before their
+    results are consumed, so that fetched batches do not pile up in
+    memory while the writer is busy."""
+    pending = collections.deque()
+    for value in iterable:
+        if len(pending) >= limit:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (value,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def _batches(iterable, size):
+    """Split an iterable into lists of at most `size` values."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _add_provider_calls(fetched, report):
+    """Add the provider call latencies of fetched batches to the report
+    and return the batches of fetched items."""
+    for items, calls in fetched:
+        report.add_provider_calls(calls)
+        yield items
+
+
+class _TimedProvider(object):
+    """A wrapper which records the latency of each provider call."""
+
+    def __init__(self, provider):
+        self._provider = provider
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._provider, name)
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                result = method(*args, **kwargs)
+                if name == 'get_records':
+                    # Include the time taken to produce the records.
+                    result = list(result)
+                return result
+            finally:
+                self.calls.append((name, time.time() - start))
+        return timed
+
+
+def _fetch_items(provider, identifiers, prefixes, since):
+    """Fetch the records of a batch of items in all formats.
+
+    This is run by the workers, so it must not touch the database.
+    Errors are returned instead of raised.
+
+    Return
+    ------
+    list of (unicode, bool, unicode or None, list):
+        (identifier, changed, error message, records) tuples for each
+        item. `changed` is `False` if the item has not changed since
+        `since`. The error message is set if checking the item failed.
+        The records are (prefix, XML, error message) tuples for each
+        prefix.
+    list of (str, float):
+        (method name, seconds) tuples for each provider call.
+    """
+    provider = _TimedProvider(provider)
+    items = []
     for identifier in identifiers:
         try:
-            if (since is not None and
-                    not provider.has_changed(identifier, since)):
-                log.debug('Skipping item "{0}"'.format(identifier))
-                continue
-            log.debug('Updating item "{0}"'.format(identifier))
+            changed = (since is None or
+                       provider.has_changed(identifier, since))
+        except Exception as e:
+            items.append((identifier, True, _error_message(e), []))
+        else:
+            items.append((identifier, bool(changed), None, []))
+
+    pending = [item for item in items if item[1] and item[2] is None]
+    if hasattr(provider, 'get_all_records'):
+        for identifier, _, _, records in pending:
+            records.extend(_get_all_records(provider, identifier, prefixes))
+        return items, provider.calls
+
+    for prefix in prefixes:
+        results = _get_records(provider, [item[0] for item in pending],
+                               prefix)
+        for (_, _, _, records), (xml, error) in zip(pending, results):
+            records.append((prefix, xml, error))
+    return items, provider.calls
+
+
+def _get_all_records(provider, identifier, prefixes):
+    """Disseminate the metadata of an item in all formats at once.
+
+    Return
+    ------
+    list of (unicode, str or None, unicode or None):
+        (prefix, XML, error message) tuples for each prefix.
+    """
+    try:
+        results = provider.get_all_records(identifier, prefixes)
+    except Exception as e:
+        error = _error_message(e)
+        return [(prefix, None, error) for prefix in prefixes]
+
+    records = []
+    for prefix in prefixes:
+        if prefix in results:
+            records.append((prefix, results[prefix], None))
+        else:
+            records.append((prefix, None, 'no record for the format'))
+    return records
+
+
+def _get_records(provider, identifiers, prefix):
+    """Disseminate the metadata of items in one format.
+
+    Use `get_records` if the provider has it, and fall back to
+    `get_record` for each item if that fails.
+
+    Return
+    ------
+    list of (str or None, unicode or None):
+        (XML, error message) tuples in the order of `identifiers`.
+    """
+    if identifiers and hasattr(provider, 'get_records'):
+        try:
+            records = list(provider.get_records(identifiers, prefix))
+            if len(records) != len(identifiers):
+                raise ValueError('expected {0} records, got {1}'.format(
+                    len(identifiers), len(records)))
+        except Exception as e:
+            logging.getLogger(__name__).warning(
+                'Failed to disseminate format "{0}" for a batch of items, '
+                'fetching them one at a time: {1}'.format(prefix, e))
+        else:
+            return [(xml, None) for xml in records]
+
+    results = []
+    for identifier in identifiers:
+        try:
+            results.append((provider.get_record(identifier, prefix), None))
+        except Exception as e:
+            results.append((None, _error_message(e)))
+    return results
+
+
+def _error_message(error):
+    """Format an exception and its traceback for logging."""
+    return '{0}\n{1}'.format(error, traceback.format_exc().rstrip())
+
+
+class _Committer(object):
+    """Commit the transaction after a number of records or seconds."""
+
+    def __init__(self, interval, timeout, dry_run, report):
+        self._interval = interval
+        self._timeout = timeout
+        self._dry_run = dry_run
+        self._report = report
+        self._pending = 0
+        self._dirty = False
+        self._started = time.time()
+
+    def item_written(self):
+        """Note that the sets of an item were written."""
+        self._dirty = True
+
+    def record_written(self):
+        """Count a written record and commit if the batch is full."""
+        self._pending += 1
+        self._dirty = True
+        timed_out = (self._timeout is not None and
+                     time.time() - self._started >= self._timeout)
+        if self._pending >= self._interval or timed_out:
+            self.commit()
+
+    def commit(self):
+        """Commit the written records and items, if any."""
+        if self._dirty:
+            with self._report.timed('db_write'):
+                if self._dry_run:
+                    models.rollback()
+                else:
+                    models.commit()
+            if not self._dry_run:
+                self._report.count('commits')
+            logging.getLogger(__name__).debug(
+                'Committed {0} record{1}.'.format(
+                    self._pending, '' if self._pending == 1 else 's'))
+        self._pending = 0
+        self._dirty = False
+        self._started = time.time()
+
+
+def _write_records(provider, fetched, committer, dry_run, journal, report):
+    """Write batches of fetched records to the database.
+
+    If `journal` is `True`, also record each changed or failed item as
+    processed.
+
+    Return
+    ------
+    int:
+        Number of updated records.
+    """
+    set_cache = SetCache()
+    updated = 0
+    for batch in fetched:
+        if not dry_run:
+            set_cache.load([identifier
+                            for identifier, changed, error, _ in batch
+                            if changed and error is None])
+        updated += _write_batch(provider, batch, committer, dry_run,
+                                journal, report, set_cache)
+    return updated
+
+
+def _count_written(report, xml):
+    """Count a record written to the database in the report."""
+    if xml is None:
+        report.count('records_deleted')
+    else:
+        report.count('records_updated')
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        report.count('bytes_written', len(xml))
+
+
+def _write_batch(provider, batch, committer, dry_run, journal, report,
+                 set_cache):
+    """Write the records of a batch of items to the database."""
+    log = logging.getLogger(__name__)
+
+    updated = 0
+    for identifier, changed, error, records in batch:
+        if error is None and not changed:
+            # Unchanged items are not journaled, so that skipping them
+            # does not write to the database.
+            log.debug('Skipping item "{0}"'.format(identifier))
+            report.count('items_unchanged')
+            continue
+        if journal:
+            models.ProcessedItem.create(identifier)
+            committer.item_written()
+        if error is not None:
+            log.error(
+                'Failed to update item "{0}": {1}'
+                ''.format(identifier, error))
+            report.count('items_failed')
+            continue
 
-            update_sets(provider, identifier, dry_run)
+        savepoint = None if dry_run else models.savepoint()
+        try:
+            log.debug('Updating item "{0}"'.format(identifier))
+            with report.timed('update_sets'):
+                update_sets(provider, identifier, dry_run, set_cache)
+            if savepoint is not None:
+                savepoint.commit()
+            committer.item_written()
         except Exception as e:
+            if savepoint is not None:
+                savepoint.rollback()
+                # The sets created for the item were rolled back too.
+                set_cache.clear()
             log.exception(
                 'Failed to update item "{0}": {1}'
                 ''.format(identifier, e))
+            report.count('items_failed')
             continue
+        report.count('items_changed')
 
-        for prefix in prefixes:
+        for prefix, xml, error in records:
+            if error is not None:
+                log.error(
+                    'Failed to disseminate format "{0}" '
+                    'for item "{1}": {2}'
+                    ''.format(prefix, identifier, error))
+                report.count('records_failed')
+                continue
+            savepoint = None if dry_run else models.savepoint()
             try:
-                xml = provider.get_record(identifier, prefix)
-                if xml is None:
-                    if not dry_run:
-                        models.Record.mark_as_deleted(identifier, prefix)
-                else:
-                    if not dry_run:
-                        models.Record.create_or_update(
-                            identifier, prefix, xml
-                        )
-                    updated += 1
+                with report.timed('db_write'):
+                    if xml is None:
+                        if not dry_run:
+                            models.Record.mark_as_deleted(identifier,
+                                                          prefix)
+                    else:
+                        if not dry_run:
+                            models.Record.create_or_update(
+                                identifier, prefix, xml
+                            )
+                        updated += 1
+                    if savepoint is not None:
+                        savepoint.commit()
             except Exception as e:
-                models.rollback()
+                if savepoint is not None:
+                    savepoint.rollback()
+                report.count('records_failed')
                 log.exception(
                     'Failed to disseminate format "{0}" '
                     'for item "{1}": {2}'
                     ''.format(prefix, identifier, e))
             else:
-                # Commit after each record so that the (esp. SQLite)
-                # database does not get locked for a long time.
-                if dry_run:
-                    models.rollback()
-                else:
-                    models.commit()
+                # A dry run writes nothing.
+                if not dry_run:
+                    _count_written(report, xml)
+                # Commit in batches so that the (esp. SQLite) database
+                # does not get locked for a long time.
+                committer.record_written()
                 log.debug('Processed item "{0}"'.format(identifier))
-
-    # End the transaction in case no records were updated.
-    models.rollback()
-
-    # TODO: log number of added records
-    log.info('Updated {0} record{1}.'
-             ''.format(updated, '' if updated == 1 else 's'))
+    return updated
@@ -0,0 +1,144 @@
+"""A minimal interface to the Linux inotify API."""
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+# Event masks from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+_IN_CLOEXEC = 0o2000000
+
+"""The fixed-size part of struct inotify_event."""
+_EVENT_HEADER = struct.Struct('iIII')
+
+"""Size of the read buffer. Must hold at least one event with a name of
+NAME_MAX bytes."""
+_BUFFER_SIZE = 64 * 1024
+
+"""An inotify event. `name` is the name of the file in the watched
+directory, or an empty string for events of the directory itself."""
+Event = collections.namedtuple('Event', ['wd', 'mask', 'cookie', 'name'])
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not available')
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def _check(result):
+    """Raise an OSError if a libc call failed."""
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+
+class Inotify(object):
+    """An inotify instance.
+
+    Raises
+    ------
+    OSError:
+        If inotify is not supported or the instance cannot be created.
+    """
+
+    def __init__(self):
+        self._libc = _load_libc()
+        self._fd = _check(self._libc.inotify_init1(_IN_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        """Watch a file or directory.
+
+        Return
+        ------
+        int:
+            The watch descriptor. Adding a watch for an already watched
+            path returns the same descriptor.
+        """
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return _check(self._libc.inotify_add_watch(self._fd, path, mask))
+
+    def rm_watch(self, wd):
+        """Stop watching. The watch is removed silently if the watched
+        file does not exist anymore."""
+        try:
+            _check(self._libc.inotify_rm_watch(self._fd, wd))
+        except OSError as error:
+            if error.errno != errno.EINVAL:
+                raise
+
+    def read_events(self, timeout=None):
+        """Wait for events.
+
+        Parameters
+        ----------
+        timeout: float or None
+            Seconds to wait for events, or `None` to wait indefinitely.
+
+        Return
+        ------
+        list of Event:
+            The pending events, or an empty list if none arrived in
+            time.
+        """
+        try:
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+        except select.error as error:
+            if error.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+        data = os.read(self._fd, _BUFFER_SIZE)
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data,
+                                                                 offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append(Event(wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        # Like files, close the descriptor when garbage collected.
+        if getattr(self, '_fd', None) is not None:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,42 @@
+import logging
+import os
+import sys
+
+import sqlalchemy as sa
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.scripts.common import parse_vars
+
+from ..config import clean_importer_settings
+from .. import models
+
+def usage(argv):
+    usage_string = '''Usage: {0} <config_uri> [var=value]...
+Upgrade the schema of an existing Kuha database, and store its
+identifiers compressed by the configured identifier_prefixes.
+
+Stop the OAI-PMH server and the metadata importer before migrating.
+
+See the sample configuration file for details.'''
+    cmd = os.path.basename(argv[0])
+    print(usage_string.format(cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+
+    settings = get_appsettings(config_uri, options=options)
+    clean_importer_settings(settings)
+
+    setup_logging(settings['logging_config'])
+    log = logging.getLogger(__name__)
+
+    engine = sa.engine_from_config(settings, 'sqlalchemy.')
+    log.info('Migrating the database...')
+    if models.migrate_schema(engine, settings['identifier_prefixes']):
+        log.info('Done.')
+    else:
+        log.info('The database is up to date.')
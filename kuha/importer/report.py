@@ -0,0 +1,143 @@
+import collections
+import contextlib
+from datetime import datetime
+import json
+import math
+import time
+
+from ..util import format_datestamp
+
+
+"""Stages of an import, in order. The other timings, such as `db_write`
+and `update_sets`, are parts of these stages."""
+STAGES = ('update_formats', 'update_items', 'update_records')
+
+"""Percentiles of the provider call latencies in the report."""
+PERCENTILES = (50, 90, 99)
+
+
+class ImportReport(object):
+    """Timings and counters of an import run.
+
+    The stages are timed with `timed`, and the other events are counted
+    with `count`. `as_dict` returns the machine-readable report, which
+    `write` saves as JSON. The error of a failed import is set as
+    `error`.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.error = None
+        self.timings = collections.defaultdict(float)
+        self.counters = collections.Counter()
+        self.provider_calls = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Add the wall time spent in the block to a timing."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.time() - start
+
+    def count(self, name, value=1):
+        """Increase a counter."""
+        self.counters[name] += value
+
+    def add_provider_calls(self, calls):
+        """Record the latencies of provider calls.
+
+        Parameters
+        ----------
+        calls: iterable of (str, float)
+            (method name, seconds) tuples.
+        """
+        for name, seconds in calls:
+            self.provider_calls[name].append(seconds)
+
+    def finish(self):
+        """Stop the wall clock of the import."""
+        self.finished = time.time()
+
+    def as_dict(self):
+        """Return the report as a JSON-serializable dict."""
+        finished = (self.finished if self.finished is not None
+                    else time.time())
+        records_time = self.timings['update_records']
+        updated = self.counters['records_updated']
+        return {
+            'started': format_datestamp(
+                datetime.utcfromtimestamp(self.started)),
+            'wall_seconds': finished - self.started,
+            'stages': dict((name, self.timings[name]) for name in STAGES),
+            'records_per_second': (updated / records_time
+                                   if records_time > 0 else None),
+            'db_write_seconds': self.timings['db_write'],
+            'update_sets_seconds': self.timings['update_sets'],
+            'provider_calls': dict(
+                (name, _latencies(seconds))
+                for name, seconds in self.provider_calls.iteritems()
+            ),
+            'counters': dict(self.counters),
+            'error': self.error,
+        }
+
+    def write(self, path):
+        """Write the report to a JSON file."""
+        with open(path, 'w') as file_:
+            json.dump(self.as_dict(), file_, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            file_.write('\n')
+
+    def log_summary(self, log):
+        """Log a summary of the report."""
+        report = self.as_dict()
+        log.info(
+            'Import took {0:.1f} s ({1}).'.format(
+                report['wall_seconds'],
+                ', '.join('{0} {1:.1f} s'.format(name, report['stages'][name])
+                          for name in STAGES)
+            )
+        )
+        counters = self.counters
+        log.info(
+            'Items: {0} changed, {1} unchanged, {2} failed. '
+            'Records: {3} updated, {4} deleted, {5} failed, '
+            '{6} bytes written in {7} commits.'.format(
+                counters['items_changed'], counters['items_unchanged'],
+                counters['items_failed'], counters['records_updated'],
+                counters['records_deleted'], counters['records_failed'],
+                counters['bytes_written'], counters['commits'])
+        )
+        if report['records_per_second'] is not None:
+            log.info('{0:.1f} records/s, {1:.1f} s writing to the '
+                     'database, {2:.1f} s updating sets.'.format(
+                         report['records_per_second'],
+                         report['db_write_seconds'],
+                         report['update_sets_seconds']))
+        for name, latencies in sorted(report['provider_calls'].iteritems()):
+            log.info(
+                'Provider {0}: {1} calls, {2}, max {3:.4f} s.'.format(
+                    name, latencies['count'],
+                    ', '.join('p{0} {1:.4f} s'.format(
+                        p, latencies['p{0}'.format(p)])
+                        for p in PERCENTILES),
+                    latencies['max'])
+            )
+
+
+def _latencies(seconds):
+    """Summarize latencies with percentiles."""
+    ordered = sorted(seconds)
+    result = {
+        'count': len(ordered),
+        'total': sum(ordered),
+        'max': ordered[-1],
+    }
+    for p in PERCENTILES:
+        # The nearest-rank method.
+        rank = int(math.ceil(p / 100.0 * len(ordered)))
+        result['p{0}'.format(p)] = ordered[max(rank, 1) - 1]
+    return result
@@ -0,0 +1,114 @@
+"""Full imports into a staging database which replaces the live one."""
+import errno
+import logging
+import os
+
+from sqlalchemy.engine.url import make_url
+
+from .. import models
+from ..exception import ConfigurationError, HarvestError
+
+"""Suffix added to the path of the live database for the staging
+database. The staging database must be in the same directory for the
+rename to be atomic."""
+STAGING_SUFFIX = '.staging'
+
+
+def staging_settings(settings, resume=False):
+    """Return the settings for building the staging database.
+
+    A staging database left behind by an earlier import is removed,
+    unless `resume` is `True`.
+
+    Parameters
+    ----------
+    settings: dict
+        The importer settings.
+    resume: bool
+        If `True`, keep an existing staging database, so that an
+        interrupted import into it can be resumed.
+
+    Return
+    ------
+    (dict, str, str):
+        The settings with the URL of the staging database, the path of
+        the staging database and the path of the live database.
+
+    Raises
+    ------
+    ConfigurationError:
+        If the database is not an SQLite database file.
+    """
+    url = make_url(settings['sqlalchemy.url'])
+    if (url.get_backend_name() != 'sqlite' or not url.database or
+            url.database == ':memory:'):
+        raise ConfigurationError(
+            'shadow builds require an SQLite database file')
+    path = url.database
+    staging = path + STAGING_SUFFIX
+    if not resume:
+        for stale in [staging, staging + '-journal']:
+            try:
+                os.remove(stale)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+    url.database = staging
+    settings = dict(settings)
+    settings['sqlalchemy.url'] = str(url)
+    return settings, staging, path
+
+
+def install(staging, path, keep_deleted=True):
+    """Check the staging database and rename it over the live database.
+
+    The history of the records is first copied from the live database,
+    see `models.copy_history`. The staging database must be bound to
+    the session, and it is disposed of.
+
+    Parameters
+    ----------
+    staging: str
+        Path of the staging database.
+    path: str
+        Path of the live database.
+    keep_deleted: bool
+        If `True`, keep the items and records which are missing from the
+        staging database as deleted.
+
+    Raises
+    ------
+    HarvestError:
+        If the staging database is corrupt.
+    """
+    log = logging.getLogger(__name__)
+
+    if os.path.exists(path):
+        log.debug('Copying record history from {0}...'.format(path))
+        models.copy_history(path, keep_deleted)
+
+    log.debug('Checking the staging database...')
+    problems = models.check_integrity()
+    engine = models.DBSession.get_bind()
+    models.DBSession.remove()
+    engine.dispose()
+    if problems:
+        raise HarvestError('staging database {0} is corrupt: {1}'.format(
+            staging, '; '.join(problems[:10])))
+
+    # The database was written without syncing, so make sure that it is
+    # on disk before it replaces the live database.
+    _fsync(staging)
+    os.rename(staging, path)
+    _fsync(os.path.dirname(os.path.abspath(path)))
+    log.info('Replaced the database {0}.'.format(path))
+
+
+def _fsync(path):
+    """Flush a file or directory to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -1,6 +1,10 @@
 class SkeletonProvider(object):
     """
     A skeleton of a metadata provider.
+
+    Providers may also implement the optional methods
+    `sorted_identifiers`, `changed_since`, `get_records` and
+    `get_all_records`. See `kuha.importer.harvest.update` for details.
     """
 
     def __init__(self, *args):
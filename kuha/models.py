@@ -1,4 +1,7 @@
+import bisect
+import collections
 import logging
+import os
 import re
 
 from lxml import etree
@@ -6,8 +9,9 @@ import sqlalchemy as sa
 import sqlalchemy.orm as orm
 from sqlalchemy.ext.declarative import declarative_base
 import transaction
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
 
+from .exception import ConfigurationError
 from .util import datestamp_now
 
 _Base = declarative_base()
@@ -15,6 +19,108 @@ DBSession = orm.scoped_session(orm.sessionmaker(
     extension=ZopeTransactionExtension()
 ))
 
+"""Key of the pending datestamp in the session info, see
+`Datestamp.update`."""
+_PENDING_DATESTAMP = 'kuha.pending_datestamp'
+
+"""Number of items, records or formats deleted at a time by
+`purge_deleted`."""
+PURGE_BATCH_SIZE = 1000
+
+"""Number of values in the IN clauses of bulk updates. SQLite limits the
+number of parameters in a statement."""
+_IN_BATCH_SIZE = 500
+
+"""Collations which order strings by their code points, like Python
+compares them. Used when the order must match Python's order."""
+_BINARY_COLLATIONS = {
+    'sqlite': 'BINARY',
+    'postgresql': 'C',
+}
+
+"""Code of the first class of stored identifiers, see
+`_IdentifierCodec`. The codes are control characters, which do not
+occur in URIs."""
+_FIRST_CODE = 0x01
+
+"""Maximum number of identifier prefixes, so that the codes stay below
+the space character."""
+MAX_IDENTIFIER_PREFIXES = 15
+
+
+class _IdentifierCodec(object):
+    """Order-preserving compression of identifiers by their prefixes.
+
+    An identifier starting with one of the prefixes is stored as the
+    code of the prefix followed by the rest of the identifier. Other
+    identifiers are stored whole after the code of the range between
+    the prefixes that they sort in. The stored strings therefore sort
+    like the identifiers, so the identifiers can be compared and ordered
+    in the database. Without prefixes, identifiers are stored as they
+    are.
+
+    Parameters
+    ----------
+    prefixes: iterable of unicode
+        The prefixes. No prefix may start with another.
+
+    Raises
+    ------
+    ValueError:
+        If the prefixes overlap or there are too many of them.
+    """
+
+    def __init__(self, prefixes=()):
+        self.prefixes = sorted(set(prefixes))
+        if len(self.prefixes) > MAX_IDENTIFIER_PREFIXES:
+            raise ValueError('too many identifier prefixes')
+        for first, second in zip(self.prefixes, self.prefixes[1:]):
+            # Sorting puts a prefix right before the prefixes that
+            # start with it.
+            if not first or second.startswith(first):
+                raise ValueError(
+                    u'overlapping identifier prefixes: "{0}" and "{1}"'
+                    u''.format(first, second))
+
+    def encode(self, identifier):
+        if not self.prefixes:
+            return identifier
+        # An identifier can only start with the greatest prefix which
+        # is not greater than it.
+        index = bisect.bisect_right(self.prefixes, identifier)
+        if index > 0 and identifier.startswith(self.prefixes[index - 1]):
+            return (unichr(_FIRST_CODE + 2 * index - 1) +
+                    identifier[len(self.prefixes[index - 1]):])
+        return unichr(_FIRST_CODE + 2 * index) + identifier
+
+    def decode(self, stored):
+        if not self.prefixes:
+            return stored
+        code = ord(stored[0]) - _FIRST_CODE
+        if code % 2 == 1:
+            return self.prefixes[code // 2] + stored[1:]
+        return stored[1:]
+
+
+"""The codec of the identifier prefixes of the connected database, set
+by `create_engine` and reloaded when the stored prefixes change."""
+_identifier_codec = _IdentifierCodec()
+
+
+class _Identifier(sa.types.TypeDecorator):
+    """A column of identifiers compressed by their prefixes."""
+    impl = sa.String
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return _identifier_codec.encode(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return _identifier_codec.decode(value)
+
 
 class _CreateMixin(object):
 
@@ -26,12 +132,332 @@ class _CreateMixin(object):
         return obj
 
 
-def create_engine(settings):
-    """Connect to the database."""
+def create_engine(settings, bulk_load=False, identifier_prefixes=None,
+                  savepoints=False):
+    """Connect to the database.
+
+    Parameters
+    ----------
+    settings: dict
+        The settings with the ``sqlalchemy.`` prefix are used.
+    bulk_load: bool
+        If `True`, trade durability for write speed. Only use this for
+        SQLite databases which are checked and synced to disk before use.
+    identifier_prefixes: list of unicode or None
+        The prefixes of the identifiers to compress, or `None` to use the
+        prefixes of the database. The prefixes are stored in a database
+        without items.
+    savepoints: bool
+        If `True`, make `savepoint` work with SQLite. Every transaction
+        then begins explicitly and holds a lock on the database until it
+        ends, so only use this for writers.
+
+    Raises
+    ------
+    ConfigurationError:
+        If the database must be migrated first.
+    """
     engine = sa.engine_from_config(settings, 'sqlalchemy.')
+    if engine.dialect.name == 'sqlite':
+        if savepoints:
+            _enable_sqlite_savepoints(engine)
+        _reconnect_when_replaced(engine)
+        if bulk_load:
+            _disable_sqlite_sync(engine)
+    if _outdated_tables(engine):
+        raise ConfigurationError(
+            'the database schema is outdated, run kuha_migrate')
     DBSession.configure(bind=engine)
     _Base.metadata.bind = engine
     _Base.metadata.create_all(engine)
+    _load_identifier_prefixes(engine, identifier_prefixes)
+    _reload_identifier_prefixes(engine)
+
+
+def _load_identifier_prefixes(engine, configured=None):
+    """Compress identifiers with the prefixes of the database."""
+    global _identifier_codec
+    with engine.begin() as connection:
+        stored = _stored_prefixes(connection)
+        if configured is not None and sorted(set(configured)) != stored:
+            has_items = connection.execute(
+                sa.select([Item.__table__.c.id]).limit(1)).first()
+            if has_items is not None:
+                raise ConfigurationError(
+                    'the identifier prefixes have changed, run kuha_migrate')
+            _store_prefixes(connection, configured)
+            stored = sorted(set(configured))
+    _identifier_codec = _IdentifierCodec(stored)
+
+
+def _reload_identifier_prefixes(engine):
+    """Reload the identifier prefixes whenever a connection is taken
+    from the pool.
+
+    The stored prefixes change when a shadow build replaces the database
+    file, or when `kuha_migrate` recompresses the identifiers of the
+    database. The prefix table is small, so reading it for every
+    transaction is cheap.
+    """
+    @sa.event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        global _identifier_codec
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT prefix FROM {0}'.format(
+                identifier_prefix_table.name))
+            stored = sorted(prefix for (prefix,) in cursor.fetchall())
+        finally:
+            cursor.close()
+        # End the transaction that some drivers begin for the query.
+        dbapi_connection.rollback()
+        if stored != _identifier_codec.prefixes:
+            _identifier_codec = _IdentifierCodec(stored)
+
+
+def _stored_prefixes(connection):
+    return sorted(prefix for (prefix,) in connection.execute(
+        sa.select([identifier_prefix_table.c.prefix])))
+
+
+def _store_prefixes(connection, prefixes):
+    connection.execute(identifier_prefix_table.delete())
+    if prefixes:
+        connection.execute(identifier_prefix_table.insert(),
+                           [{'prefix': prefix} for prefix in set(prefixes)])
+
+
+def _outdated_tables(connectable):
+    """Return the names of the tables which lack columns of the current
+    schema."""
+    inspector = sa.inspect(connectable)
+    names = inspector.get_table_names()
+    return [table.name
+            for table in [Item.__table__, Set.__table__, Datestamp.__table__]
+            if table.name in names and
+            set(table.c.keys()) - _column_names(inspector, table.name)]
+
+
+def _column_names(inspector, table_name):
+    return set(c['name'] for c in inspector.get_columns(table_name))
+
+
+def migrate_schema(engine, identifier_prefixes=None):
+    """Upgrade the schema of an existing database.
+
+    Parameters
+    ----------
+    engine: sqlalchemy.engine.Engine
+        The database to migrate.
+    identifier_prefixes: list of unicode or None
+        If not `None`, store the identifiers compressed by these
+        prefixes instead of the prefixes of the database.
+
+    Return
+    ------
+    bool:
+        `True` if the database was migrated, `False` if it already had
+        the current schema and identifier prefixes.
+    """
+    migrated = False
+    if _outdated_tables(engine):
+        inspector = sa.inspect(engine)
+        if any('id' not in _column_names(inspector, name)
+               for name in ['items', 'sets']):
+            _add_integer_keys(engine)
+        _add_leaf_set_specs(engine)
+        _add_datestamp_generation(engine)
+        migrated = True
+    identifier_prefix_table.create(engine, checkfirst=True)
+    if identifier_prefixes is not None:
+        migrated = (_recode_identifiers(engine, identifier_prefixes) or
+                    migrated)
+    return migrated
+
+
+def _add_integer_keys(engine):
+    """Add the integer keys of items and sets.
+
+    The items, sets and set memberships are copied to new tables, which
+    replace the old ones in a single transaction. Other tables are not
+    changed. The new set memberships refer to the integer keys of the
+    items and sets before the new tables are renamed, which SQLite
+    allows.
+    """
+    metadata = sa.MetaData()
+    # The targets of the foreign keys, which are not created.
+    for table in [Item.__table__, Set.__table__]:
+        table.tometadata(metadata)
+    old_tables = [item_set_association.name, Set.__tablename__,
+                  Item.__tablename__]
+    copies = dict(
+        (table.name, table.tometadata(metadata,
+                                      name=table.name + '_migrated'))
+        for table in [Item.__table__, Set.__table__, item_set_association]
+    )
+    items, sets, memberships = (
+        copies[name] for name in reversed(old_tables))
+    with engine.begin() as connection:
+        old = sa.MetaData()
+        old.reflect(connection, only=old_tables)
+        old_items, old_sets, old_memberships = (
+            old.tables[name] for name in reversed(old_tables))
+        for table in copies.values():
+            table.create(connection)
+        # Copy in the order of the strings, so that the integer keys
+        # are in the same order.
+        connection.execute(items.insert().from_select(
+            ['identifier', 'deleted'],
+            sa.select([old_items.c.identifier, old_items.c.deleted])
+              .order_by(old_items.c.identifier)))
+        connection.execute(sets.insert().from_select(
+            ['spec', 'name'],
+            sa.select([old_sets.c.spec, old_sets.c.name])
+              .order_by(old_sets.c.spec)))
+        connection.execute(memberships.insert().from_select(
+            ['item_id', 'set_id'],
+            sa.select([items.c.id, sets.c.id])
+              .where(items.c.identifier ==
+                     old_memberships.c.item_identifier)
+              .where(sets.c.spec == old_memberships.c.set_spec)
+              .distinct()))
+        for name in old_tables:
+            connection.execute('DROP TABLE {0}'.format(name))
+        for name in reversed(old_tables):
+            connection.execute('ALTER TABLE {0} RENAME TO {1}'.format(
+                copies[name].name, name))
+
+
+def _add_leaf_set_specs(engine):
+    """Add the leaf set specs of the items, see `Item.update_memberships`.
+    """
+    items = Item.__table__
+    sets = Set.__table__
+    table = item_set_association
+    with engine.begin() as connection:
+        if 'leaf_set_specs' not in _column_names(sa.inspect(connection),
+                                                 items.name):
+            connection.execute(
+                "ALTER TABLE items "
+                "ADD COLUMN leaf_set_specs TEXT NOT NULL DEFAULT ''")
+        specs = collections.defaultdict(set)
+        for item_id, spec in connection.execute(
+                sa.select([table.c.item_id, sets.c.spec])
+                  .select_from(table.join(sets))):
+            specs[item_id].add(spec)
+        if specs:
+            connection.execute(
+                items.update()
+                     .where(items.c.id == sa.bindparam('item_id'))
+                     .values(leaf_set_specs=sa.bindparam('leaf_specs')),
+                [{'item_id': item_id,
+                  'leaf_specs': _join_specs(leaf_set_specs(item_specs))}
+                 for item_id, item_specs in specs.iteritems()]
+            )
+
+
+def _add_datestamp_generation(engine):
+    """Add the modification counter of the datestamp, see
+    `Datestamp.get_version`."""
+    name = Datestamp.__tablename__
+    with engine.begin() as connection:
+        inspector = sa.inspect(connection)
+        if (name in inspector.get_table_names() and
+                'generation' not in _column_names(inspector, name)):
+            connection.execute(
+                "ALTER TABLE datestamp "
+                "ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+
+
+def _recode_identifiers(engine, prefixes):
+    """Store the identifiers compressed by other prefixes.
+
+    Return
+    ------
+    bool:
+        `False` if the database already used the prefixes.
+    """
+    global _identifier_codec
+    new = _IdentifierCodec(prefixes)
+    with engine.begin() as connection:
+        old = _IdentifierCodec(_stored_prefixes(connection))
+        if old.prefixes == new.prefixes:
+            return False
+        # Mark the stored identifiers first, so that the recoded ones
+        # cannot collide with those not recoded yet. DEL does not occur
+        # in URIs either.
+        mark = u'\x7f'
+        for table in ['items', 'records']:
+            connection.execute(
+                sa.text('UPDATE {0} SET identifier = :mark || identifier'
+                        ''.format(table)), mark=mark)
+            stored = [value for (value,) in connection.execute(
+                'SELECT DISTINCT identifier FROM {0}'.format(table))]
+            if stored:
+                connection.execute(
+                    sa.text('UPDATE {0} SET identifier = :new '
+                            'WHERE identifier = :old'.format(table)),
+                    [{'old': value,
+                      'new': new.encode(old.decode(value[len(mark):]))}
+                     for value in stored]
+                )
+        _store_prefixes(connection, new.prefixes)
+    _identifier_codec = new
+    return True
+
+
+def _enable_sqlite_savepoints(engine):
+    """Make savepoints work with pysqlite.
+
+    The pysqlite driver begins transactions implicitly and only before
+    data modifying statements, which breaks SAVEPOINT. Disable that and
+    begin the transactions explicitly instead.
+    """
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @sa.event.listens_for(engine, 'begin')
+    def on_begin(connection):
+        connection.execute('BEGIN')
+
+
+def _reconnect_when_replaced(engine):
+    """Reconnect to an SQLite database file that has been replaced.
+
+    Pooled connections keep using the file they were opened with, even
+    after another file has been renamed over it by a shadow build of the
+    importer. The inode of the file is therefore compared whenever a
+    connection is taken from the pool.
+    """
+    path = engine.url.database
+    if not path or path == ':memory:':
+        return
+
+    def inode():
+        try:
+            return os.stat(path).st_ino
+        except OSError:
+            return None
+
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['inode'] = inode()
+
+    @sa.event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get('inode') != inode():
+            # The pool discards the connection and opens a new one.
+            raise sa.exc.DisconnectionError('database file replaced')
+
+
+def _disable_sqlite_sync(engine):
+    """Keep the rollback journal in memory and do not wait for writes
+    to reach the disk."""
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.execute('PRAGMA synchronous = OFF')
+        dbapi_connection.execute('PRAGMA journal_mode = MEMORY')
 
 
 def ensure_oai_dc_exists():
@@ -43,15 +469,85 @@ def ensure_oai_dc_exists():
         commit()
 
 
-def purge_deleted():
-    """Remove items, records and formats marked as deleted."""
+def purge_deleted(batch_size=PURGE_BATCH_SIZE, after_batch=None):
+    """Remove items, records and formats marked as deleted.
+
+    The rows are deleted in batches by primary key, together with the
+    set memberships of the items. The purged objects are removed from
+    the session.
+
+    Parameters
+    ----------
+    batch_size: int
+        Number of items, records or formats to delete at a time. The
+        records are deleted in batches of item identifiers.
+    after_batch: callable or None
+        Called without arguments after each batch, for example `commit`
+        to release the database between batches.
+
+    Return
+    ------
+    int:
+        The number of purged rows, not including set memberships.
+    """
+    DBSession.flush()
+    memberships = item_set_association
+    batches = [
+        (Record.identifier, [Record]),
+        (Format.prefix, [Format]),
+        (Item.identifier, [memberships, Item]),
+    ]
     purged = 0
-    for Class in [Record, Format, Item]:
-        purged += (DBSession.query(Class)
-                            .filter(Class.deleted.is_(True))
-                            .delete(synchronize_session='fetch'))
-    if purged > 0:
-        Datestamp.update()
+    for key, tables in batches:
+        deleted = tables[-1].deleted.is_(True)
+        while True:
+            keys = [value for (value,) in DBSession.execute(
+                sa.select([key]).where(deleted).distinct()
+                                .order_by(key).limit(batch_size)
+            )]
+            if not keys:
+                break
+            for table in tables:
+                if table is memberships:
+                    DBSession.execute(table.delete().where(
+                        table.c.item_id.in_(
+                            sa.select([Item.id])
+                              .where(Item.identifier.in_(keys)))))
+                else:
+                    purged += DBSession.execute(
+                        table.__table__.delete()
+                             .where(deleted).where(key.in_(keys))
+                    ).rowcount
+            mark_changed(DBSession())
+            Datestamp.update()
+            if after_batch is not None:
+                after_batch()
+
+    # The rows were deleted without synchronizing the session.
+    for obj in list(DBSession.identity_map.values()):
+        if isinstance(obj, (Record, Format, Item)) and obj.deleted:
+            DBSession.expunge(obj)
+    return purged
+
+
+def optimize(vacuum=False):
+    """Update the statistics of the query planner.
+
+    Must be called outside of transactions.
+
+    Parameters
+    ----------
+    vacuum: bool
+        If `True`, also rebuild the database to reclaim the space of
+        deleted rows. The database is locked while it is rebuilt.
+    """
+    engine = DBSession.get_bind()
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        if vacuum:
+            connection.execute('VACUUM')
+        connection.execute('ANALYZE')
 
 
 def commit():
@@ -64,26 +560,196 @@ def rollback():
     transaction.abort()
 
 
+def savepoint():
+    """Set a savepoint in the ongoing database transaction.
+
+    The savepoint is set directly in the SQLAlchemy session, since the
+    transaction package does not support savepoints with SQLite.
+
+    Return
+    ------
+    object:
+        The savepoint. Call its ``commit()`` method to release it, or its
+        ``rollback()`` method to undo the changes made after the savepoint
+        without ending the transaction.
+    """
+    return DBSession.begin_nested()
+
+
+def copy_history(path, keep_deleted=True):
+    """Copy the history of the records from an older SQLite database.
+
+    Used after importing everything into an empty database, so that the
+    result is the same as if the older database had been updated:
+
+    - Records with the same XML keep their datestamps.
+    - If `keep_deleted` is `True`, the formats, items and records which
+      are missing from this database are added as deleted. Records that
+      were not deleted before get the current time as their datestamp.
+      The added items keep their set memberships, and the sets missing
+      from this database are added for them.
+    - The database datestamp is kept, so that resumption tokens do not
+      expire, if no record has changed. The modification counter of the
+      datestamp continues from the older database, so that the version
+      of the database changes anyway.
+
+    The transaction must not be open, since SQLite cannot attach a
+    database inside a transaction.
+
+    Parameters
+    ----------
+    path: str
+        Path of the older database.
+    keep_deleted: bool
+        If `False`, only copy the datestamps.
+
+    Raises
+    ------
+    ConfigurationError:
+        If the older database compresses identifiers with other
+        prefixes.
+    """
+    now = sa.bindparam('now', datestamp_now(), type_=sa.DateTime)
+    same_record = '''
+        FROM old.records AS o
+        WHERE o.identifier = records.identifier
+          AND o.prefix = records.prefix
+          AND o.deleted = 0
+          AND o.xml = records.xml
+    '''
+    statements = [
+        sa.text('UPDATE records SET datestamp = (SELECT o.datestamp {0}) '
+                'WHERE records.deleted = 0 AND EXISTS (SELECT 1 {0})'
+                ''.format(same_record)),
+    ]
+    if keep_deleted:
+        statements.extend([
+            sa.text('''INSERT INTO formats (prefix, namespace, schema, deleted)
+               SELECT prefix, namespace, schema, 1 FROM old.formats
+               WHERE prefix NOT IN (SELECT prefix FROM formats)'''),
+            # The sets are needed before the items are added.
+            sa.text('''INSERT INTO sets (spec, name)
+               SELECT s.spec, s.name FROM old.sets AS s
+               WHERE s.spec NOT IN (SELECT spec FROM sets)
+                 AND s.id IN (
+                     SELECT a.set_id
+                     FROM old.item_set_association AS a
+                     JOIN old.items AS i ON i.id = a.item_id
+                     WHERE i.identifier NOT IN (
+                         SELECT identifier FROM items))'''),
+            sa.text('''INSERT INTO items (identifier, deleted, leaf_set_specs)
+               SELECT identifier, 1, leaf_set_specs FROM old.items
+               WHERE identifier NOT IN (SELECT identifier FROM items)'''),
+            # Deleted items without memberships include the added ones.
+            sa.text('''INSERT INTO item_set_association (item_id, set_id)
+               SELECT items.id, sets.id
+               FROM old.item_set_association AS a
+               JOIN old.items AS oi ON oi.id = a.item_id
+               JOIN old.sets AS os ON os.id = a.set_id
+               JOIN items ON items.identifier = oi.identifier
+               JOIN sets ON sets.spec = os.spec
+               WHERE items.deleted = 1
+                 AND NOT EXISTS (
+                     SELECT 1 FROM item_set_association
+                     WHERE item_set_association.item_id = items.id)'''),
+            sa.text('''INSERT INTO records (identifier, prefix, datestamp, xml,
+                                   deleted)
+               SELECT identifier, prefix,
+                      CASE WHEN deleted THEN datestamp ELSE :now END,
+                      xml, 1
+               FROM old.records AS o
+               WHERE NOT EXISTS (
+                   SELECT 1 FROM records
+                   WHERE records.identifier = o.identifier
+                     AND records.prefix = o.prefix)''').bindparams(now),
+        ])
+    # The records added or removed since the old datestamp change the
+    # datestamps or the number of records.
+    statements.append(sa.text('''
+        UPDATE datestamp SET datestamp = (
+            SELECT max(datestamp) FROM old.datestamp)
+        WHERE (SELECT max(datestamp) FROM old.datestamp) IS NOT NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM records
+              WHERE datestamp > (SELECT max(datestamp) FROM old.datestamp))
+          AND (SELECT count(*) FROM records) =
+              (SELECT count(*) FROM old.records)'''))
+    statements.append(sa.text('''
+        UPDATE datestamp SET generation = generation + 1 + (
+            SELECT coalesce(max(generation), 0) FROM old.datestamp)'''))
+
+    connection = DBSession.get_bind().connect()
+    try:
+        connection.execute(sa.text('ATTACH DATABASE :path AS old'),
+                           path=path)
+        try:
+            # The identifiers are compared as stored.
+            tables = [name for (name,) in connection.execute(
+                "SELECT name FROM old.sqlite_master WHERE type = 'table'")]
+            old_prefixes = sorted(
+                prefix for (prefix,) in connection.execute(
+                    'SELECT prefix FROM old.identifier_prefixes')
+            ) if identifier_prefix_table.name in tables else []
+            if old_prefixes != _identifier_codec.prefixes:
+                raise ConfigurationError(
+                    'the identifier prefixes of {0} differ, run '
+                    'kuha_migrate'.format(path))
+            with connection.begin():
+                for statement in statements:
+                    connection.execute(statement)
+        finally:
+            connection.execute('DETACH DATABASE old')
+    finally:
+        connection.close()
+
+
+def check_integrity():
+    """Check the integrity of an SQLite database.
+
+    Return
+    ------
+    list of unicode:
+        The problems found, or an empty list if the database is intact.
+    """
+    rows = DBSession.execute('PRAGMA integrity_check').fetchall()
+    messages = [message for (message,) in rows]
+    return [] if messages == ['ok'] else messages
+
+
+"""The prefixes of the stored identifiers, see `_IdentifierCodec`."""
+identifier_prefix_table = sa.Table(
+    'identifier_prefixes',
+    _Base.metadata,
+    sa.Column('prefix', sa.String, primary_key=True),
+)
+
+
 item_set_association = sa.Table(
     'item_set_association',
     _Base.metadata,
     sa.Column(
-        'set_spec',
-        sa.String,
-        sa.ForeignKey('sets.spec')
+        'item_id',
+        sa.Integer,
+        sa.ForeignKey('items.id'),
+        primary_key=True
     ),
     sa.Column(
-        'item_identifier',
-        sa.String,
-        sa.ForeignKey('items.identifier')
+        'set_id',
+        sa.Integer,
+        sa.ForeignKey('sets.id'),
+        primary_key=True
     ),
+    # For listing the records of a set.
+    sa.Index('ix_item_set_association_set_id', 'set_id'),
 )
 
 
 class Set(_Base, _CreateMixin):
     """The SQLAlchemy model class for an OAI set."""
     __tablename__ = 'sets'
-    spec = sa.Column(sa.String, primary_key=True)
+    # The set memberships are joined on the integer key.
+    id = sa.Column(sa.Integer, primary_key=True)
+    spec = sa.Column(sa.String, unique=True, nullable=False)
     name = sa.Column(sa.String, nullable=False)
 
     # the pattern of valid set specs from the OAI-PMH XML schema
@@ -126,6 +792,7 @@ class Set(_Base, _CreateMixin):
 class Format(_Base, _CreateMixin):
     """The SQLAlchemy model class for an OAI metadata format."""
     __tablename__ = 'formats'
+    # The records refer to the formats by prefix, see `Record`.
     prefix = sa.Column(sa.String, primary_key=True)
     namespace = sa.Column(sa.String, nullable=False)
     schema = sa.Column(sa.String, nullable=False)
@@ -244,12 +911,57 @@ class Format(_Base, _CreateMixin):
         Record.mark_as_deleted(prefix=self.prefix)
         self.deleted = True
 
+    @classmethod
+    def mark_many_as_deleted(cls, prefixes):
+        """Mark formats and their records as deleted.
+
+        Unlike `mark_as_deleted`, this does not update Format and Record
+        objects already loaded in the session.
+        """
+        _mark_many_as_deleted(cls.prefix, Record.prefix, prefixes)
+
+
+def leaf_set_specs(specs):
+    """Exclude the parent sets of other sets from set specs.
+
+    Parameters
+    ----------
+    specs: iterable of unicode
+        Set specs.
+
+    Return
+    ------
+    list of unicode:
+        The specs of the sets which are not parent sets of any other set
+        in `specs`, sorted.
+    """
+    specs = set(specs)
+    parents = set()
+    for spec in specs:
+        i = spec.find(u':')
+        while i != -1:
+            parents.add(spec[:i])
+            i = spec.find(u':', i + 1)
+    return sorted(specs - parents)
+
+
+def _join_specs(specs):
+    # Set specs cannot contain spaces.
+    return u' '.join(specs)
+
 
 class Item(_Base, _CreateMixin):
     """The SQLAlchemy model class for an OAI item."""
     __tablename__ = 'items'
-    identifier = sa.Column(sa.String, primary_key=True)
+    # The set memberships are joined on the integer key. The records
+    # refer to the identifier, which they are listed in the order of.
+    id = sa.Column(sa.Integer, primary_key=True)
+    identifier = sa.Column(_Identifier, unique=True, nullable=False)
     deleted = sa.Column(sa.Boolean, nullable=False)
+    # The space-separated specs of the sets which contain the item and
+    # none of its subsets, so that listing records needs no set queries.
+    _leaf_set_specs = sa.Column('leaf_set_specs', sa.Text, nullable=False,
+                                default=u'', server_default=u'')
 
     sets = orm.relationship('Set', secondary=item_set_association)
 
@@ -259,9 +971,86 @@ class Item(_Base, _CreateMixin):
 
     def clear_sets(self):
         self.sets = []
+        self._leaf_set_specs = u''
 
     def add_to_set(self, set_):
-        self.sets.append(set_)
+        if set_ not in self.sets:
+            self.sets.append(set_)
+            self._leaf_set_specs = _join_specs(
+                leaf_set_specs(s.spec for s in self.sets))
+
+    @classmethod
+    def set_memberships(cls, identifiers):
+        """Fetch the specs of the sets which contain the given items.
+
+        Return
+        ------
+        dict from unicode to set of unicode:
+            Mapping from the identifiers to the set specs. Items which
+            are not in any set are mapped to empty sets.
+        """
+        memberships = dict((identifier, set()) for identifier in identifiers)
+        if identifiers:
+            rows = (DBSession.query(cls.identifier, Set.spec)
+                             .join(cls.sets)
+                             .filter(cls.identifier.in_(list(identifiers))))
+            for identifier, spec in rows:
+                memberships[identifier].add(spec)
+        return memberships
+
+    @classmethod
+    def update_memberships(cls, identifier, added, removed, leaf_specs):
+        """Add an item to sets and remove it from other sets.
+
+        Unlike `add_to_set` and `clear_sets`, this only writes the
+        changed rows of the association table, and does not update Item
+        objects already loaded in the session.
+
+        Parameters
+        ----------
+        identifier: unicode
+            The identifier of the item.
+        added: collection of unicode
+            Specs of the sets to add the item to. The sets must exist.
+        removed: collection of unicode
+            Specs of the sets to remove the item from.
+        leaf_specs: list of unicode
+            The specs of all sets of the item after the update, without
+            parent sets, see `leaf_set_specs`. Stored for
+            `Record.set_specs` if the sets have changed.
+        """
+        if not added and not removed:
+            return
+        # Insert the new sets first.
+        DBSession.flush()
+        table = item_set_association
+        item_id = (sa.select([cls.id])
+                     .where(cls.identifier == identifier)
+                     .as_scalar())
+        if removed:
+            DBSession.execute(
+                table.delete()
+                     .where(table.c.item_id == item_id)
+                     .where(table.c.set_id.in_(
+                         sa.select([Set.id])
+                           .where(Set.spec.in_(sorted(removed)))))
+            )
+        if added:
+            DBSession.execute(
+                table.insert().from_select(
+                    ['item_id', 'set_id'],
+                    sa.select([item_id, Set.id])
+                      .where(Set.spec.in_(sorted(added)))
+                )
+            )
+        DBSession.execute(
+            cls.__table__.update()
+               .where(cls.identifier == identifier)
+               .values(leaf_set_specs=_join_specs(leaf_specs))
+        )
+        # Otherwise the transaction manager would consider the session
+        # unchanged and roll it back.
+        mark_changed(DBSession())
 
     @classmethod
     def get(cls, identifier):
@@ -334,12 +1123,84 @@ class Item(_Base, _CreateMixin):
         Record.mark_as_deleted(identifier=self.identifier)
         self.deleted = True
 
+    @classmethod
+    def iter_identifiers(cls, batch_size=500):
+        """Iterate over all items in the order of their identifiers.
+
+        The items are fetched in batches with keyset pagination, so no
+        cursor is kept open between the batches and the database can be
+        modified during the iteration.
+
+        Parameters
+        ----------
+        batch_size: int
+            Number of items to fetch at a time.
+
+        Return
+        ------
+        iterable of (unicode, bool):
+            (identifier, deleted) tuples, in the order Python compares
+            the identifiers regardless of the collation of the column.
+        """
+        key = _binary_collation(cls.identifier)
+        last = None
+        while True:
+            query = DBSession.query(cls.identifier, cls.deleted)
+            if last is not None:
+                query = query.filter(key > last)
+            batch = query.order_by(key).limit(batch_size).all()
+            for identifier, deleted in batch:
+                yield identifier, deleted
+            if len(batch) < batch_size:
+                return
+            last = batch[-1][0]
+
+    @classmethod
+    def create_many(cls, identifiers):
+        """Add new items to the database with a single statement.
+
+        The items must not exist in the database.
+        """
+        if identifiers:
+            DBSession.execute(
+                cls.__table__.insert(),
+                [{'identifier': identifier, 'deleted': False}
+                 for identifier in identifiers]
+            )
+            # Otherwise the transaction manager would consider the
+            # session unchanged and roll it back.
+            mark_changed(DBSession())
+
+    @classmethod
+    def undelete_many(cls, identifiers):
+        """Mark existing items as not deleted."""
+        if identifiers:
+            (DBSession.query(cls)
+                      .filter(cls.identifier.in_(identifiers))
+                      .update({'deleted': False},
+                              synchronize_session=False))
+
+    @classmethod
+    def mark_many_as_deleted(cls, identifiers):
+        """Mark items and their records as deleted.
+
+        Unlike `mark_as_deleted`, this does not update Item and Record
+        objects already loaded in the session.
+        """
+        _mark_many_as_deleted(cls.identifier, Record.identifier,
+                              identifiers)
+
 
 class Record(_Base, _CreateMixin):
     """The SQLAlchemy model class for an OAI record."""
     __tablename__ = 'records'
+    # Unlike the set memberships, the records are keyed by strings
+    # rather than by the integer keys of the items and formats. They are
+    # looked up, listed and resumed in the order of these strings, which
+    # would otherwise take a join with the items. The identifiers are
+    # stored compressed, and the metadata prefixes are short.
     identifier = sa.Column(
-        sa.String,
+        _Identifier,
         sa.ForeignKey('items.identifier'),
         primary_key=True
     )
@@ -351,6 +1212,14 @@ class Record(_Base, _CreateMixin):
     datestamp = sa.Column(sa.DateTime, nullable=False)
     xml = sa.Column(sa.Text)
     deleted = sa.Column(sa.Boolean, nullable=False)
+    # Loaded by `list` with the record, see `set_specs`.
+    _leaf_set_specs = orm.column_property(
+        sa.select([Item._leaf_set_specs])
+          .where(Item.identifier == identifier)
+          .correlate_except(Item)
+          .as_scalar(),
+        deferred=True,
+    )
 
     def __init__(self, identifier, prefix, xml, datestamp=None):
         try:
@@ -447,7 +1316,7 @@ class Record(_Base, _CreateMixin):
             The matching records. If no records match, an empty list is
             returned.
         """
-        query = DBSession.query(cls)
+        query = DBSession.query(cls).options(orm.undefer('_leaf_set_specs'))
 
         if identifier is not None:
             query = query.filter_by(identifier=identifier)
@@ -463,10 +1332,13 @@ class Record(_Base, _CreateMixin):
             query = (query.join(Item).join(Item.sets)
                           .filter(Set.spec==set_))
 
-        query = query.order_by(cls.identifier)
+        # The stored identifiers start with control characters, which
+        # only sort correctly by code points.
+        key = _binary_collation(cls.identifier)
+        query = query.order_by(key)
 
         if offset is not None:
-            query = query.filter(cls.identifier >= offset)
+            query = query.filter(key >= offset)
         if limit is not None:
             if limit < 0:
                 raise ValueError('negative limit: %d' % limit)
@@ -500,32 +1372,10 @@ class Record(_Base, _CreateMixin):
         """Return a list of specs for sets which contain this record.
 
         Sets which are parent sets of sets that contain the record are
-        excluded from the result.
+        excluded from the result. The specs are stored with the item when
+        its sets are updated, see `Item.update_memberships`.
         """
-        result = []
-        # Fetch all set specs.
-        specs = (DBSession.query(Set.spec).join(Item.sets)
-                          .filter(Item.identifier==self.identifier)
-                          .all())
-        specs = [s for (s,) in specs]
-        # Sort to descending order by level.
-        specs.sort(key=lambda x: -x.count(':'))
-        # A set containing the specs of sets whose subsets have already
-        # been processed.
-        processed = set()
-        for spec in specs:
-            if spec not in processed:
-                result.append(spec)
-                # Mark all parent sets of the set as processed.
-                i = 0
-                try:
-                    while True:
-                        i = spec.index(':', i)
-                        processed.add(spec[:i])
-                        i += 1
-                except ValueError:
-                    pass
-        return result
+        return (self._leaf_set_specs or u'').split()
 
     @classmethod
     def create_or_update(cls, identifier, prefix, xml):
@@ -564,9 +1414,11 @@ class Record(_Base, _CreateMixin):
         if prefix is not None:
             query = query.filter_by(prefix=prefix)
         query = query.filter(cls.deleted.is_(False))
+        # Update the records loaded in the session without selecting
+        # the matching rows first.
         updated = query.update(
             {'deleted': True, 'datestamp': datestamp_now()},
-            synchronize_session='fetch'
+            synchronize_session='evaluate'
         )
         if updated > 0:
             Datestamp.update()
@@ -592,13 +1444,126 @@ class Record(_Base, _CreateMixin):
             raise ValueError('wrong schema location')
 
 
+def _binary_collation(column):
+    """Compare and sort a string column by code points, if the database
+    supports it."""
+    collation = _BINARY_COLLATIONS.get(DBSession.get_bind().dialect.name)
+    if collation is None:
+        return column
+    return column.collate(collation)
+
+
+def _mark_many_as_deleted(key, record_key, values):
+    """Mark items or formats and their records as deleted in bulk.
+
+    The rows are updated with a few statements without synchronizing
+    the session.
+
+    Parameters
+    ----------
+    key: sqlalchemy.Column
+        The primary key of the items or formats.
+    record_key: sqlalchemy.Column
+        The column of the records referring to `key`.
+    values: collection of unicode
+        The identifiers of the items or the prefixes of the formats.
+    """
+    values = list(values)
+    if not values:
+        return
+    Class = key.class_
+    now = datestamp_now()
+    updated = 0
+    for start in xrange(0, len(values), _IN_BATCH_SIZE):
+        batch = values[start:start + _IN_BATCH_SIZE]
+        (DBSession.query(Class)
+                  .filter(key.in_(batch))
+                  .update({'deleted': True}, synchronize_session=False))
+        updated += (DBSession.query(Record)
+                             .filter(record_key.in_(batch))
+                             .filter(Record.deleted.is_(False))
+                             .update({'deleted': True, 'datestamp': now},
+                                     synchronize_session=False))
+    if updated > 0:
+        Datestamp.update()
+
+
+class ImportCheckpoint(_Base, _CreateMixin):
+    """The SQLAlchemy model class for the start time of an unfinished
+    import.
+
+    The items already processed by the import are stored as
+    ProcessedItems in the same transactions as their records, so an
+    interrupted import can be resumed from where it stopped.
+    """
+    __tablename__ = 'import_checkpoint'
+    started = sa.Column(sa.DateTime, primary_key=True)
+
+    def __init__(self, started):
+        self.started = started
+
+    @classmethod
+    def begin(cls, started):
+        """Start an import or continue an unfinished one.
+
+        Parameters
+        ----------
+        started: datetime.datetime
+            The start time of the import.
+
+        Return
+        ------
+        datetime.datetime:
+            The start time of the unfinished import if there is one,
+            otherwise `started`.
+        """
+        checkpoint = DBSession.query(cls).first()
+        if checkpoint is not None:
+            return checkpoint.started
+        cls.create(started)
+        return started
+
+    @classmethod
+    def end(cls):
+        """Remove the checkpoint and the processed items."""
+        DBSession.query(ProcessedItem).delete(synchronize_session=False)
+        DBSession.query(cls).delete(synchronize_session=False)
+
+
+class ProcessedItem(_Base, _CreateMixin):
+    """The SQLAlchemy model class for an item processed by an unfinished
+    import."""
+    __tablename__ = 'processed_items'
+    identifier = sa.Column(sa.String, primary_key=True)
+
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+    @classmethod
+    def identifiers(cls):
+        """Return the identifiers of the processed items.
+
+        Return
+        ------
+        set of unicode:
+            The identifiers.
+        """
+        return set(identifier for (identifier,)
+                   in DBSession.query(cls.identifier))
+
+
 class Datestamp(_Base, _CreateMixin):
     """The SQLAlchemy model class for the datestamp of the database."""
     __tablename__ = 'datestamp'
     datestamp = sa.Column(sa.DateTime, primary_key=True)
+    # Incremented whenever the datestamp is written, since several
+    # modifications may get the same datestamp.
+    generation = sa.Column(sa.Integer, nullable=False, default=0,
+                           server_default='0')
 
-    def __init__(self, datestamp):
+    def __init__(self, datestamp, generation=1):
         self.datestamp = datestamp
+        self.generation = generation
 
     @classmethod
     def get(cls):
@@ -610,21 +1575,80 @@ class Datestamp(_Base, _CreateMixin):
             The datestamp of the latest database modification. If the
             database has never been modified, return None.
         """
+        cls.write_pending()
         result = DBSession.query(cls.datestamp).first()
         if result is not None:
             # The query returns a 1-tuple.
             return result[0]
         return None
 
+    @classmethod
+    def get_version(cls):
+        """Fetch the datestamp and the modification counter of the
+        database.
+
+        Unlike the datestamp alone, the version changes with every
+        transaction that modifies the database, including transactions
+        committed within the same second.
+
+        Return
+        ------
+        (datetime.datetime or None, int):
+            The datestamp and the number of times it has been written.
+        """
+        cls.write_pending()
+        result = DBSession.query(cls.datestamp, cls.generation).first()
+        if result is not None:
+            return tuple(result)
+        return (None, 0)
+
     @classmethod
     def update(cls):
-        """Set the database datestamp to the current time."""
+        """Set the database datestamp to the current time.
+
+        The datestamp row is written only once per transaction, when
+        the transaction is committed or the datestamp is read, so that
+        writers do not update it for every record.
+        """
+        DBSession().info[_PENDING_DATESTAMP] = datestamp_now()
+
+    @classmethod
+    def write_pending(cls):
+        """Write the datestamp set by `update` to the database.
+
+        Does nothing if the datestamp has not been updated.
+        """
+        now = DBSession().info.pop(_PENDING_DATESTAMP, None)
+        if now is None:
+            return
         try:
             datestamp = DBSession.query(cls).one()
-            datestamp.datestamp = datestamp_now()
+            datestamp.datestamp = now
+            # Incremented in the database, so that concurrent writers
+            # do not get the same generation.
+            datestamp.generation = cls.generation + 1
         except orm.exc.NoResultFound:
-            DBSession.add(cls(datestamp_now()))
+            DBSession.add(cls(now))
         except orm.exc.MultipleResultsFound:
             logging.getLogger(__name__).warning('Multiple datestamps')
+            generation = DBSession.query(
+                sa.func.max(cls.generation)).scalar()
             DBSession.query(cls).delete(synchronize_session='fetch')
-            DBSession.add(cls(datestamp_now()))
+            DBSession.add(cls(now, generation + 1))
+
+
+@sa.event.listens_for(DBSession, 'before_commit')
+def _write_pending_datestamp(session):
+    # Savepoints are committed too, but the datestamp is written only
+    # with the outermost transaction.
+    if not session.transaction.nested:
+        Datestamp.write_pending()
+
+
+@sa.event.listens_for(DBSession, 'after_transaction_end')
+def _discard_pending_datestamp(session, transaction):
+    # The changes were rolled back with the transaction. A savepoint
+    # rollback keeps the datestamp pending, which at worst updates it
+    # needlessly.
+    if transaction.parent is None:
+        session.info.pop(_PENDING_DATESTAMP, None)
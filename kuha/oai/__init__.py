@@ -1,10 +1,15 @@
 import sys
 
 from pyramid.config import Configurator
+from pyramid.tweens import EXCVIEW
 from pyramid.paster import setup_logging
 
 from ..config import clean_oai_settings
 from ..models import create_engine, ensure_oai_dc_exists
+from .cache import RecordCache, ResponseCache
+from .identifiers import IdentifierFilter
+from .precompile import use_template_cache, warm_templates
+from .serializer import XmlFileRenderer
 
 def main(global_config, **app_config):
     """ This function returns a Pyramid WSGI application.
@@ -18,9 +23,29 @@ def main(global_config, **app_config):
     create_engine(settings)
     ensure_oai_dc_exists()
 
+    if settings['template_cache_directory'] is not None:
+        use_template_cache(settings['template_cache_directory'])
+
     config = Configurator(settings=settings)
     config.include('pyramid_tm')
     config.include('pyramid_chameleon')
+    config.add_renderer('.oaixml', XmlFileRenderer)
     config.add_route('oai', '/oai', request_method=('GET', 'POST'))
+    if settings['identifier_filter']:
+        config.registry.identifier_filter = IdentifierFilter()
+    if settings['record_cache_size']:
+        config.registry.record_cache = RecordCache(
+            settings['record_cache_size'])
+    if settings['response_cache_file'] is not None:
+        config.registry.response_cache = ResponseCache(
+            settings['response_cache_file'], settings['response_cache_size'])
+        # Error responses are rendered by the exception view tween, and
+        # the datestamp is read within the transaction.
+        config.add_tween('kuha.oai.cache.response_cache_tween_factory',
+                         under='pyramid_tm.tm_tween_factory', over=EXCVIEW)
     config.scan()
-    return config.make_wsgi_app()
+    app = config.make_wsgi_app()
+
+    # Compile the templates before serving the first request.
+    warm_templates(config.registry)
+    return app
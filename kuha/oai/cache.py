@@ -0,0 +1,346 @@
+"""Caches of database contents and responses for the OAI app."""
+import collections
+import json
+import logging
+import re
+import threading
+import time
+
+from pyramid.response import Response
+import sqlalchemy as sa
+
+from ..models import Datestamp
+from ..util import datestamp_now, format_datestamp
+
+"""Seconds between checks of the database datestamp. Changes made
+within this time after the previous check may not be seen yet."""
+CHECK_INTERVAL = 1.0
+
+"""Estimated memory used by a cached record in addition to its text."""
+_RECORD_OVERHEAD = 500
+
+"""Seconds to wait for other processes writing to the response cache."""
+_RESPONSE_CACHE_TIMEOUT = 1.0
+
+"""The element which is replaced in cached responses."""
+_RESPONSE_DATE = re.compile(b'<responseDate>[^<]*</responseDate>')
+
+"""A copy of a record, with the attributes used by the templates."""
+CachedRecord = collections.namedtuple(
+    'CachedRecord',
+    ['identifier', 'prefix', 'datestamp', 'deleted', 'xml', 'set_specs'],
+)
+
+
+class DatestampWatch(object):
+    """Detect changes of the database from its datestamp and
+    modification counter, see `models.Datestamp.get_version`.
+
+    Not thread-safe; the callers must hold a lock.
+    """
+
+    def __init__(self):
+        # The version read by the latest check.
+        self.version = None
+        self._checked = None
+
+    def changed(self):
+        """Check whether the database has been modified.
+
+        The datestamp is read from the database at most once every
+        `CHECK_INTERVAL` seconds.
+
+        Return
+        ------
+        bool:
+            ``True`` on the first call and whenever the database has
+            been modified since the previous check, ``False`` otherwise.
+        """
+        now = time.time()
+        if (self._checked is not None and
+                0 <= now - self._checked < CHECK_INTERVAL):
+            return False
+        first = self._checked is None
+        version = Datestamp.get_version()
+        self._checked = now
+        if first or version != self.version:
+            self.version = version
+            return True
+        return False
+
+
+class RecordCache(object):
+    """A least recently used cache of records, keyed by the identifier
+    and the metadata prefix.
+
+    The whole cache is emptied when the database is modified, as
+    detected by `DatestampWatch`. It is safe to use from several
+    threads.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Approximate maximum size of the cached records.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._watch = DatestampWatch()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        # Incremented when the cache is emptied, so that records loaded
+        # before a modification are not stored after it.
+        self._generation = 0
+
+    def get(self, identifier, prefix, load):
+        """Return a cached record, or load and cache it.
+
+        Parameters
+        ----------
+        identifier: unicode
+            An OAI identifier URI.
+        prefix: unicode
+            A metadata prefix.
+        load: callable
+            Function returning the record if it is not in the cache.
+            Exceptions raised by it are passed to the caller.
+
+        Return
+        ------
+        CachedRecord:
+            A copy of the record.
+        """
+        key = (identifier, prefix)
+        with self._lock:
+            if self._watch.changed():
+                self._clear()
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                generation = self._generation
+            else:
+                self._entries[key] = entry
+                return entry[0]
+
+        record = load()
+        cached = CachedRecord(record.identifier, record.prefix,
+                              record.datestamp, record.deleted,
+                              record.xml, record.set_specs)
+        size = _record_size(cached)
+        with self._lock:
+            if (generation == self._generation and
+                    key not in self._entries and size <= self.max_bytes):
+                self._entries[key] = (cached, size)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self._bytes -= evicted
+        return cached
+
+    def _clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        self._generation += 1
+
+
+def _record_size(record):
+    return (_RECORD_OVERHEAD + len(record.identifier) +
+            len(record.xml or '') + sum(len(s) for s in record.set_specs))
+
+
+_response_metadata = sa.MetaData()
+
+_responses = sa.Table(
+    'responses',
+    _response_metadata,
+    # The URL and the parameters of the request.
+    sa.Column('request', sa.Text, primary_key=True),
+    # The datestamp and the generation of the database.
+    sa.Column('version', sa.Text, nullable=False),
+    # The generation alone, for dropping the responses of older versions.
+    sa.Column('generation', sa.Integer, nullable=False, index=True),
+    sa.Column('content_type', sa.Text, nullable=False),
+    sa.Column('body', sa.LargeBinary, nullable=False),
+    sa.Column('size', sa.Integer, nullable=False),
+    sa.Column('stored', sa.Float, nullable=False, index=True),
+)
+
+# A single row with the total size of the responses, which the writers
+# keep up to date instead of summing the sizes.
+_response_total = sa.Table(
+    'total',
+    _response_metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('size', sa.Integer, nullable=False),
+)
+
+
+class ResponseCache(object):
+    """A cache of OAI-PMH responses in an SQLite file, which several
+    server processes can share.
+
+    The responses are keyed by the request and the version of the
+    database, see `models.Datestamp.get_version`. The responses of
+    older versions are dropped when a newer response is stored.
+
+    When the cache is full, the responses stored first are dropped,
+    however often they have been served, so that serving a response
+    does not write to the file.
+    The response date of cached responses is replaced with the current
+    time. It is safe to use from several threads.
+
+    Parameters
+    ----------
+    path: unicode
+        Path of the cache file. Created if it does not exist.
+    max_bytes: int
+        Maximum total size of the cached response bodies.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self._engine = sa.create_engine(
+            'sqlite:///' + path,
+            connect_args={'timeout': _RESPONSE_CACHE_TIMEOUT},
+        )
+        _use_shared_cache_file(self._engine)
+        _response_metadata.create_all(self._engine)
+        with self._engine.begin() as connection:
+            connection.execute(
+                _response_total.insert().prefix_with('OR IGNORE')
+                  .from_select(['id', 'size'], sa.select([
+                      sa.literal(1),
+                      sa.func.coalesce(sa.func.sum(_responses.c.size), 0),
+                  ])))
+        self._lock = threading.Lock()
+        self._watch = DatestampWatch()
+        # The newest generation whose older responses have been dropped.
+        self._pruned = None
+
+    def handle(self, request, handler):
+        """Return a cached response, or call the handler and cache its
+        response.
+
+        The cache is skipped if it cannot be accessed, e.g. because it
+        is locked by other processes for too long.
+        """
+        key = json.dumps([request.path_url,
+                          sorted(request.params.items())])
+        with self._lock:
+            self._watch.changed()
+            datestamp, generation = self._watch.version
+        version = u'{0} {1}'.format(
+            datestamp.isoformat() if datestamp is not None else u'',
+            generation)
+        try:
+            response = self._load(key, version)
+        except sa.exc.SQLAlchemyError as error:
+            _log_error('read', error)
+            response = None
+        if response is not None:
+            return response
+
+        response = handler(request)
+        if (response.status_int == 200 and
+                len(response.body) <= self.max_bytes):
+            try:
+                self._store(key, version, generation, response)
+            except sa.exc.SQLAlchemyError as error:
+                _log_error('write', error)
+        return response
+
+    def _load(self, key, version):
+        row = self._engine.execute(
+            sa.select([_responses.c.content_type, _responses.c.body])
+              .where(_responses.c.request == key)
+              .where(_responses.c.version == version)
+        ).first()
+        if row is None:
+            return None
+        response_date = '<responseDate>{0}</responseDate>'.format(
+            format_datestamp(datestamp_now()))
+        body = _RESPONSE_DATE.sub(response_date.encode('ascii'),
+                                  bytes(row.body), count=1)
+        return Response(body=body,
+                        headerlist=[('Content-Type', str(row.content_type))])
+
+    def _store(self, key, version, generation, response):
+        table = _responses
+        size = len(response.body)
+        with self._engine.begin() as connection:
+            if self._pruned is None or generation > self._pruned:
+                # Responses of older versions are not used anymore.
+                # Newer ones are kept for the other processes, which may
+                # have seen modifications that this one has not.
+                older = table.c.generation < generation
+                self._add_size(connection, -sa.select(
+                    [sa.func.coalesce(sa.func.sum(table.c.size), 0)]
+                ).where(older).as_scalar())
+                connection.execute(table.delete().where(older))
+                self._pruned = generation
+            # A replaced response no longer counts towards the total.
+            self._add_size(connection, size - sa.select(
+                [sa.func.coalesce(sa.func.sum(table.c.size), 0)]
+            ).where(table.c.request == key).as_scalar())
+            connection.execute(
+                table.insert().prefix_with('OR REPLACE'),
+                request=key,
+                version=version,
+                generation=generation,
+                content_type=response.headers['Content-Type'],
+                body=response.body,
+                size=size,
+                stored=time.time(),
+            )
+            excess = connection.execute(
+                sa.select([_response_total.c.size])).scalar()
+            excess -= self.max_bytes
+            if excess <= 0:
+                return
+            oldest = []
+            freed = 0
+            for request, size in connection.execute(
+                    sa.select([table.c.request, table.c.size])
+                      .order_by(table.c.stored)):
+                oldest.append(request)
+                freed += size
+                if freed >= excess:
+                    break
+            connection.execute(table.delete().where(
+                table.c.request == sa.bindparam('old')),
+                [{'old': request} for request in oldest])
+            self._add_size(connection, -freed)
+
+    @staticmethod
+    def _add_size(connection, change):
+        connection.execute(_response_total.update().values(
+            size=_response_total.c.size + change))
+
+
+def _use_shared_cache_file(engine):
+    """Let readers and a writer access the cache file concurrently."""
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        # The cache can be rebuilt, so it need not survive crashes.
+        dbapi_connection.execute('PRAGMA journal_mode=WAL')
+        dbapi_connection.execute('PRAGMA synchronous=OFF')
+
+
+def _log_error(operation, error):
+    logging.getLogger(__name__).warning(
+        'Could not {0} the response cache: {1}'.format(operation, error))
+
+
+def response_cache_tween_factory(handler, registry):
+    """Serve the responses from ``registry.response_cache``.
+
+    The tween must be placed under the transaction manager, which
+    handles the database session used for reading the datestamp.
+    """
+    response_cache = registry.response_cache
+
+    def response_cache_tween(request):
+        return response_cache.handle(request, handler)
+
+    return response_cache_tween
@@ -0,0 +1,139 @@
+"""An in-memory filter of the item identifiers in the database."""
+import hashlib
+import logging
+import math
+import struct
+import threading
+
+from ..models import DBSession, Datestamp, Item, rollback
+from .cache import DatestampWatch
+
+"""Probability that an identifier is not in the filter but passes it."""
+ERROR_RATE = 0.01
+
+_HASH_PARTS = struct.Struct('<QQ')
+
+
+class BloomFilter(object):
+    """A Bloom filter of unicode strings.
+
+    Parameters
+    ----------
+    capacity: int
+        Number of strings that will be added to the filter.
+    error_rate: float
+        The false positive probability for `capacity` strings.
+    """
+
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(
+            float(self.size) / capacity * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: the positions are h1 + i * h2 for the two
+        # halves of an MD5 digest.
+        digest = hashlib.md5(value.encode('utf-8')).digest()
+        first, second = _HASH_PARTS.unpack(digest)
+        for i in xrange(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+
+class IdentifierFilter(object):
+    """A filter of the identifiers of all items, deleted or not.
+
+    The filter is rebuilt in a background thread when the database is
+    modified. Until the new filter is ready, all items are reported as
+    possibly existing, so that they are looked up from the database. It
+    is safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watch = DatestampWatch()
+        self._filter = None
+        # The database version that the filter was built from.
+        self._version = None
+        # The thread building a new filter, if any.
+        self._builder = None
+
+    def might_exist(self, identifier):
+        """Check whether an item may exist.
+
+        Parameters
+        ----------
+        identifier: unicode
+            An OAI identifier URI.
+
+        Return
+        ------
+        bool:
+            ``False`` if there is no item with the identifier. ``True``
+            if the item may exist, which must then be checked from the
+            database.
+        """
+        with self._lock:
+            self._watch.changed()
+            bloom = self._current()
+            version = self._version
+        if bloom is None or identifier in bloom:
+            return True
+        # The database is checked for changes only once in
+        # `cache.CHECK_INTERVAL` seconds, so items added since then are
+        # not in the filter. A miss is confirmed by reading the version
+        # again.
+        return Datestamp.get_version() != version
+
+    def _current(self):
+        """Return the filter, or `None` if it is out of date.
+
+        A new filter is then built in a background thread, unless one is
+        already being built. The lock must be held by the caller.
+        """
+        version = self._watch.version
+        if self._version == version:
+            return self._filter
+        if self._builder is None:
+            self._builder = threading.Thread(
+                target=self._build, args=(version,),
+                name='identifier-filter')
+            self._builder.daemon = True
+            self._builder.start()
+        return None
+
+    def _build(self, version):
+        # The version is read before the identifiers, so modifications
+        # during the build cause another rebuild.
+        log = logging.getLogger(__name__)
+        bloom = None
+        try:
+            identifiers = [identifier
+                           for identifier, _ in Item.iter_identifiers()]
+            bloom = BloomFilter(len(identifiers))
+            for identifier in identifiers:
+                bloom.add(identifier)
+            log.debug('Built an identifier filter of {0} items'.format(
+                len(identifiers)))
+        except Exception:
+            log.exception('Failed to build the identifier filter')
+        finally:
+            # The thread has a session of its own.
+            rollback()
+            DBSession.remove()
+            with self._lock:
+                self._builder = None
+                if bloom is not None:
+                    self._filter = bloom
+                    self._version = version
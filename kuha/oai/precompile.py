@@ -0,0 +1,102 @@
+import logging
+import os
+import sys
+
+from chameleon.loader import ModuleLoader
+from chameleon.template import BaseTemplate
+from pyramid.config import Configurator
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.renderers import get_renderer
+from pyramid.scripts.common import parse_vars
+
+from ..config import clean_oai_settings
+
+# Asset specification of the template directory.
+_TEMPLATE_SPEC = '{0}:templates'.format(__name__.rpartition('.')[0])
+_TEMPLATE_DIRECTORY = os.path.join(os.path.dirname(__file__), 'templates')
+
+def usage(argv):
+    usage_string = '''Usage: {0} <config_uri> [var=value]...
+Compile the OAI-PMH templates into the template cache directory.
+
+See the sample configuration file for details.'''
+    cmd = os.path.basename(argv[0])
+    print(usage_string.format(cmd))
+    sys.exit(1)
+
+
+def template_names():
+    """List the filenames of all OAI-PMH templates.
+
+    Return
+    ------
+    list of str:
+        Names of the template files, sorted.
+    """
+    return sorted(name for name in os.listdir(_TEMPLATE_DIRECTORY)
+                  if name.endswith('.pt'))
+
+
+def use_template_cache(directory):
+    """Store compiled templates in a persistent directory.
+
+    Compiled templates are written to the directory as Python modules.
+    Templates that are found in the directory are loaded from there
+    instead of being compiled again, also by other processes.
+
+    Parameters
+    ----------
+    directory: unicode
+        Path of the cache directory. Created if it does not exist.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    BaseTemplate.loader = ModuleLoader(directory)
+
+
+def warm_templates(registry):
+    """Compile all templates and cache their renderers.
+
+    The renderers are stored in the registry, so the first request to
+    each verb does not have to compile the templates.
+
+    Parameters
+    ----------
+    registry: pyramid.registry.Registry
+        The application registry. ``pyramid_chameleon`` must have been
+        included and the configuration committed.
+    """
+    log = logging.getLogger(__name__)
+    for name in template_names():
+        log.debug('Compiling template "{0}"...'.format(name))
+        spec = '{0}/{1}'.format(_TEMPLATE_SPEC, name)
+        renderer = get_renderer(spec, registry=registry)
+        renderer.implementation().cook_check()
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+
+    settings = get_appsettings(config_uri, options=options)
+    clean_oai_settings(settings)
+
+    setup_logging(settings['logging_config'])
+    log = logging.getLogger(__name__)
+
+    directory = settings['template_cache_directory']
+    if directory is None:
+        log.critical('Template cache directory has not been configured.')
+        sys.exit(1)
+
+    log.info('Compiling templates to "{0}"...'.format(directory))
+    use_template_cache(directory)
+
+    config = Configurator(settings=settings)
+    config.include('pyramid_chameleon')
+    config.commit()
+    warm_templates(config.registry)
+
+    log.info('Done.')
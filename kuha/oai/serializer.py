@@ -0,0 +1,140 @@
+from io import BytesIO
+
+from lxml import etree
+
+from ..util import format_datestamp
+
+"""The namespaces."""
+OAI_NS = 'http://www.openarchives.org/OAI/2.0/'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+"""The schema location of OAI-PMH responses."""
+OAI_SCHEMA_LOCATION = (OAI_NS + ' ' +
+                       'http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd')
+
+# Same declaration as in the oaipmh.pt template.
+_XML_DECLARATION = b'<?xml version="1.0" encoding="UTF-8"?>\n'
+
+_NSMAP = {None: OAI_NS, 'xsi': XSI_NS}
+
+
+def _tag(name):
+    return '{{{0}}}{1}'.format(OAI_NS, name)
+
+
+class XmlFileRenderer(object):
+    """A Pyramid renderer which serializes OAI-PMH responses with
+    ``lxml.etree.xmlfile``.
+
+    This renderer produces the same documents as the templates of the
+    ``GetRecord``, ``ListIdentifiers`` and ``ListRecords`` verbs, but
+    writes them incrementally without evaluating template expressions
+    for each record. The renderer name must be the verb followed by the
+    ``.oaixml`` extension, e.g. ``ListRecords.oaixml``.
+    """
+
+    def __init__(self, info):
+        verb = info.name.rsplit(':', 1)[-1].rsplit('.', 1)[0]
+        try:
+            self._write_content = _CONTENT_WRITERS[verb]
+        except KeyError:
+            raise ValueError('no serializer for verb {0}'.format(verb))
+        self._verb = verb
+
+    def __call__(self, value, system):
+        return serialize(self._verb, self._write_content, value,
+                         system['request'])
+
+
+def serialize(verb, write_content, values, request):
+    """Serialize an OAI-PMH response.
+
+    Parameters
+    ----------
+    verb: str
+        Name of the verb element.
+    write_content: callable
+        Function which writes the children of the verb element. Called
+        with the ``lxml.etree.xmlfile`` writer, the output stream and the
+        values.
+    values: dict
+        The values returned by the view.
+    request: pyramid.request.Request
+        The request.
+
+    Return
+    ------
+    str:
+        The UTF-8 encoded response.
+    """
+    output = BytesIO()
+    output.write(_XML_DECLARATION)
+    with etree.xmlfile(output, encoding='UTF-8') as xf:
+        root_attrib = {'{{{0}}}schemaLocation'.format(XSI_NS):
+                       OAI_SCHEMA_LOCATION}
+        with xf.element(_tag('OAI-PMH'), root_attrib, nsmap=_NSMAP):
+            _write_text(xf, 'responseDate', format_datestamp(values['time']))
+            _write_text(xf, 'request', request.path_url,
+                        dict(request.params))
+            with xf.element(_tag(verb)):
+                write_content(xf, output, values)
+    return output.getvalue()
+
+
+def _write_text(xf, name, text, attrib=None):
+    """Write an element containing only text."""
+    with xf.element(_tag(name), attrib or {}):
+        xf.write(text)
+
+
+def _write_header(xf, record):
+    """Write the header of a record."""
+    attrib = {'status': 'deleted'} if record.deleted else {}
+    with xf.element(_tag('header'), attrib):
+        _write_text(xf, 'identifier', record.identifier)
+        _write_text(xf, 'datestamp', format_datestamp(record.datestamp))
+        for spec in record.set_specs:
+            _write_text(xf, 'setSpec', spec)
+
+
+def _write_record(xf, output, record):
+    """Write a record with its header and metadata."""
+    with xf.element(_tag('record')):
+        _write_header(xf, record)
+        if not record.deleted:
+            with xf.element(_tag('metadata')):
+                # The metadata is stored as serialized XML. Copy it to the
+                # output as is, like the templates do.
+                xf.flush()
+                xml = record.xml
+                if isinstance(xml, unicode):
+                    xml = xml.encode('utf-8')
+                output.write(xml)
+
+
+def _write_token(xf, token):
+    if token is not None:
+        _write_text(xf, 'resumptionToken', token)
+
+
+def _write_get_record(xf, output, values):
+    _write_record(xf, output, values['record'])
+
+
+def _write_list_identifiers(xf, output, values):
+    for record in values['records']:
+        _write_header(xf, record)
+    _write_token(xf, values['token'])
+
+
+def _write_list_records(xf, output, values):
+    for record in values['records']:
+        _write_record(xf, output, record)
+    _write_token(xf, values['token'])
+
+
+_CONTENT_WRITERS = {
+    'GetRecord': _write_get_record,
+    'ListIdentifiers': _write_list_identifiers,
+    'ListRecords': _write_list_records,
+}
@@ -118,7 +118,8 @@ def handle_list_metadata_formats(request):
     _check_params(request.params, allowed=[u'identifier'])
 
     ignore_deleted = _get_ignore_deleted(request)
-    identifier = _get_identifier(request.params, ignore_deleted)
+    identifier = _get_identifier(request.params, ignore_deleted,
+                                 _get_identifier_filter(request))
     formats = Format.list(identifier, ignore_deleted)
 
     if identifier is not None and not formats:
@@ -179,6 +180,7 @@ def handle_list_items(request):
         # No resumption token needed.
         new_token = None
 
+    _select_serializer(request)
     return {'records': records, 'token': new_token}
 
 
@@ -205,8 +207,23 @@ def handle_get_record(request):
     _check_params(request.params,
                   required=[u'identifier', u'metadataPrefix'])
 
+    record_cache = getattr(request.registry, 'record_cache', None)
+    if record_cache is None:
+        record = _get_record(request)
+    else:
+        record = record_cache.get(request.params[u'identifier'],
+                                  request.params[u'metadataPrefix'],
+                                  functools.partial(_get_record, request))
+
+    _select_serializer(request)
+    return {'record': record}
+
+
+def _get_record(request):
+    """Fetch the record requested with GetRecord from the database."""
     ignore_deleted = _get_ignore_deleted(request)
-    identifier = _get_identifier(request.params, ignore_deleted)
+    identifier = _get_identifier(request.params, ignore_deleted,
+                                 _get_identifier_filter(request))
     prefix = _get_metadata_prefix(request.params, ignore_deleted)
 
     records = Record.list(
@@ -218,8 +235,18 @@ def handle_get_record(request):
     if not records:
         raise exception.UnavailableMetadataFormat(prefix, identifier)
     assert len(records) == 1, 'Id-prefix combination is not unique'
+    return records[0]
+
 
-    return {'record': records[0]}
+def _select_serializer(request):
+    """Render the response with the lxml serializer if it is enabled.
+
+    The serializer is looked up by the verb, so this must only be called
+    by views that have a serializer (see ``serializer.XmlFileRenderer``).
+    """
+    if request.registry.settings.get('oai_serializer') == u'lxml':
+        request.override_renderer = '{0}.oaixml'.format(
+            request.params[u'verb'])
 
 
 def _check_params(params, required=[], allowed=[]):
@@ -371,7 +398,11 @@ def _get_metadata_prefix(params, ignore_deleted):
     return prefix
 
 
-def _get_identifier(params, ignore_deleted):
+def _get_identifier_filter(request):
+    return getattr(request.registry, 'identifier_filter', None)
+
+
+def _get_identifier(params, ignore_deleted, identifier_filter=None):
     """Get identifier from request parameters and check that it exists.
 
     Parameters
@@ -380,6 +411,9 @@ def _get_identifier(params, ignore_deleted):
         The request parameters.
     ignore_deleted: bool
         If `True` consider deleted items as not existing.
+    identifier_filter: identifiers.IdentifierFilter or None
+        If given, identifiers which are not in the filter are rejected
+        without looking up the item.
 
     Raises
     ------
@@ -393,6 +427,9 @@ def _get_identifier(params, ignore_deleted):
     if u'identifier' not in params:
         return None
     identifier = params[u'identifier']
+    if (identifier_filter is not None and
+            not identifier_filter.might_exist(identifier)):
+        raise exception.IdDoesNotExist(identifier)
     if not Item.exists(identifier, ignore_deleted):
         raise exception.IdDoesNotExist(identifier)
     return identifier
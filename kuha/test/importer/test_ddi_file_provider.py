@@ -0,0 +1,467 @@
+from io import BytesIO
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import mock
+from lxml import etree
+
+from ...importer import ddi_file_provider, inotify
+from ...importer.ddi_file_provider import (
+    Crosswalk,
+    DdiFileProvider,
+    convert_to_dc,
+    read_ddi,
+)
+
+DDI = '''<codeBook>
+    <stdyDscr>
+        <citation>
+            <titlStmt>
+                <titl>{0}</titl>
+                <IDNo>{0}-id</IDNo>
+            </titlStmt>
+        </citation>
+    </stdyDscr>
+</codeBook>'''
+
+
+class ProviderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.provider = DdiFileProvider('example.org', self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, name, mtime=None, contents=None):
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as file_:
+            file_.write(DDI.format(name) if contents is None else contents)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+
+class TestIdentifiers(ProviderTestCase):
+
+    def test_scan(self):
+        self.write_file('a.xml')
+        self.write_file('b.XML')
+        self.write_file('c.txt')
+        self.write_file('sub/dir/d.xml')
+
+        self.assertItemsEqual(self.provider.identifiers(), [
+            'oai:example.org:a',
+            'oai:example.org:b',
+            'oai:example.org:sub/dir/d',
+        ])
+
+    def test_symbolic_links(self):
+        self.write_file('sub/a.xml')
+        os.symlink(os.path.join(self.directory, 'sub'),
+                   os.path.join(self.directory, 'link'))
+        os.symlink(os.path.join(self.directory, 'missing.xml'),
+                   os.path.join(self.directory, 'broken.xml'))
+
+        identifiers = list(self.provider.identifiers())
+
+        # Linked directories are not followed, but broken links are
+        # listed so that fetching them fails.
+        self.assertItemsEqual(identifiers, [
+            'oai:example.org:sub/a',
+            'oai:example.org:broken',
+        ])
+        with self.assertRaises(OSError):
+            self.provider.has_changed('oai:example.org:broken',
+                                      datetime(2000, 1, 1))
+
+
+    def test_unreadable_directory(self):
+        self.write_file('a.xml')
+        self.write_file('sub/b.xml')
+        self.write_file('sub/dir/c.xml')
+        unreadable = os.path.join(self.directory, 'sub', 'dir')
+        scandir = ddi_file_provider.scandir
+
+        def failing_scandir(path):
+            if path == unreadable:
+                raise OSError(13, 'Permission denied')
+            return scandir(path)
+
+        with mock.patch.object(ddi_file_provider, 'scandir',
+                               side_effect=failing_scandir):
+            identifiers = list(self.provider.identifiers())
+
+        self.assertItemsEqual(identifiers, [
+            'oai:example.org:a',
+            'oai:example.org:sub/b',
+        ])
+
+    def test_unreadable_root(self):
+        with mock.patch.object(ddi_file_provider, 'scandir',
+                               side_effect=OSError(13, 'Permission denied')):
+            with self.assertRaises(OSError):
+                list(self.provider.identifiers())
+
+
+class TestHasChanged(ProviderTestCase):
+
+    def setUp(self):
+        super(TestHasChanged, self).setUp()
+        self.write_file('a.xml', mtime=0)
+        self.write_file('sub/b.xml')
+        # The ctime of the files cannot be set.
+        self.before = datetime(2000, 1, 1)
+        self.after = datetime.utcnow() + timedelta(hours=1)
+
+    def test_without_scan(self):
+        self.assertIs(
+            self.provider.has_changed('oai:example.org:a', self.before),
+            True)
+        self.assertIs(
+            self.provider.has_changed('oai:example.org:a', self.after),
+            False)
+
+    def test_index(self):
+        list(self.provider.identifiers())
+        os.remove(os.path.join(self.directory, 'a.xml'))
+
+        with mock.patch.object(ddi_file_provider.os, 'stat') as stat:
+            self.assertIs(
+                self.provider.has_changed('oai:example.org:a', self.before),
+                True)
+            self.assertIs(
+                self.provider.has_changed('oai:example.org:sub/b',
+                                          self.after),
+                False)
+        self.assertEqual(stat.mock_calls, [])
+
+    def test_changed_since(self):
+        self.assertItemsEqual(self.provider.changed_since(self.before),
+                              ['oai:example.org:a', 'oai:example.org:sub/b'])
+        self.assertEqual(self.provider.changed_since(self.after), [])
+
+    def test_invalid_identifier(self):
+        with self.assertRaises(ValueError):
+            self.provider.has_changed('oai:example.com:a', self.before)
+
+    def test_pickle(self):
+        list(self.provider.identifiers())
+        copy = pickle.loads(pickle.dumps(self.provider))
+        self.assertIsNone(copy._index)
+        self.assertIs(
+            copy.has_changed('oai:example.org:a', self.before), True)
+
+
+class TestWatch(ProviderTestCase):
+
+    def setUp(self):
+        super(TestWatch, self).setUp()
+        self.write_file('a.xml')
+        self.write_file('sub/b.xml')
+        list(self.provider.identifiers())
+        self.batches = self.provider.watch(delay=0.05)
+
+    def tearDown(self):
+        self.batches.close()
+        super(TestWatch, self).tearDown()
+
+    def test_files(self):
+        self.write_file('c.xml')
+        self.write_file('sub/b.xml', contents='<codeBook/>')
+        self.write_file('d.txt')
+        os.remove(os.path.join(self.directory, 'a.xml'))
+
+        changed, removed = next(self.batches)
+
+        self.assertItemsEqual(changed, ['oai:example.org:c',
+                                        'oai:example.org:sub/b'])
+        self.assertEqual(removed, ['oai:example.org:a'])
+        self.assertEqual(self.provider._index['oai:example.org:c'].path,
+                         os.path.join(self.directory, 'c.xml'))
+        self.assertNotIn('oai:example.org:a', self.provider._index)
+
+    def test_directories(self):
+        os.rename(os.path.join(self.directory, 'sub'),
+                  os.path.join(self.directory, 'moved'))
+
+        changed, removed = next(self.batches)
+
+        self.assertEqual(changed, ['oai:example.org:moved/b'])
+        self.assertEqual(removed, ['oai:example.org:sub/b'])
+
+        # The moved directory is watched under its new name.
+        self.write_file('moved/c.xml')
+        self.assertEqual(next(self.batches),
+                         (['oai:example.org:moved/c'], []))
+
+    def test_changes_before_watch(self):
+        self.batches.close()
+        self.write_file('c.xml')
+
+        batches = self.provider.watch(delay=0.05)
+        try:
+            self.assertEqual(next(batches), (['oai:example.org:c'], []))
+        finally:
+            batches.close()
+
+    def test_overflow(self):
+        self.write_file('c.xml')
+        overflow = [inotify.Event(-1, inotify.IN_Q_OVERFLOW, 0, '')]
+        with mock.patch.object(inotify.Inotify, 'read_events',
+                               side_effect=[overflow, []]):
+            changed, removed = next(self.batches)
+
+        self.assertEqual(changed, ['oai:example.org:c'])
+        self.assertEqual(removed, [])
+
+
+class TestDigestCache(ProviderTestCase):
+
+    def setUp(self):
+        super(TestDigestCache, self).setUp()
+        self.cache = os.path.join(self.directory, 'digests.json')
+        self.write_file('a.xml')
+        self.write_file('sub/b.xml')
+        self.scan()
+        self.since = datetime.utcnow() + timedelta(seconds=1)
+        self.later = time.time() + 3600
+
+    def scan(self):
+        provider = DdiFileProvider('example.org', self.directory,
+                                   self.cache)
+        list(provider.identifiers())
+        return provider
+
+    def changed(self, provider):
+        return sorted(provider.changed_since(self.since))
+
+    def test_same_contents(self):
+        # Like copying the files without preserving their times.
+        self.write_file('a.xml', mtime=self.later)
+        os.chmod(os.path.join(self.directory, 'sub/b.xml'), 0o600)
+        self.assertEqual(self.changed(self.scan()), [])
+
+        # The times are not compared with the digest cache.
+        self.provider = DdiFileProvider('example.org', self.directory)
+        list(self.provider.identifiers())
+        self.assertEqual(self.changed(self.provider),
+                         ['oai:example.org:a'])
+
+    def test_changed_contents(self):
+        self.write_file('a.xml', mtime=self.later, contents='<codeBook/>')
+        provider = self.scan()
+        self.assertEqual(self.changed(provider), ['oai:example.org:a'])
+        self.assertIs(provider.has_changed('oai:example.org:sub/b',
+                                           self.since), False)
+
+        # The change is reported until the file is modified again.
+        os.utime(os.path.join(self.directory, 'a.xml'), None)
+        self.assertEqual(self.changed(self.scan()), ['oai:example.org:a'])
+
+    def test_files_not_read_again(self):
+        with mock.patch.object(ddi_file_provider, '_digest') as digest:
+            self.scan()
+        self.assertEqual(digest.mock_calls, [])
+
+    def test_removed_files(self):
+        os.remove(os.path.join(self.directory, 'a.xml'))
+        self.scan()
+        with open(self.cache) as file_:
+            self.assertEqual(json.load(file_).keys(), [os.path.join('sub',
+                                                                    'b.xml')])
+
+    def test_invalid_cache(self):
+        with open(self.cache, 'w') as file_:
+            file_.write('{')
+        self.write_file('a.xml', mtime=self.later)
+        self.assertEqual(self.changed(self.scan()), ['oai:example.org:a'])
+
+
+class TestGetRecord(ProviderTestCase):
+
+    def test_oai_dc(self):
+        self.write_file('sub/a.XML')
+        list(self.provider.identifiers())
+
+        xml = self.provider.get_record('oai:example.org:sub/a', 'oai_dc')
+
+        self.assertIn('<dc:title>sub/a.XML</dc:title>', xml)
+        self.assertIn('<dc:identifier>sub/a.XML-id</dc:identifier>', xml)
+
+    def test_streaming(self):
+        contents = DDI.replace(
+            '</codeBook>',
+            '<dataDscr>{0}</dataDscr><fileDscr><fileTxt><fileType>SPSS'
+            '</fileType></fileTxt></fileDscr></codeBook>'.format(
+                '<var><labl>v</labl></var>' * 100))
+        self.write_file('a.xml', contents=contents)
+        expected = self.provider.get_record('oai:example.org:a', 'oai_dc')
+
+        with mock.patch.object(ddi_file_provider, 'STREAMING_THRESHOLD', 0):
+            with mock.patch.object(ddi_file_provider, 'read_ddi',
+                                   wraps=read_ddi) as read_mock:
+                xml = self.provider.get_record('oai:example.org:a', 'oai_dc')
+
+        self.assertEqual(len(read_mock.mock_calls), 1)
+        self.assertEqual(xml, expected)
+        self.assertIn('<dc:format>SPSS</dc:format>', xml)
+
+    def test_other_format(self):
+        self.write_file('a.xml')
+        self.assertIsNone(
+            self.provider.get_record('oai:example.org:a', 'ddi'))
+
+
+DDI_25 = '''<codeBook xmlns="ddi:codebook:2_5"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xsi:schemaLocation="ddi:codebook:2_5 http://www.ddialliance.org/Specification/DDI-Codebook/2.5/XMLSchema/codebook.xsd">
+    <stdyDscr>
+        <citation><titlStmt><titl>Study</titl></titlStmt></citation>
+    </stdyDscr>
+    <dataDscr><var name="v1"/></dataDscr>
+</codeBook>'''
+
+
+class TestGetAllRecords(ProviderTestCase):
+
+    def setUp(self):
+        super(TestGetAllRecords, self).setUp()
+        self.provider = DdiFileProvider('example.org', self.directory,
+                                        '-', 'yes')
+
+    def test_formats(self):
+        formats = self.provider.formats()
+        self.assertItemsEqual(formats.keys(), ['oai_dc', 'ddi_c'])
+        self.assertEqual(formats['ddi_c'][0], 'ddi:codebook:2_5')
+
+    def test_pass_through_disabled(self):
+        provider = DdiFileProvider('example.org', self.directory)
+        self.assertItemsEqual(provider.formats().keys(), ['oai_dc'])
+        self.write_file('a.xml', contents=DDI_25)
+
+        with mock.patch.object(ddi_file_provider, 'STREAMING_THRESHOLD', 0):
+            with mock.patch.object(ddi_file_provider.etree, 'parse',
+                                   wraps=etree.parse) as parse:
+                records = provider.get_all_records(
+                    'oai:example.org:a', ['oai_dc', 'ddi_c'])
+
+        self.assertEqual(parse.mock_calls, [])
+        self.assertIn('<dc:title>Study</dc:title>', records['oai_dc'])
+        self.assertIsNone(records['ddi_c'])
+
+    def test_ddi_25(self):
+        self.write_file('a.xml', contents=DDI_25)
+
+        with mock.patch.object(ddi_file_provider, 'STREAMING_THRESHOLD', 0):
+            with mock.patch.object(ddi_file_provider.etree, 'parse',
+                                   wraps=etree.parse) as parse:
+                records = self.provider.get_all_records(
+                    'oai:example.org:a', ['oai_dc', 'ddi_c', 'ead'])
+
+        self.assertEqual(len(parse.mock_calls), 1)
+        self.assertIsNone(records['ead'])
+        self.assertIn('<dc:title>Study</dc:title>', records['oai_dc'])
+        ddi = etree.fromstring(records['ddi_c'])
+        self.assertEqual(ddi.tag, '{ddi:codebook:2_5}codeBook')
+        self.assertEqual(len(ddi.findall('{*}dataDscr/{*}var')), 1)
+
+    def test_ddi_without_namespace(self):
+        self.write_file('a.xml')
+
+        records = self.provider.get_all_records(
+            'oai:example.org:a', ['oai_dc', 'ddi_c'])
+
+        self.assertIn('<dc:title>a.xml</dc:title>', records['oai_dc'])
+        self.assertIsNone(records['ddi_c'])
+
+    def test_no_known_formats(self):
+        self.assertEqual(
+            self.provider.get_all_records('oai:example.org:missing',
+                                          ['ead']),
+            {'ead': None})
+
+
+class TestReadDdi(unittest.TestCase):
+
+    def test_sections(self):
+        ddi = BytesIO(b'''<codeBook a="b">
+            <docDscr><citation><titl>Doc</titl></citation></docDscr>
+            <stdyDscr><citation><titl>Study</titl></citation></stdyDscr>
+            <dataDscr>
+                <var name="v1"><labl>1</labl></var>
+                <var name="v2"><labl>2</labl></var>
+            </dataDscr>
+            <fileDscr ID="F1"><fileTxt/></fileDscr>
+        </codeBook>''')
+
+        root = read_ddi(ddi)
+
+        self.assertEqual(root.tag, 'codeBook')
+        self.assertEqual(root.get('a'), 'b')
+        self.assertEqual([e.tag for e in root], ['stdyDscr', 'fileDscr'])
+        self.assertEqual(root.findtext('stdyDscr/citation/titl'), 'Study')
+        self.assertEqual(root.find('fileDscr').get('ID'), 'F1')
+
+    def test_other_sections(self):
+        ddi = BytesIO(b'<codeBook><a><b/></a><c/><stdyDscr/></codeBook>')
+        root = read_ddi(ddi, sections=['a', 'c'])
+        self.assertEqual(etree.tostring(root),
+                         b'<codeBook><a><b/></a><c/></codeBook>')
+
+
+class TestConvertToDc(unittest.TestCase):
+
+    def test_mapping(self):
+        ddi = etree.fromstring('''<codeBook>
+            <stdyDscr>
+                <citation>
+                    <titlStmt><titl>Title</titl></titlStmt>
+                    <rspStmt><AuthEnty>A</AuthEnty><AuthEnty>B</AuthEnty>
+                    </rspStmt>
+                </citation>
+                <stdyInfo>
+                    <subject><keyword> </keyword><topcClas>t</topcClas>
+                    </subject>
+                </stdyInfo>
+            </stdyDscr>
+            <fileDscr><fileTxt><fileType>SPSS</fileType></fileTxt></fileDscr>
+            <dataDscr><var><labl>Not mapped</labl></var></dataDscr>
+        </codeBook>''')
+
+        dc = convert_to_dc(etree.ElementTree(ddi))
+
+        self.assertEqual(dc.tag,
+                         '{http://www.openarchives.org/OAI/2.0/oai_dc/}dc')
+        self.assertItemsEqual(
+            [(etree.QName(e).localname, e.text) for e in dc],
+            [('title', 'Title'), ('creator', 'A'), ('creator', 'B'),
+             ('subject', 't'), ('format', 'SPSS')]
+        )
+        # The root element can be converted as well.
+        self.assertEqual(etree.tostring(convert_to_dc(ddi)),
+                         etree.tostring(dc))
+
+    def test_custom_crosswalk(self):
+        crosswalk = Crosswalk({'title': ['a/b', 'c'], 'date': []})
+        dc = crosswalk.convert(etree.fromstring(
+            '<r><c>2</c><a><b>1</b></a></r>'))
+        self.assertEqual(
+            [(etree.QName(e).localname, e.text) for e in dc],
+            [('title', '1'), ('title', '2')]
+        )
+        self.assertEqual(
+            dc.get('{http://www.w3.org/2001/XMLSchema-instance}'
+                   'schemaLocation'),
+            'http://www.openarchives.org/OAI/2.0/oai_dc/ '
+            'http://www.openarchives.org/OAI/2.0/oai_dc.xsd'
+        )
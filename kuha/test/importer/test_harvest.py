@@ -7,6 +7,7 @@ import mock
 from ..util import LogCapture
 from ...exception import HarvestError
 from ...importer import harvest
+from ...importer.report import ImportReport
 
 def make_item(identifier):
     item = mock.Mock()
@@ -20,6 +21,25 @@ def make_format(prefix):
     return format_
 
 
+def make_provider():
+    """Make a provider without the optional methods."""
+    return mock.Mock(spec=[
+        'formats', 'identifiers', 'has_changed', 'get_sets', 'get_record',
+    ])
+
+
+class PicklableProvider(object):
+    """A provider that can be sent to worker processes."""
+
+    def has_changed(self, identifier, since):
+        return identifier != u'item2'
+
+    def get_record(self, identifier, prefix):
+        if identifier == u'item3':
+            raise ValueError('crosswalk error')
+        return '<{0} id="{1}"/>'.format(prefix, identifier)
+
+
 class TestUpdateFormats(unittest.TestCase):
 
     def test_successful_update(self):
@@ -46,14 +66,15 @@ class TestUpdateFormats(unittest.TestCase):
                 new_prefixes = harvest.update_formats(provider, purge=True)
 
         self.assertItemsEqual(new_prefixes, formats.keys())
-        self.assertEqual(oai_dc_mock.mark_as_deleted.mock_calls, [])
-        ead_mock.mark_as_deleted.assert_called_once_with()
+        models.Format.mark_many_as_deleted.assert_called_once_with(
+            [u'ead'])
         models.Format.list.assert_called_once_with(ignore_deleted=True)
         self.assertItemsEqual(
             models.Format.create_or_update.mock_calls,
             [mock.call(p, n, s) for p, (n, s) in formats.iteritems()]
         )
-        models.purge_deleted.assert_called_once_with()
+        models.purge_deleted.assert_called_once_with(
+            after_batch=models.commit)
         provider.formats.assert_called_once_with()
         models.commit.assert_called_once_with()
 
@@ -92,6 +113,7 @@ class TestUpdateFormats(unittest.TestCase):
                 harvest.update_formats(provider, purge=True, dry_run=True)
 
         self.assertEqual(models.Format.create_or_update.mock_calls, [])
+        self.assertEqual(models.Format.mark_many_as_deleted.mock_calls, [])
         self.assertEqual(models.purge_deleted.mock_calls, [])
         self.assertEqual(models.commit.mock_calls, [])
 
@@ -113,16 +135,33 @@ class TestUpdateItems(unittest.TestCase):
 
         self.assertItemsEqual(new_ids, identifiers)
         provider.identifiers.assert_called_once_with()
-        item_mocks[0].mark_as_deleted.assert_called_once_with()
-        self.assertEqual(item_mocks[1].mark_as_deleted.mock_calls, [])
+        models.Item.mark_many_as_deleted.assert_called_once_with([u'1234'])
         self.assertItemsEqual(
             models.Item.create_or_update.mock_calls,
             [mock.call(i) for i in ['asd', u'U', 'a:b']]
         )
-        models.purge_deleted.assert_called_once_with()
+        models.purge_deleted.assert_called_once_with(
+            after_batch=models.commit)
         models.commit.assert_called_once_with()
         log.assert_emitted('Removed 1 item and added 2 items.')
 
+    def test_purge_fails(self):
+        provider = mock.Mock()
+        provider.identifiers.return_value = [u'a']
+
+        with mock.patch.object(harvest, 'models') as models:
+            models.Item.list.return_value = [make_item(u'b')]
+            models.purge_deleted.side_effect = ValueError('locked')
+            with self.assertRaises(HarvestError):
+                harvest.update_items(provider, purge=True)
+
+        # The items were committed before purging.
+        self.assertEqual(
+            [name for name, _, _ in models.mock_calls
+             if name in ('commit', 'purge_deleted', 'rollback')],
+            ['commit', 'purge_deleted', 'rollback']
+        )
+
     def test_no_identifiers(self):
         provider = mock.Mock()
         provider.identifiers.return_value = []
@@ -131,7 +170,7 @@ class TestUpdateItems(unittest.TestCase):
         with mock.patch.object(harvest, 'models') as models:
             models.Item.list.return_value = [item_mock]
             harvest.update_items(provider, purge=False)
-        item_mock.mark_as_deleted.assert_called_once_with()
+        models.Item.mark_many_as_deleted.assert_called_once_with([u'id'])
 
     def test_provider_fails(self):
         provider = mock.Mock()
@@ -184,8 +223,101 @@ class TestUpdateItems(unittest.TestCase):
         self.assertEqual(models.Item.create_or_update.mock_calls, [])
         self.assertEqual(models.purge_deleted.mock_calls, [])
         self.assertEqual(models.commit.mock_calls, [])
-        self.assertEqual(item_mock.mark_as_deleted.mock_calls, [])
+        self.assertEqual(models.Item.mark_many_as_deleted.mock_calls, [])
+
+        log.assert_emitted('Removed 1 item and added 1 item.')
+
+
+class TestStreamItems(unittest.TestCase):
+
+    def test_successful_update(self):
+        provider = mock.Mock(spec=['identifiers'])
+        provider.identifiers.return_value = ['c', 'a', u'b', 'a']
+
+        with LogCapture(harvest) as log:
+            with mock.patch.object(harvest, 'models') as models:
+                models.Item.iter_identifiers.return_value = iter([
+                    (u'a', False), (u'b', True), (u'd', False),
+                ])
+                new_ids = harvest.update_items(provider, purge=True,
+                                               streaming=True)
+
+        self.assertEqual(list(new_ids), [u'a', u'b', u'c'])
+        models.Item.create_many.assert_called_once_with([u'c'])
+        models.Item.undelete_many.assert_called_once_with([u'b'])
+        models.Item.mark_many_as_deleted.assert_called_once_with([u'd'])
+        self.assertEqual(models.Item.create_or_update.mock_calls, [])
+        models.purge_deleted.assert_called_once_with(
+            after_batch=models.commit)
+        models.commit.assert_called_once_with()
+        log.assert_emitted('Removed 1 item and added 2 items.')
+
+    def test_sorted_identifiers(self):
+        provider = mock.Mock(spec=['identifiers', 'sorted_identifiers'])
+        provider.sorted_identifiers.return_value = ['a', 'b']
+
+        with mock.patch.object(harvest, 'models') as models:
+            models.Item.iter_identifiers.return_value = iter([])
+            new_ids = harvest.update_items(provider, streaming=True)
 
+        self.assertEqual(list(new_ids), [u'a', u'b'])
+        self.assertEqual(provider.identifiers.mock_calls, [])
+        models.Item.create_many.assert_called_once_with([u'a', u'b'])
+
+    def test_unsorted_identifiers(self):
+        provider = mock.Mock(spec=['sorted_identifiers'])
+        provider.sorted_identifiers.return_value = ['b', 'a']
+
+        with mock.patch.object(harvest, 'models') as models:
+            models.Item.iter_identifiers.return_value = iter([])
+            with self.assertRaises(HarvestError) as cm:
+                harvest.update_items(provider, streaming=True)
+        self.assertIn('not sorted', cm.exception.message)
+        models.rollback.assert_called_once_with()
+
+    def test_sort_on_disk(self):
+        identifiers = [u'oai:x:{0}'.format(i) for i in range(7, -1, -1)]
+        identifiers += [u'line\nbreak', u'\xe4\\', u'oai:x:3']
+        provider = mock.Mock(spec=['identifiers'])
+        provider.identifiers.return_value = identifiers
+
+        with mock.patch.object(harvest, '_SORT_BUFFER_SIZE', 3):
+            with mock.patch.object(harvest, 'models') as models:
+                models.Item.iter_identifiers.return_value = iter([])
+                new_ids = harvest.update_items(provider, streaming=True)
+
+        self.assertEqual(list(new_ids), sorted(set(identifiers)))
+
+    def test_batches(self):
+        provider = mock.Mock(spec=['identifiers'])
+        provider.identifiers.return_value = ['a', 'b', 'c']
+
+        with mock.patch.object(harvest, '_ITEM_BATCH_SIZE', 2):
+            with mock.patch.object(harvest, 'models') as models:
+                models.Item.iter_identifiers.return_value = iter([])
+                harvest.update_items(provider, streaming=True)
+
+        models.Item.iter_identifiers.assert_called_once_with(2)
+        self.assertEqual(models.Item.create_many.mock_calls,
+                         [mock.call([u'a', u'b']), mock.call([u'c'])])
+
+    def test_dry_run(self):
+        provider = mock.Mock(spec=['identifiers'])
+        provider.identifiers.return_value = ['asd']
+
+        with LogCapture(harvest) as log:
+            with mock.patch.object(harvest, 'models') as models:
+                models.Item.iter_identifiers.return_value = iter([
+                    (u'1234', False),
+                ])
+                new_ids = harvest.update_items(provider, purge=True,
+                                               dry_run=True, streaming=True)
+
+        self.assertEqual(list(new_ids), [u'asd'])
+        self.assertEqual(models.Item.create_many.mock_calls, [])
+        self.assertEqual(models.Item.mark_many_as_deleted.mock_calls, [])
+        self.assertEqual(models.purge_deleted.mock_calls, [])
+        self.assertEqual(models.commit.mock_calls, [])
         log.assert_emitted('Removed 1 item and added 1 item.')
 
 
@@ -196,7 +328,7 @@ class TestUpdateRecords(unittest.TestCase):
         identifiers = [u'item{0}'.format(i) for i in xrange(4)]
         time = datetime(2014, 2, 4, 10, 54, 27)
 
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_record.return_value = '<xml ... />'
         provider.has_changed.side_effect = (
             lambda identifier, _: identifier != u'item2'
@@ -217,7 +349,7 @@ class TestUpdateRecords(unittest.TestCase):
         )
         self.assertItemsEqual(
             update_sets_mock.mock_calls,
-            [mock.call(provider, id_, False)
+            [mock.call(provider, id_, False, mock.ANY)
              for id_ in [u'item0', u'item1', u'item3']],
         )
         self.assertItemsEqual(
@@ -233,10 +365,55 @@ class TestUpdateRecords(unittest.TestCase):
         log.assert_emitted('Skipping item "item2"')
         log.assert_emitted('Updated 6 records.')
 
+    def test_report(self):
+        provider = make_provider()
+        provider.get_record.side_effect = (
+            lambda identifier, prefix:
+            None if identifier == u'item1' else u'<\u00e4\u00e4/>'
+        )
+        provider.has_changed.side_effect = (
+            lambda identifier, _: identifier != u'item2'
+        )
+        report = ImportReport()
+
+        with mock.patch.object(harvest, 'models'):
+            with mock.patch.object(harvest, 'update_sets'):
+                harvest.update_records(
+                    provider, [u'item{0}'.format(i) for i in xrange(3)],
+                    [u'oai_dc'], datetime(2014, 2, 4, 10, 54, 27),
+                    report=report)
+
+        self.assertEqual(report.counters, {
+            'items_changed': 2,
+            'items_unchanged': 1,
+            'records_updated': 1,
+            'records_deleted': 1,
+            # The length of the record encoded in UTF-8.
+            'bytes_written': 7,
+            'commits': 2,
+        })
+        self.assertEqual(len(report.provider_calls['has_changed']), 3)
+        self.assertEqual(len(report.provider_calls['get_record']), 2)
+        self.assertIn('update_sets', report.timings)
+        self.assertIn('db_write', report.timings)
+
+    def test_dry_run_report(self):
+        provider = make_provider()
+        provider.get_record.return_value = '<xml/>'
+        report = ImportReport()
+
+        with mock.patch.object(harvest, 'models'):
+            with mock.patch.object(harvest, 'update_sets'):
+                harvest.update_records(provider, [u'item'], [u'oai_dc'],
+                                       dry_run=True, report=report)
+
+        # Nothing was written.
+        self.assertEqual(report.counters, {'items_changed': 1})
+
     def test_no_time(self):
         prefixes = [u'oai_dc']
         items = [u'oai:test:id']
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_record.return_value = '<oai_dc:dc>...</oai_dc:dc>'
 
         with mock.patch.object(harvest, 'update_sets'):
@@ -249,7 +426,7 @@ class TestUpdateRecords(unittest.TestCase):
             u'oai:test:id', u'oai_dc')
 
     def test_no_records(self):
-        provider = mock.Mock()
+        provider = make_provider()
         time = datetime(2014, 2, 4, 10, 54, 27)
         with mock.patch.object(harvest, 'models') as models:
             harvest.update_records(provider, [], [u'ead'], since=time)
@@ -266,7 +443,7 @@ class TestUpdateRecords(unittest.TestCase):
                 raise ValueError('crosswalk error')
             else:
                 return xml
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_record.side_effect = get_record
 
         with mock.patch.object(harvest, 'update_sets'):
@@ -281,7 +458,7 @@ class TestUpdateRecords(unittest.TestCase):
         log.assert_emitted('crosswalk error')
 
     def test_deleted_record(self):
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_record.return_value = None
 
         with mock.patch.object(harvest, 'update_sets'):
@@ -296,7 +473,7 @@ class TestUpdateRecords(unittest.TestCase):
     def test_update_sets_fails(self):
         items = [u'item1', u'item2']
 
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_record.return_value = '<oai_dc:dc>...</oai_dc:dc>'
 
         with mock.patch.object(harvest, 'update_sets') as (
@@ -308,13 +485,35 @@ class TestUpdateRecords(unittest.TestCase):
 
         self.assertItemsEqual(
             update_sets_mock.mock_calls,
-            [mock.call(provider, id_, False)
+            [mock.call(provider, id_, False, mock.ANY)
              for id_ in [u'item1', u'item2']],
         )
         log.assert_emitted('Failed to update item "item1"')
         log.assert_emitted('Failed to update item "item2"')
         log.assert_emitted('invalid set spec')
 
+    def test_set_cache(self):
+        provider = make_provider()
+        provider.get_record.return_value = '<xml/>'
+        provider.has_changed.side_effect = (
+            lambda identifier, _: identifier != u'item2'
+        )
+
+        with mock.patch.object(harvest, 'models'):
+            with mock.patch.object(harvest, 'SetCache') as cache_class:
+                with mock.patch.object(harvest, 'update_sets') as (
+                        update_sets_mock):
+                    update_sets_mock.side_effect = [ValueError(), None]
+                    harvest.update_records(
+                        provider, [u'item1', u'item2', u'item3'],
+                        [u'oai_dc'], datetime(2014, 2, 4, 10, 54, 27))
+
+        cache = cache_class.return_value
+        # The memberships of the changed items are loaded at once.
+        cache.load.assert_called_once_with([u'item1', u'item3'])
+        # The sets written for the failed item were rolled back.
+        cache.clear.assert_called_once_with()
+
     def test_delete_single_record(self):
         formats = [u'oai_dc', u'ead', u'ddi']
         def get_record(id_, prefix):
@@ -324,7 +523,7 @@ class TestUpdateRecords(unittest.TestCase):
                 return None
             elif prefix == u'ddi':
                 return 'data'
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_record.side_effect = get_record
         provider.get_sets.return_value = []
 
@@ -339,7 +538,7 @@ class TestUpdateRecords(unittest.TestCase):
     def test_dry_run(self):
         time = datetime(2014, 2, 4, 10, 54, 27)
 
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_record.return_value = '<xml ... />'
         provider.has_changed.return_value = True
 
@@ -355,17 +554,407 @@ class TestUpdateRecords(unittest.TestCase):
                         dry_run=True,
                     )
 
-        update_sets_mock.assert_called_once_with(provider, u'item1', True)
+        update_sets_mock.assert_called_once_with(provider, u'item1', True,
+                                                 mock.ANY)
         self.assertEqual(models.Record.create_or_update.mock_calls, [])
         self.assertEqual(models.commit.mock_calls, [])
 
         log.assert_emitted('Updated 1 record.')
 
 
+class TestUpdateRecordsInBatches(unittest.TestCase):
+
+    def test_commit_interval(self):
+        provider = make_provider()
+        provider.get_record.return_value = '<xml ... />'
+        identifiers = [u'item{0}'.format(i) for i in xrange(5)]
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                harvest.update_records(
+                    provider, identifiers, [u'ead', u'oai_dc'],
+                    commit_interval=4)
+
+        # 10 records in batches of 4 records.
+        self.assertEqual(models.commit.mock_calls,
+                         [mock.call() for _ in xrange(3)])
+
+    def test_commit_timeout(self):
+        provider = make_provider()
+        provider.get_record.return_value = '<xml ... />'
+        identifiers = [u'item{0}'.format(i) for i in xrange(5)]
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                with mock.patch.object(harvest, 'time') as time_mock:
+                    # Each record takes 2 seconds.
+                    time_mock.time.side_effect = xrange(0, 100, 2)
+                    harvest.update_records(
+                        provider, identifiers, [u'oai_dc'],
+                        commit_interval=100, commit_timeout=3)
+
+        self.assertEqual(models.commit.mock_calls,
+                         [mock.call() for _ in xrange(3)])
+
+    def test_failed_record_rolled_back_alone(self):
+        def create_or_update(identifier, prefix, xml):
+            if identifier == u'item1':
+                raise ValueError('invalid xml')
+
+        provider = make_provider()
+        provider.get_record.return_value = '<xml ... />'
+        identifiers = [u'item0', u'item1', u'item2']
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock.patch.object(harvest, 'models') as models:
+                models.Record.create_or_update.side_effect = (
+                    create_or_update)
+                savepoints = [mock.Mock() for _ in xrange(6)]
+                models.savepoint.side_effect = savepoints
+                with LogCapture(harvest) as log:
+                    harvest.update_records(
+                        provider, identifiers, [u'oai_dc'],
+                        commit_interval=10)
+
+        # A savepoint for the sets and the record of each item.
+        self.assertEqual(len(models.savepoint.mock_calls), 6)
+        savepoints[3].rollback.assert_called_once_with()
+        self.assertEqual(savepoints[3].commit.mock_calls, [])
+        for i in [0, 1, 2, 4, 5]:
+            savepoints[i].commit.assert_called_once_with()
+            self.assertEqual(savepoints[i].rollback.mock_calls, [])
+        # The transaction should not have been aborted.
+        models.commit.assert_called_once_with()
+        log.assert_emitted(
+            'Failed to disseminate format "oai_dc" for item "item1"')
+        log.assert_emitted('Updated 2 records.')
+
+
+class TestUpdateRecordsWithJournal(unittest.TestCase):
+
+    def test_journal(self):
+        provider = make_provider()
+        provider.get_record.return_value = '<xml/>'
+        provider.has_changed.side_effect = (
+            lambda identifier, _: identifier != u'item3'
+        )
+        time = datetime(2014, 2, 4, 10, 54, 27)
+        identifiers = [u'item{0}'.format(i) for i in xrange(4)]
+
+        with LogCapture(harvest) as log:
+            with mock.patch.object(harvest, 'models') as models:
+                models.ProcessedItem.identifiers.return_value = set(
+                    [u'item0', u'item2'])
+                with mock.patch.object(harvest, 'update_sets'):
+                    harvest.update_records(
+                        provider, identifiers, [u'oai_dc'], time,
+                        journal=True)
+
+        self.assertEqual(
+            provider.has_changed.mock_calls,
+            [mock.call(u'item1', time), mock.call(u'item3', time)]
+        )
+        # Unchanged items are not recorded as processed.
+        self.assertEqual(
+            models.ProcessedItem.create.mock_calls,
+            [mock.call(u'item1')]
+        )
+        self.assertEqual(models.commit.mock_calls, [mock.call()])
+        log.assert_emitted(
+            'Skipping 2 items processed by an interrupted import.')
+        log.assert_emitted('Updated 1 record.')
+
+    def test_dry_run(self):
+        provider = make_provider()
+        provider.get_record.return_value = '<xml/>'
+
+        with mock.patch.object(harvest, 'models') as models:
+            with mock.patch.object(harvest, 'update_sets'):
+                harvest.update_records(provider, [u'a'], [u'oai_dc'],
+                                       dry_run=True, journal=True)
+
+        self.assertEqual(models.ProcessedItem.mock_calls, [])
+
+
+class TestUpdateRecordsWithWorkers(unittest.TestCase):
+
+    def check_harvest(self, processes):
+        identifiers = [u'item{0}'.format(i) for i in xrange(20)]
+        prefixes = [u'oai_dc', u'ead']
+        time = datetime(2014, 2, 4, 10, 54, 27)
+
+        with LogCapture(harvest) as log:
+            with mock.patch.object(harvest, 'models') as models:
+                with mock.patch.object(harvest, 'update_sets') as (
+                        update_sets_mock):
+                    harvest.update_records(
+                        PicklableProvider(), identifiers, prefixes, time,
+                        workers=4, processes=processes)
+
+        written = [id_ for id_ in identifiers
+                   if id_ not in (u'item2', u'item3')]
+        # Records should have been written in order.
+        self.assertEqual(
+            models.Record.create_or_update.mock_calls,
+            [mock.call(id_, prefix, '<{0} id="{1}"/>'.format(prefix, id_))
+             for id_ in written
+             for prefix in prefixes]
+        )
+        self.assertEqual(len(update_sets_mock.mock_calls), 19)
+        log.assert_emitted('Skipping item "item2"')
+        log.assert_emitted(
+            'Failed to disseminate format "oai_dc" for item "item3"')
+        log.assert_emitted('crosswalk error')
+        log.assert_emitted('Updated 36 records.')
+
+    def test_threads(self):
+        self.check_harvest(processes=False)
+
+    def test_bounded_imap(self):
+        submitted = []
+        pool = mock.Mock()
+
+        def apply_async(func, args):
+            submitted.extend(args)
+            return mock.Mock(get=mock.Mock(return_value=func(*args)))
+        pool.apply_async.side_effect = apply_async
+
+        results = []
+        for result in harvest._bounded_imap(pool, lambda x: x * 2,
+                                            xrange(10), 3):
+            # At most three values are submitted ahead of the consumer.
+            self.assertLessEqual(len(submitted), len(results) + 3)
+            results.append(result)
+
+        self.assertEqual(results, [x * 2 for x in xrange(10)])
+
+    def test_processes(self):
+        self.check_harvest(processes=True)
+
+    def test_has_changed_fails(self):
+        provider = make_provider()
+        provider.has_changed.side_effect = IOError('file not found')
+        time = datetime(2014, 2, 4, 10, 54, 27)
+
+        with LogCapture(harvest) as log:
+            with mock.patch.object(harvest, 'models') as models:
+                with mock.patch.object(harvest, 'update_sets') as (
+                        update_sets_mock):
+                    harvest.update_records(
+                        provider, [u'a', u'b'], [u'oai_dc'], time,
+                        workers=2)
+
+        self.assertEqual(update_sets_mock.mock_calls, [])
+        self.assertEqual(provider.get_record.mock_calls, [])
+        log.assert_emitted('Failed to update item "a"')
+        log.assert_emitted('Failed to update item "b"')
+        log.assert_emitted('file not found')
+
+
+class TestUpdateRecordsWithBatchProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = mock.Mock(spec=[
+            'get_sets', 'has_changed', 'get_record', 'changed_since',
+            'get_records',
+        ])
+        self.provider.changed_since.return_value = [u'item0', 'item2']
+        self.provider.get_records.side_effect = (
+            lambda ids, prefix: ('<{0} id="{1}"/>'.format(prefix, id_)
+                                 for id_ in ids)
+        )
+        self.identifiers = [u'item{0}'.format(i) for i in xrange(4)]
+        self.time = datetime(2014, 2, 4, 10, 54, 27)
+
+    def update_records(self, since, **kwargs):
+        with LogCapture(harvest) as log:
+            with mock.patch.object(harvest, 'models') as models:
+                with mock.patch.object(harvest, 'update_sets'):
+                    harvest.update_records(
+                        self.provider, self.identifiers,
+                        [u'oai_dc', u'ead'], since, **kwargs)
+        return models, log
+
+    def test_batch_methods(self):
+        models, log = self.update_records(self.time)
+
+        self.provider.changed_since.assert_called_once_with(self.time)
+        self.assertEqual(self.provider.has_changed.mock_calls, [])
+        self.assertEqual(self.provider.get_record.mock_calls, [])
+        self.assertEqual(self.provider.get_records.mock_calls, [
+            mock.call([u'item0', u'item2'], u'oai_dc'),
+            mock.call([u'item0', u'item2'], u'ead'),
+        ])
+        self.assertEqual(
+            models.Record.create_or_update.mock_calls,
+            [mock.call(id_, prefix, '<{0} id="{1}"/>'.format(prefix, id_))
+             for id_ in [u'item0', u'item2']
+             for prefix in [u'oai_dc', u'ead']]
+        )
+        log.assert_emitted('Updated 4 records.')
+
+    def test_no_time(self):
+        self.update_records(None)
+
+        self.assertEqual(self.provider.changed_since.mock_calls, [])
+        self.assertEqual(self.provider.get_records.mock_calls, [
+            mock.call(self.identifiers, u'oai_dc'),
+            mock.call(self.identifiers, u'ead'),
+        ])
+
+    def test_batch_size(self):
+        with mock.patch.object(harvest, '_RECORD_BATCH_SIZE', 3):
+            self.update_records(None, workers=2)
+
+        self.assertItemsEqual(self.provider.get_records.mock_calls, [
+            mock.call(ids, prefix)
+            for ids in [self.identifiers[:3], self.identifiers[3:]]
+            for prefix in [u'oai_dc', u'ead']
+        ])
+
+    def test_changed_since_fails(self):
+        self.provider.changed_since.side_effect = IOError('no index')
+        self.provider.has_changed.side_effect = (
+            lambda identifier, _: identifier == u'item1'
+        )
+
+        models, log = self.update_records(self.time)
+
+        self.assertEqual(len(self.provider.has_changed.mock_calls), 4)
+        self.assertEqual(self.provider.get_records.mock_calls, [
+            mock.call([u'item1'], u'oai_dc'),
+            mock.call([u'item1'], u'ead'),
+        ])
+        log.assert_emitted('Failed to list changed items')
+        log.assert_emitted('Updated 2 records.')
+
+    def test_get_records_fails(self):
+        self.provider.get_records.side_effect = IOError('archive offline')
+        self.provider.get_record.side_effect = (
+            lambda identifier, prefix: '<x/>' if prefix == u'ead' else None
+        )
+
+        models, log = self.update_records(self.time)
+
+        self.assertItemsEqual(
+            self.provider.get_record.mock_calls,
+            [mock.call(id_, prefix)
+             for id_ in [u'item0', u'item2']
+             for prefix in [u'oai_dc', u'ead']]
+        )
+        self.assertItemsEqual(
+            models.Record.mark_as_deleted.mock_calls,
+            [mock.call(u'item0', u'oai_dc'), mock.call(u'item2', u'oai_dc')]
+        )
+        log.assert_emitted('archive offline')
+        log.assert_emitted('Updated 2 records.')
+
+    def test_wrong_number_of_records(self):
+        self.provider.get_records.side_effect = None
+        self.provider.get_records.return_value = ['<x/>']
+        self.provider.get_record.return_value = '<y/>'
+
+        models, log = self.update_records(self.time)
+
+        self.assertEqual(len(self.provider.get_record.mock_calls), 4)
+        log.assert_emitted('expected 2 records, got 1')
+
+    def test_get_all_records(self):
+        provider = mock.Mock(spec=[
+            'get_sets', 'get_record', 'get_records', 'get_all_records',
+        ])
+
+        def get_all_records(identifier, prefixes):
+            if identifier == u'item1':
+                raise IOError('unreadable file')
+            return {u'oai_dc': '<dc id="{0}"/>'.format(identifier),
+                    u'ddi': None}
+        provider.get_all_records.side_effect = get_all_records
+        self.provider = provider
+
+        models, log = self.update_records(None)
+
+        self.assertEqual(
+            provider.get_all_records.mock_calls,
+            [mock.call(id_, [u'oai_dc', u'ead']) for id_ in self.identifiers]
+        )
+        self.assertEqual(provider.get_records.mock_calls, [])
+        self.assertEqual(provider.get_record.mock_calls, [])
+        self.assertEqual(
+            models.Record.create_or_update.mock_calls,
+            [mock.call(id_, u'oai_dc', '<dc id="{0}"/>'.format(id_))
+             for id_ in [u'item0', u'item2', u'item3']]
+        )
+        log.assert_emitted(
+            'Failed to disseminate format "ead" for item "item0": '
+            'no record for the format')
+        log.assert_emitted(
+            'Failed to disseminate format "oai_dc" for item "item1"')
+        log.assert_emitted('unreadable file')
+        log.assert_emitted('Updated 3 records.')
+
+
+class TestUpdateChanged(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = make_provider()
+        self.provider.formats.return_value = {
+            u'oai_dc': ('http://www.openarchives.org/OAI/2.0/oai_dc/',
+                        'http://www.openarchives.org/OAI/2.0/oai_dc.xsd'),
+        }
+        self.provider.get_record.return_value = '<xml/>'
+
+    def update_changed(self, **kwargs):
+        with LogCapture(harvest) as log:
+            with mock.patch.object(harvest, 'models') as models:
+                with mock.patch.object(harvest, 'update_sets'):
+                    harvest.update_changed(self.provider, [u'item0'],
+                                           [u'item1', u'item2'], **kwargs)
+        return models, log
+
+    def test_successful_update(self):
+        models, log = self.update_changed()
+
+        models.Item.create_or_update.assert_called_once_with(u'item0')
+        models.Item.mark_many_as_deleted.assert_called_once_with(
+            [u'item1', u'item2'])
+        models.Record.create_or_update.assert_called_once_with(
+            u'item0', u'oai_dc', '<xml/>')
+        self.assertEqual(self.provider.identifiers.mock_calls, [])
+        self.assertEqual(self.provider.has_changed.mock_calls, [])
+        self.assertEqual(models.purge_deleted.mock_calls, [])
+        log.assert_emitted('Removed 2 items.')
+        log.assert_emitted('Updated 1 record.')
+
+    def test_purge(self):
+        models, _ = self.update_changed(purge=True)
+        models.purge_deleted.assert_called_once_with(
+            after_batch=models.commit)
+
+    def test_dry_run(self):
+        models, _ = self.update_changed(dry_run=True)
+
+        self.assertEqual(models.Item.create_or_update.mock_calls, [])
+        self.assertEqual(models.Item.mark_many_as_deleted.mock_calls, [])
+        self.assertEqual(models.Record.create_or_update.mock_calls, [])
+        self.assertEqual(models.commit.mock_calls, [])
+
+    def test_update_fails(self):
+        with mock.patch.object(harvest, 'models') as models:
+            models.Item.mark_many_as_deleted.side_effect = ValueError(
+                'database error')
+            with self.assertRaises(HarvestError):
+                harvest.update_changed(self.provider, [u'item0'],
+                                       [u'item1'])
+
+        models.rollback.assert_called_once_with()
+        self.assertEqual(self.provider.get_record.mock_calls, [])
+
+
 class TestUpdateSets(unittest.TestCase):
 
     def test_valid_sets(self):
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_sets.return_value = [
             (u'a:b', 'Set B'),
             ('a',   u'Set A'),
@@ -373,34 +962,61 @@ class TestUpdateSets(unittest.TestCase):
         ]
 
         with mock.patch.object(harvest, 'models') as models:
+            models.Item.set_memberships.return_value = {
+                'oai:example.org:item': set([u'a', u'd']),
+            }
             harvest.update_sets(provider, 'oai:example.org:item')
 
-        models.Item.get.assert_called_once_with('oai:example.org:item')
-        item = models.Item.get.return_value
-        item.clear_sets.assert_called_once_with()
+        models.Item.set_memberships.assert_called_once_with(
+            ['oai:example.org:item'])
         self.assertEqual(
             models.Set.create_or_update.mock_calls,
             [mock.call('a', u'Set A'),
              mock.call(u'a:b', 'Set B'),
              mock.call('a:b:c', 'Set C')]
         )
-        set_ = models.Set.create_or_update.return_value
-        self.assertEqual(
-            item.add_to_set.mock_calls,
-            [mock.call(set_) for _ in xrange(3)]
-        )
+        models.leaf_set_specs.assert_called_once_with(
+            set([u'a', u'a:b', u'a:b:c']))
+        models.Item.update_memberships.assert_called_once_with(
+            'oai:example.org:item', set([u'a:b', u'a:b:c']), set([u'd']),
+            models.leaf_set_specs.return_value)
 
     def test_no_sets(self):
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_sets.return_value = []
         with mock.patch.object(harvest, 'models') as models:
+            models.Item.set_memberships.return_value = {
+                'item': set([u'a']),
+            }
             harvest.update_sets(provider, 'item')
-        item = models.Item.get.return_value
-        item.clear_sets.assert_called_once_with()
-        self.assertEqual(item.add_to_set.mock_calls, [])
+        models.Item.update_memberships.assert_called_once_with(
+            'item', set(), set([u'a']), models.leaf_set_specs.return_value)
+        models.leaf_set_specs.assert_called_once_with(set())
+
+    def test_cache(self):
+        provider = make_provider()
+        provider.get_sets.return_value = [(u'a', u'Set A')]
+        cache = harvest.SetCache()
+
+        with mock.patch.object(harvest, 'models') as models:
+            models.Item.set_memberships.return_value = {
+                u'item1': set(),
+                u'item2': set([u'a']),
+            }
+            cache.load([u'item1', u'item2'])
+            harvest.update_sets(provider, u'item1', cache=cache)
+            harvest.update_sets(provider, u'item2', cache=cache)
+
+        # The set is written once, and the memberships are loaded once.
+        models.Set.create_or_update.assert_called_once_with(u'a', u'Set A')
+        models.Item.set_memberships.assert_called_once_with(
+            [u'item1', u'item2'])
+        # The unchanged memberships of item2 are not written.
+        models.Item.update_memberships.assert_called_once_with(
+            u'item1', set([u'a']), set(), models.leaf_set_specs.return_value)
 
     def test_dry_run(self):
-        provider = mock.Mock()
+        provider = make_provider()
         provider.get_sets.return_value = [(u'a', 'Set Name')]
 
         with mock.patch.object(harvest, 'models') as models:
@@ -410,8 +1026,7 @@ class TestUpdateSets(unittest.TestCase):
                 'oai:example.org:item',
                 dry_run=True,
             )
-        item_mock = models.Item.get.return_value
 
-        self.assertEqual(item_mock.clear_sets.mock_calls, [])
+        self.assertEqual(models.Item.set_memberships.mock_calls, [])
         self.assertEqual(models.Set.create_or_update.mock_calls, [])
-        self.assertEqual(item_mock.add_to_set.mock_calls, [])
+        self.assertEqual(models.Item.update_memberships.mock_calls, [])
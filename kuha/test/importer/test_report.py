@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ..util import LogCapture
+from ...importer import report as report_module
+from ...importer.report import ImportReport
+
+
+class TestImportReport(unittest.TestCase):
+
+    def setUp(self):
+        self.report = ImportReport()
+
+    def test_timed(self):
+        with mock.patch.object(report_module.time, 'time',
+                               side_effect=[10.0, 12.5, 20.0, 21.0]):
+            with self.report.timed('update_records'):
+                pass
+            with self.report.timed('update_records'):
+                pass
+        self.assertEqual(self.report.timings['update_records'], 3.5)
+
+    def test_timed_exception(self):
+        with self.assertRaises(ValueError):
+            with self.report.timed('update_items'):
+                raise ValueError()
+        self.assertIn('update_items', self.report.timings)
+
+    def test_as_dict(self):
+        self.report.timings['update_records'] = 2.0
+        self.report.timings['db_write'] = 0.5
+        self.report.timings['update_sets'] = 0.25
+        self.report.count('records_updated', 10)
+        self.report.count('commits')
+        self.report.add_provider_calls(
+            [('get_record', i / 100.0) for i in xrange(100, 0, -1)])
+        self.report.finish()
+
+        result = self.report.as_dict()
+
+        self.assertEqual(result['records_per_second'], 5.0)
+        self.assertEqual(result['db_write_seconds'], 0.5)
+        # Sets are updated within the update_records stage.
+        self.assertEqual(result['update_sets_seconds'], 0.25)
+        self.assertNotIn('update_sets', result['stages'])
+        self.assertEqual(result['stages']['update_formats'], 0.0)
+        self.assertEqual(result['counters'],
+                         {'records_updated': 10, 'commits': 1})
+        latencies = result['provider_calls']['get_record']
+        self.assertEqual(latencies['count'], 100)
+        self.assertEqual(latencies['p50'], 0.5)
+        self.assertEqual(latencies['p90'], 0.9)
+        self.assertEqual(latencies['p99'], 0.99)
+        self.assertEqual(latencies['max'], 1.0)
+        self.assertIsNone(result['error'])
+
+    def test_no_records(self):
+        self.assertIsNone(self.report.as_dict()['records_per_second'])
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'report.json')
+            self.report.count('items_changed', 3)
+            self.report.write(path)
+            with open(path) as file_:
+                result = json.load(file_)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(result['counters'], {'items_changed': 3})
+
+    def test_log_summary(self):
+        self.report.timings['update_records'] = 1.0
+        self.report.count('records_updated', 4)
+        self.report.count('bytes_written', 1234)
+        self.report.add_provider_calls([('has_changed', 0.25)])
+        log = logging.getLogger(report_module.__name__)
+
+        with LogCapture(report_module) as capture:
+            self.report.log_summary(log)
+
+        capture.assert_emitted('update_records 1.0 s')
+        capture.assert_emitted('Records: 4 updated')
+        capture.assert_emitted('1234 bytes written')
+        capture.assert_emitted('4.0 records/s')
+        capture.assert_emitted('Provider has_changed: 1 calls, p50 0.2500 s')
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ...exception import ConfigurationError, HarvestError
+from ...importer import shadow
+
+
+class ShadowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'kuha.sqlite')
+        self.staging = self.path + '.staging'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, path, contents):
+        with open(path, 'w') as file_:
+            file_.write(contents)
+
+    def read_file(self, path):
+        with open(path) as file_:
+            return file_.read()
+
+
+class TestStagingSettings(ShadowTestCase):
+
+    def test_settings(self):
+        settings = {'sqlalchemy.url': 'sqlite:///' + self.path, 'a': 'b'}
+
+        staging_settings, staging, path = shadow.staging_settings(settings)
+
+        self.assertEqual(staging_settings, {
+            'sqlalchemy.url': 'sqlite:///' + self.staging,
+            'a': 'b',
+        })
+        self.assertEqual(staging, self.staging)
+        self.assertEqual(path, self.path)
+        self.assertEqual(settings['sqlalchemy.url'], 'sqlite:///' + self.path)
+
+    def test_stale_database(self):
+        self.write_file(self.staging, 'stale')
+        self.write_file(self.staging + '-journal', 'stale')
+        settings = {'sqlalchemy.url': 'sqlite:///' + self.path}
+
+        shadow.staging_settings(settings, resume=True)
+        self.assertTrue(os.path.exists(self.staging))
+
+        shadow.staging_settings(settings)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_not_sqlite_file(self):
+        for url in ['sqlite://', 'sqlite:///:memory:',
+                    'postgresql://localhost/kuha']:
+            with self.assertRaises(ConfigurationError):
+                shadow.staging_settings({'sqlalchemy.url': url})
+
+
+class TestInstall(ShadowTestCase):
+
+    def install(self, problems=()):
+        with mock.patch.object(shadow, 'models') as models:
+            models.check_integrity.return_value = list(problems)
+            shadow.install(self.staging, self.path, keep_deleted=False)
+        return models
+
+    def test_replace(self):
+        self.write_file(self.path, 'live')
+        self.write_file(self.staging, 'staging')
+
+        models = self.install()
+
+        models.copy_history.assert_called_once_with(self.path, False)
+        engine = models.DBSession.get_bind.return_value
+        engine.dispose.assert_called_once_with()
+        self.assertEqual(os.listdir(self.directory), ['kuha.sqlite'])
+        self.assertEqual(self.read_file(self.path), 'staging')
+
+    def test_first_import(self):
+        self.write_file(self.staging, 'staging')
+
+        models = self.install()
+
+        self.assertEqual(models.copy_history.mock_calls, [])
+        self.assertEqual(self.read_file(self.path), 'staging')
+
+    def test_corrupt(self):
+        self.write_file(self.path, 'live')
+        self.write_file(self.staging, 'staging')
+
+        with self.assertRaises(HarvestError):
+            self.install(problems=['page 2 is never used'])
+
+        self.assertEqual(self.read_file(self.path), 'live')
+        self.assertTrue(os.path.exists(self.staging))
@@ -0,0 +1,288 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import mock
+from pyramid import testing
+import sqlalchemy as sa
+from pyramid.response import Response
+from webob.multidict import MultiDict
+
+from ..util import LogCapture
+from ...oai import cache
+from ...oai.cache import (
+    CachedRecord,
+    DatestampWatch,
+    RecordCache,
+    ResponseCache,
+)
+
+
+def make_record(identifier, xml=u'<x/>'):
+    return CachedRecord(identifier, u'oai_dc', datetime(2016, 1, 1), False,
+                        xml, [u'a:b'])
+
+
+@mock.patch.object(cache, 'Datestamp')
+@mock.patch.object(cache, 'time')
+class TestDatestampWatch(unittest.TestCase):
+
+    def test_changed(self, time_mock, datestamp_mock):
+        datestamp = datetime(2016, 1, 1)
+        get_version = datestamp_mock.get_version
+        watch = DatestampWatch()
+
+        time_mock.time.return_value = 10.0
+        get_version.return_value = (None, 0)
+        self.assertTrue(watch.changed())
+        # Not checked again within the interval.
+        time_mock.time.return_value = 10.5
+        get_version.return_value = (datestamp, 1)
+        self.assertFalse(watch.changed())
+        self.assertEqual(watch.version, (None, 0))
+        time_mock.time.return_value = 11.0
+        self.assertTrue(watch.changed())
+        time_mock.time.return_value = 12.0
+        self.assertFalse(watch.changed())
+        # Modified again within the same second.
+        time_mock.time.return_value = 13.0
+        get_version.return_value = (datestamp, 2)
+        self.assertTrue(watch.changed())
+        self.assertEqual(watch.version, (datestamp, 2))
+
+
+@mock.patch.object(cache, 'DatestampWatch')
+class TestRecordCache(unittest.TestCase):
+
+    def test_read_through(self, watch_mock):
+        watch_mock.return_value.changed.return_value = False
+        record_cache = RecordCache(10000)
+        load = mock.Mock(return_value=make_record(u'item'))
+
+        first = record_cache.get(u'item', u'oai_dc', load)
+        second = record_cache.get(u'item', u'oai_dc', load)
+
+        self.assertEqual(first, make_record(u'item'))
+        self.assertIs(second, first)
+        load.assert_called_once_with()
+
+    def test_load_error(self, watch_mock):
+        watch_mock.return_value.changed.return_value = False
+        record_cache = RecordCache(10000)
+        load = mock.Mock(side_effect=ValueError())
+
+        for _ in xrange(2):
+            self.assertRaises(ValueError, record_cache.get, u'item',
+                              u'oai_dc', load)
+        self.assertEqual(load.call_count, 2)
+
+    def test_invalidate(self, watch_mock):
+        watch_mock.return_value.changed.side_effect = [False, True]
+        record_cache = RecordCache(10000)
+        load = mock.Mock(return_value=make_record(u'item'))
+
+        record_cache.get(u'item', u'oai_dc', load)
+        record_cache.get(u'item', u'oai_dc', load)
+
+        self.assertEqual(load.call_count, 2)
+
+    def test_modified_within_second(self, watch_mock):
+        watch_mock.side_effect = DatestampWatch
+        datestamp = datetime(2016, 1, 1)
+        record_cache = RecordCache(10000)
+        load = mock.Mock(return_value=make_record(u'item'))
+
+        with mock.patch.object(cache, 'Datestamp') as datestamp_mock:
+            with mock.patch.object(cache, 'time') as time_mock:
+                time_mock.time.return_value = 10.0
+                datestamp_mock.get_version.return_value = (datestamp, 1)
+                record_cache.get(u'item', u'oai_dc', load)
+                time_mock.time.return_value = 12.0
+                datestamp_mock.get_version.return_value = (datestamp, 2)
+                record_cache.get(u'item', u'oai_dc', load)
+
+        self.assertEqual(load.call_count, 2)
+
+    def test_eviction(self, watch_mock):
+        watch_mock.return_value.changed.return_value = False
+        size = cache._record_size(make_record(u'item0'))
+        record_cache = RecordCache(2 * size)
+        loads = [mock.Mock(return_value=make_record(u'item{0}'.format(i)))
+                 for i in xrange(3)]
+
+        record_cache.get(u'item0', u'oai_dc', loads[0])
+        record_cache.get(u'item1', u'oai_dc', loads[1])
+        # Make item1 the least recently used one.
+        record_cache.get(u'item0', u'oai_dc', loads[0])
+        record_cache.get(u'item2', u'oai_dc', loads[2])
+        for i in [2, 0, 1]:
+            record_cache.get(u'item{0}'.format(i), u'oai_dc', loads[i])
+
+        self.assertEqual([load.call_count for load in loads], [1, 2, 1])
+
+    def test_too_large(self, watch_mock):
+        watch_mock.return_value.changed.return_value = False
+        record_cache = RecordCache(100)
+        load = mock.Mock(return_value=make_record(u'item', u'x' * 1000))
+
+        record_cache.get(u'item', u'oai_dc', load)
+        record_cache.get(u'item', u'oai_dc', load)
+
+        self.assertEqual(load.call_count, 2)
+
+
+@mock.patch.object(cache, 'DatestampWatch')
+class TestResponseCache(unittest.TestCase):
+
+    BODY = (b'<OAI-PMH><responseDate>2016-01-01T00:00:00Z</responseDate>'
+            b'<request>http://example.com/oai</request>{0}</OAI-PMH>')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'responses.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_cache(self, watch_mock, max_bytes=10000):
+        watch_mock.return_value.version = (datetime(2016, 1, 1), 1)
+        return ResponseCache(self.path, max_bytes)
+
+    def make_handler(self, content=b'', status=200):
+        return mock.Mock(return_value=Response(
+            body=self.BODY.format(content), status=status,
+            content_type='text/xml'))
+
+    def make_request(self, **params):
+        return testing.DummyRequest(params=params)
+
+    def test_cached(self, watch_mock):
+        response_cache = self.make_cache(watch_mock)
+        handler = self.make_handler()
+        request = self.make_request(verb=u'Identify')
+
+        first = response_cache.handle(request, handler)
+        with mock.patch.object(cache, 'datestamp_now',
+                               return_value=datetime(2016, 2, 3, 4, 5, 6)):
+            second = response_cache.handle(request, handler)
+
+        handler.assert_called_once_with(request)
+        self.assertEqual(second.body, first.body.replace(
+            b'2016-01-01T00:00:00Z', b'2016-02-03T04:05:06Z'))
+        self.assertEqual(second.headers['Content-Type'],
+                         first.headers['Content-Type'])
+
+    def test_shared(self, watch_mock):
+        handler = self.make_handler()
+        request = self.make_request(verb=u'Identify')
+
+        self.make_cache(watch_mock).handle(request, handler)
+        self.make_cache(watch_mock).handle(request, handler)
+
+        handler.assert_called_once_with(request)
+
+    def test_keys(self, watch_mock):
+        response_cache = self.make_cache(watch_mock)
+        handler = self.make_handler()
+
+        response_cache.handle(self.make_request(verb=u'Identify'), handler)
+        response_cache.handle(self.make_request(verb=u'ListSets'), handler)
+        watch_mock.return_value.version = (datetime(2016, 1, 2), 2)
+        response_cache.handle(self.make_request(verb=u'Identify'), handler)
+        # Modified within the same second.
+        watch_mock.return_value.version = (datetime(2016, 1, 2), 3)
+        response_cache.handle(self.make_request(verb=u'Identify'), handler)
+
+        self.assertEqual(handler.call_count, 4)
+
+    def test_parameter_order(self, watch_mock):
+        response_cache = self.make_cache(watch_mock)
+        handler = self.make_handler()
+        params = [(u'verb', u'ListRecords'), (u'metadataPrefix', u'oai_dc')]
+
+        for ordered in [params, reversed(params)]:
+            request = testing.DummyRequest()
+            request.params = MultiDict(ordered)
+            response_cache.handle(request, handler)
+
+        self.assertEqual(handler.call_count, 1)
+
+    def test_not_cached(self, watch_mock):
+        response_cache = self.make_cache(watch_mock, max_bytes=1000)
+        request = self.make_request(verb=u'Identify')
+
+        for handler in [self.make_handler(status=500),
+                        self.make_handler(b'x' * 1000)]:
+            response_cache.handle(request, handler)
+            response_cache.handle(request, handler)
+            self.assertEqual(handler.call_count, 2)
+
+    def test_eviction(self, watch_mock):
+        size = len(self.BODY.format(b''))
+        response_cache = self.make_cache(watch_mock, max_bytes=2 * size)
+        handler = self.make_handler()
+        requests = [self.make_request(verb=u'Verb{0}'.format(i))
+                    for i in xrange(3)]
+
+        for i in [0, 1, 2, 1, 2, 0]:
+            response_cache.handle(requests[i], handler)
+
+        # The oldest response was dropped.
+        self.assertEqual(handler.call_count, 4)
+
+    def test_newer_versions_kept(self, watch_mock):
+        # The other process has not seen the latest modification yet.
+        watch_mock.side_effect = [
+            mock.Mock(version=(datetime(2016, 1, 2), 2)),
+            mock.Mock(version=(datetime(2016, 1, 1), 1)),
+        ]
+        newer = ResponseCache(self.path, 10000)
+        older = ResponseCache(self.path, 10000)
+        handler = self.make_handler()
+        request = self.make_request(verb=u'Identify')
+
+        newer.handle(request, handler)
+        older.handle(self.make_request(verb=u'ListSets'), handler)
+        newer.handle(request, handler)
+
+        self.assertEqual(handler.call_count, 2)
+
+    def test_total_size(self, watch_mock):
+        size = len(self.BODY.format(b''))
+        response_cache = self.make_cache(watch_mock, max_bytes=2 * size)
+        handler = self.make_handler()
+        engine = sa.create_engine('sqlite:///' + self.path)
+
+        def sizes():
+            return (
+                engine.execute('SELECT size FROM total').scalar(),
+                engine.execute('SELECT sum(size) FROM responses').scalar(),
+            )
+
+        # Replaced and evicted responses are subtracted.
+        for key in [u'a', u'b', u'b', u'c']:
+            response_cache._store(key, u'1', 1, handler.return_value)
+        self.assertEqual(sizes(), (2 * size, 2 * size))
+
+        # The responses of the older version are dropped.
+        watch_mock.return_value.version = (datetime(2016, 1, 2), 2)
+        response_cache.handle(self.make_request(verb=u'Identify'), handler)
+        self.assertEqual(sizes(), (size, size))
+
+    def test_error(self, watch_mock):
+        response_cache = self.make_cache(watch_mock)
+        handler = self.make_handler()
+        request = self.make_request(verb=u'Identify')
+        error = sa.exc.OperationalError('SELECT', {}, Exception('locked'))
+
+        with mock.patch.object(response_cache, '_engine') as engine:
+            engine.execute.side_effect = error
+            engine.begin.side_effect = error
+            with LogCapture(cache) as capture:
+                response = response_cache.handle(request, handler)
+
+        self.assertEqual(response.body, self.BODY.format(b''))
+        capture.assert_emitted('Could not read the response cache')
+        capture.assert_emitted('Could not write the response cache')
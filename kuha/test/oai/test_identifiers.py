@@ -0,0 +1,133 @@
+import threading
+import unittest
+from datetime import datetime
+
+import mock
+
+from ..util import LogCapture
+from ...oai import cache, identifiers
+from ...oai.identifiers import BloomFilter, IdentifierFilter
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_contains(self):
+        bloom = BloomFilter(100)
+        values = [u'oai:example.org:{0}'.format(i) for i in xrange(100)]
+        for value in values:
+            bloom.add(value)
+
+        for value in values:
+            self.assertIn(value, bloom)
+        misses = sum(u'oai:example.org:x{0}'.format(i) in bloom
+                     for i in xrange(1000))
+        self.assertLess(misses, 50)
+
+    def test_empty(self):
+        bloom = BloomFilter(0)
+        self.assertNotIn(u'item', bloom)
+
+    def test_unicode(self):
+        bloom = BloomFilter(1)
+        bloom.add(u'\xe4\u20ac')
+        self.assertIn(u'\xe4\u20ac', bloom)
+
+
+@mock.patch.object(identifiers, 'Item')
+@mock.patch.object(identifiers.Datestamp, 'get_version')
+@mock.patch.object(cache, 'time')
+class TestIdentifierFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = IdentifierFilter()
+
+    def build(self, identifier=u'item'):
+        # Start building the filter and wait for it.
+        self.assertTrue(self.filter.might_exist(identifier))
+        builder = self.filter._builder
+        if builder is not None:
+            builder.join()
+
+    def test_might_exist(self, time_mock, get_version_mock, item_mock):
+        time_mock.time.return_value = 100.0
+        get_version_mock.return_value = (datetime(2016, 1, 1), 1)
+        item_mock.iter_identifiers.return_value = [(u'item1', False),
+                                                   (u'item2', True)]
+        self.build(u'item3')
+
+        self.assertTrue(self.filter.might_exist(u'item1'))
+        self.assertTrue(self.filter.might_exist(u'item2'))
+        self.assertFalse(self.filter.might_exist(u'item3'))
+        item_mock.iter_identifiers.assert_called_once_with()
+
+    def test_rebuild(self, time_mock, get_version_mock, item_mock):
+        datestamp = datetime(2016, 1, 1)
+        time_mock.time.return_value = 100.0
+        get_version_mock.return_value = (datestamp, 1)
+        item_mock.iter_identifiers.return_value = [(u'item1', False)]
+        self.build()
+        self.assertFalse(self.filter.might_exist(u'item2'))
+
+        # The database has not changed.
+        time_mock.time.return_value = 102.0
+        self.assertFalse(self.filter.might_exist(u'item2'))
+        self.assertEqual(item_mock.iter_identifiers.call_count, 1)
+
+        # Modified within the same second.
+        time_mock.time.return_value = 104.0
+        get_version_mock.return_value = (datestamp, 2)
+        item_mock.iter_identifiers.return_value = [(u'item2', False)]
+        self.build(u'item1')
+        self.assertTrue(self.filter.might_exist(u'item2'))
+        self.assertFalse(self.filter.might_exist(u'item1'))
+        self.assertEqual(item_mock.iter_identifiers.call_count, 2)
+
+    def test_miss_confirmed(self, time_mock, get_version_mock, item_mock):
+        datestamp = datetime(2016, 1, 1)
+        time_mock.time.return_value = 100.0
+        get_version_mock.return_value = (datestamp, 1)
+        item_mock.iter_identifiers.return_value = [(u'item1', False)]
+        self.build()
+
+        # Added before the next check of the database.
+        get_version_mock.return_value = (datestamp, 2)
+        self.assertTrue(self.filter.might_exist(u'item2'))
+
+    def test_build_error(self, time_mock, get_version_mock, item_mock):
+        time_mock.time.return_value = 100.0
+        get_version_mock.return_value = (datetime(2016, 1, 1), 1)
+        item_mock.iter_identifiers.side_effect = ValueError()
+
+        with LogCapture(identifiers) as capture:
+            self.build()
+        capture.assert_emitted('Failed to build the identifier filter')
+
+        # Built again by the next call.
+        item_mock.iter_identifiers.side_effect = None
+        item_mock.iter_identifiers.return_value = [(u'item1', False)]
+        self.build()
+        self.assertFalse(self.filter.might_exist(u'item2'))
+        self.assertEqual(item_mock.iter_identifiers.call_count, 2)
+
+    def test_not_blocked_while_building(self, time_mock, get_version_mock,
+                                        item_mock):
+        time_mock.time.return_value = 100.0
+        get_version_mock.return_value = (datetime(2016, 1, 1), 1)
+        release = threading.Event()
+
+        def iter_identifiers():
+            release.wait()
+            return [(u'item1', False)]
+
+        item_mock.iter_identifiers.side_effect = iter_identifiers
+
+        # The requests do not wait for the build, and every item is
+        # reported as possibly existing.
+        self.assertTrue(self.filter.might_exist(u'item2'))
+        self.assertTrue(self.filter.might_exist(u'item2'))
+        builder = self.filter._builder
+        release.set()
+        builder.join()
+
+        self.assertFalse(self.filter.might_exist(u'item2'))
+        item_mock.iter_identifiers.assert_called_once_with()
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from chameleon.template import BaseTemplate
+from pyramid import testing
+
+from ...oai import precompile
+
+
+class TestPrecompile(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.include('pyramid_chameleon')
+        self.config.commit()
+        self.directory = tempfile.mkdtemp()
+        self.old_loader = BaseTemplate.loader
+
+    def tearDown(self):
+        BaseTemplate.loader = self.old_loader
+        shutil.rmtree(self.directory)
+        testing.tearDown()
+
+    def test_template_names(self):
+        names = precompile.template_names()
+        self.assertIn('oaipmh.pt', names)
+        self.assertIn('listrecords.pt', names)
+        self.assertEqual(names, sorted(names))
+
+    def test_warm_templates(self):
+        precompile.warm_templates(self.config.registry)
+
+        for name in precompile.template_names():
+            spec = 'kuha.oai:templates/{0}'.format(name)
+            renderer = precompile.get_renderer(
+                spec, registry=self.config.registry)
+            # The template should have been compiled.
+            self.assertTrue(renderer.implementation()._cooked)
+
+    def test_template_cache(self):
+        directory = os.path.join(self.directory, 'cache')
+        precompile.use_template_cache(directory)
+        precompile.warm_templates(self.config.registry)
+
+        modules = [f for f in os.listdir(directory) if f.endswith('.py')]
+        for name in precompile.template_names():
+            prefix = os.path.splitext(name)[0] + '_'
+            self.assertTrue(
+                any(m.startswith(prefix) for m in modules),
+                'Template "{0}" not in cache: {1}'.format(name, modules),
+            )
@@ -0,0 +1,117 @@
+import unittest
+from datetime import datetime
+
+from lxml import etree
+from pyramid import testing
+from pyramid.renderers import render
+
+from ...oai.serializer import XmlFileRenderer
+from ...util import format_datestamp, filter_illegal_chars
+from .test_templates import Record, get_template_path, parse_response
+
+
+class Info(object):
+    """Dummy renderer info."""
+    def __init__(self, name):
+        self.name = name
+
+
+def normalize(text):
+    """Parse and validate a response and serialize it without
+    insignificant whitespace."""
+    parser = etree.XMLParser(remove_blank_text=True)
+    tree = etree.fromstring(etree.tostring(parse_response(text)), parser)
+    location = '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'
+    for element in tree.iter():
+        if element.text is not None and element.text.isspace():
+            element.text = None
+        # Whitespace in schema locations is not significant either.
+        if element.get(location) is not None:
+            element.set(location, ' '.join(element.get(location).split()))
+    return etree.tostring(tree, method='c14n')
+
+
+class SerializerTest(unittest.TestCase):
+    """Check that the serializer output matches the templates."""
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.include('pyramid_chameleon')
+
+        self.request = testing.DummyRequest(params={
+            'verb': self.verb,
+            'metadataPrefix': 'oai_dc',
+        })
+        setattr(self.request, 'path_url', 'http://pelle.org/asd')
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def check_output(self, values):
+        values.update({
+            'time': datetime(2013, 12, 24, 13, 45, 0),
+            'format_date': format_datestamp,
+            'filter_illegal_chars': filter_illegal_chars,
+        })
+        expected = render(self.template, values, self.request)
+
+        renderer = XmlFileRenderer(Info(self.verb + '.oaixml'))
+        actual = renderer(values, {'request': self.request})
+
+        self.assertIs(type(actual), str)
+        self.assertTrue(actual.startswith(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'))
+        self.assertEqual(normalize(actual.decode('utf-8')),
+                         normalize(expected))
+
+
+class TestGetRecord(SerializerTest):
+    verb = 'GetRecord'
+    template = get_template_path('getrecord.pt')
+
+    def test_get_record(self):
+        self.request.params['identifier'] = 'oai:example.org:item'
+        self.check_output({'record': Record(set_specs=['a:b', 'c'])})
+
+    def test_deleted_record(self):
+        self.request.params['identifier'] = 'oai:example.org:item'
+        self.check_output({'record': Record(deleted=True)})
+
+
+class TestListIdentifiers(SerializerTest):
+    verb = 'ListIdentifiers'
+    template = get_template_path('listidentifiers.pt')
+
+    def test_list_identifiers(self):
+        records = [Record('Rec 0', 'item0', ['abc']),
+                   Record('Rec 1', 'item1'),
+                   Record('Rec 2', 'item2', deleted=True)]
+        self.check_output({'records': records, 'token': '{<1234>}'})
+
+    def test_no_token(self):
+        self.check_output({'records': [Record()], 'token': None})
+
+
+class TestListRecords(SerializerTest):
+    verb = 'ListRecords'
+    template = get_template_path('listrecords.pt')
+
+    def test_list_records(self):
+        records = [Record('Rec &amp; &#xe4;', 'item0'),
+                   Record('Rec 1', 'item1', ['a', 'a:b']),
+                   Record('Rec 2', 'item2', deleted=True)]
+        self.check_output({'records': records, 'token': None})
+
+    def test_empty_token(self):
+        self.check_output({'records': [Record()], 'token': ''})
+
+
+class TestRendererName(unittest.TestCase):
+
+    def test_unknown_verb(self):
+        with self.assertRaises(ValueError):
+            XmlFileRenderer(Info('Identify.oaixml'))
+
+    def test_asset_spec(self):
+        # Should not fail.
+        XmlFileRenderer(Info('kuha.oai:ListRecords.oaixml'))
@@ -248,6 +248,20 @@ class TestListFormatsView(ViewTestCase,
         self.assertRaises(IdDoesNotExist, self.function, request)
         item_mock.exists.assert_called_once_with('unexistingId', False)
 
+    @mock.patch.object(views, 'Item')
+    def test_filtered_identifier(self, item_mock):
+        self.config.registry.identifier_filter = mock.Mock()
+        self.config.registry.identifier_filter.might_exist.return_value = \
+            False
+        params = self.minimal_params()
+        params['identifier'] = 'unexistingId'
+        request = testing.DummyRequest(params=params)
+
+        self.assertRaises(IdDoesNotExist, self.function, request)
+        self.config.registry.identifier_filter.might_exist.\
+            assert_called_once_with('unexistingId')
+        self.assertEqual(item_mock.exists.mock_calls, [])
+
     @mock.patch.object(views, 'Format')
     @mock.patch.object(views, 'Item')
     def test_no_available_formats(self, item_mock, format_mock):
@@ -605,6 +619,20 @@ class TestGetRecordView(ViewTestCase,
             metadata_prefix='dummy',
             ignore_deleted=True,
         )
+        self.assertFalse(hasattr(request, 'override_renderer'))
+
+    @mock.patch.object(views, 'Record')
+    @mock.patch.object(views, 'Format')
+    @mock.patch.object(views, 'Item')
+    def test_lxml_serializer(self, item_mock, format_mock, record_mock):
+        """The lxml serializer should be used if it is enabled."""
+        self.config.add_settings(oai_serializer=u'lxml')
+        record_mock.list.return_value = [self.record]
+        request = testing.DummyRequest(params=self.minimal_params())
+
+        self.function(request)
+
+        self.assertEqual(request.override_renderer, 'GetRecord.oaixml')
 
     @mock.patch.object(views, 'Format')
     @mock.patch.object(views, 'Item')
@@ -628,6 +656,43 @@ class TestGetRecordView(ViewTestCase,
         self.assertRaises(IdDoesNotExist, self.function, request)
         item_mock.exists.assert_called_once_with('item', True)
 
+    @mock.patch.object(views, 'Record')
+    @mock.patch.object(views, 'Format')
+    @mock.patch.object(views, 'Item')
+    def test_identifier_filter(self, item_mock, format_mock, record_mock):
+        """Identifiers passing the filter should be checked from the
+        database."""
+        identifier_filter = mock.Mock()
+        identifier_filter.might_exist.return_value = True
+        self.config.registry.identifier_filter = identifier_filter
+        item_mock.exists.return_value = True
+        format_mock.exists.return_value = True
+        record_mock.list.return_value = [self.record]
+        request = testing.DummyRequest(params=self.minimal_params())
+
+        self.check_response(self.function(request), record=self.record)
+        identifier_filter.might_exist.assert_called_once_with('item')
+        item_mock.exists.assert_called_once_with('item', True)
+
+    @mock.patch.object(views, 'Record')
+    @mock.patch.object(views, 'Format')
+    @mock.patch.object(views, 'Item')
+    def test_record_cache(self, item_mock, format_mock, record_mock):
+        """Cached records should not be fetched from the database."""
+        self.config.registry.record_cache = mock.Mock()
+        cached = self.config.registry.record_cache.get.return_value
+        request = testing.DummyRequest(params=self.minimal_params())
+
+        self.check_response(self.function(request), record=cached)
+        args, _ = self.config.registry.record_cache.get.call_args
+        self.assertEqual(args[:2], ('item', 'dummy'))
+        self.assertEqual(record_mock.list.mock_calls, [])
+
+        item_mock.exists.return_value = True
+        format_mock.exists.return_value = True
+        record_mock.list.return_value = [self.record]
+        self.assertIs(args[2](), self.record)
+
     @mock.patch.object(views, 'Record')
     @mock.patch.object(views, 'Format')
     @mock.patch.object(views, 'Item')
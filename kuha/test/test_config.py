@@ -1,5 +1,6 @@
 # encoding: utf-8
 
+import os
 import unittest
 
 import mock
@@ -43,6 +44,16 @@ class TestCleanSettings(unittest.TestCase):
                           settings, cleaners)
         cleaners['setting'].assert_called_once_with('   ')
 
+    def test_default_value(self):
+        settings = {'a': '1'}
+        cleaners = {'a': mock.Mock(), 'b': mock.Mock()}
+        defaults = {'b': '2'}
+        config._clean_settings(settings, cleaners, defaults)
+
+        cleaners['a'].assert_called_once_with('1')
+        cleaners['b'].assert_called_once_with('2')
+        self.assertIs(settings['b'], cleaners['b'].return_value)
+
 
 class TestCleanAdminEmails(unittest.TestCase):
 
@@ -114,6 +125,94 @@ class TestCleanItemListLimit(unittest.TestCase):
                               value)
 
 
+class TestCleanRecordCacheSize(unittest.TestCase):
+
+    def test_valid_size(self):
+        self.assertEqual(config._clean_record_cache_size('1000'), 1000)
+        self.assertEqual(config._clean_record_cache_size('0'), 0)
+
+    def test_invalid_size(self):
+        for value in ['-1', '1.5', 'large']:
+            self.assertRaises(ValueError,
+                              config._clean_record_cache_size,
+                              value)
+
+
+class TestCleanResponseCacheSize(unittest.TestCase):
+
+    def test_valid_size(self):
+        self.assertEqual(config._clean_response_cache_size('1000'), 1000)
+
+    def test_invalid_size(self):
+        for value in ['0', '-1', 'large']:
+            self.assertRaises(ValueError,
+                              config._clean_response_cache_size,
+                              value)
+
+
+class TestCleanCommitPolicy(unittest.TestCase):
+
+    def test_valid_interval(self):
+        self.assertEqual(config._clean_commit_interval('100'), 100)
+
+    def test_invalid_interval(self):
+        for value in [-1, 0, '1.5', '']:
+            self.assertRaises(ValueError,
+                              config._clean_commit_interval,
+                              value)
+
+    def test_valid_timeout(self):
+        self.assertEqual(config._clean_commit_timeout('2.5'), 2.5)
+        self.assertIsNone(config._clean_commit_timeout(''))
+
+    def test_invalid_timeout(self):
+        for value in ['-1', '0', 'soon']:
+            self.assertRaises(ValueError,
+                              config._clean_commit_timeout,
+                              value)
+
+
+class TestCleanHarvestWorkers(unittest.TestCase):
+
+    def test_valid_value(self):
+        self.assertEqual(config._clean_harvest_workers('8'), 8)
+
+    def test_invalid_value(self):
+        for value in [-1, 0, 'many']:
+            self.assertRaises(ValueError,
+                              config._clean_harvest_workers,
+                              value)
+
+
+class TestCleanWatchDelay(unittest.TestCase):
+
+    def test_valid_value(self):
+        self.assertEqual(config._clean_watch_delay('0.5'), 0.5)
+
+    def test_invalid_value(self):
+        for value in ['-1', '0', '']:
+            self.assertRaises(ValueError,
+                              config._clean_watch_delay,
+                              value)
+
+
+class TestCleanIdentifierPrefixes(unittest.TestCase):
+
+    def test_valid_value(self):
+        self.assertEqual(
+            config._clean_identifier_prefixes('oai:b:\n oai:a: oai:b:'),
+            [u'oai:a:', u'oai:b:']
+        )
+        self.assertEqual(config._clean_identifier_prefixes(''), [])
+
+    def test_invalid_value(self):
+        for value in ['oai:a: oai:a:b:',
+                      ' '.join('p{0}'.format(i) for i in xrange(16))]:
+            self.assertRaises(ValueError,
+                              config._clean_identifier_prefixes,
+                              value)
+
+
 class TestCleanUnicode(unittest.TestCase):
 
     def test_valid_values(self):
@@ -132,6 +231,19 @@ class TestCleanUnicode(unittest.TestCase):
             config._clean_unicode('\xFA')
 
 
+class TestCleanPath(unittest.TestCase):
+
+    def test_empty(self):
+        for value in ['', '   ', u'\n']:
+            self.assertIsNone(config._clean_path(value))
+
+    def test_path(self):
+        result = config._clean_path('some/dir')
+        self.assertTrue(os.path.isabs(result))
+        self.assertTrue(result.endswith(os.path.join('some', 'dir')))
+        self.assertIs(type(result), unicode)
+
+
 class TestCleanProviderClass(unittest.TestCase):
 
     def test_valid_name(self):
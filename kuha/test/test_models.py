@@ -1,5 +1,8 @@
 # encoding: utf-8
 
+import os
+import shutil
+import tempfile
 import unittest
 from datetime import datetime, timedelta
 
@@ -9,11 +12,13 @@ import sqlalchemy.exc as exc
 import sqlalchemy.orm as orm
 import mock
 
+from ..exception import ConfigurationError
 from ..util import datestamp_now
 from .. import models
 from ..models import (
     DBSession,
     Item, Record, Format, Datestamp, Set,
+    ImportCheckpoint, ProcessedItem,
 )
 
 
@@ -57,6 +62,7 @@ class ModelTestCase(unittest.TestCase):
 
         # in-memory database
         self.engine = sa.create_engine('sqlite://')
+        models._enable_sqlite_savepoints(self.engine)
 
         # Wrap the test cases in a transaction.
         connection = self.engine.connect()
@@ -153,6 +159,7 @@ class TestMarkItemsAsDeleted(ModelTestCase):
         fmt2 = make_format('oai_dc')
         r1 = Record.create('hjkl', 'ead', make_xml(fmt1))
         r2 = Record.create('hjkl', 'oai_dc', make_xml(fmt2))
+        DBSession.commit()
         DBSession.query(Datestamp).one().datestamp = date
 
         item.mark_as_deleted()
@@ -169,6 +176,108 @@ class TestMarkItemsAsDeleted(ModelTestCase):
         self.assertTrue(Datestamp.get() > date)
 
 
+class TestBulkItems(ModelTestCase):
+
+    def test_iter_identifiers(self):
+        for identifier in ['d', 'b', 'e', 'a', 'c']:
+            Item.create(identifier)
+        Item.get('c').deleted = True
+
+        self.assertEqual(list(Item.iter_identifiers(batch_size=2)), [
+            (u'a', False), (u'b', False), (u'c', True),
+            (u'd', False), (u'e', False),
+        ])
+        self.assertEqual(list(Item.iter_identifiers(batch_size=5)),
+                         list(Item.iter_identifiers()))
+
+    def test_empty_database(self):
+        self.assertEqual(list(Item.iter_identifiers()), [])
+
+    def test_case_insensitive_collation(self):
+        DBSession.execute('DROP TABLE items')
+        DBSession.execute(
+            'CREATE TABLE items (id INTEGER PRIMARY KEY, '
+            'identifier VARCHAR COLLATE NOCASE UNIQUE NOT NULL, '
+            'deleted BOOLEAN NOT NULL, '
+            "leaf_set_specs TEXT NOT NULL DEFAULT '')")
+        Item.create_many([u'b', u'C', u'a', u'D'])
+
+        self.assertEqual(
+            [i for i, _ in Item.iter_identifiers(batch_size=2)],
+            [u'C', u'D', u'a', u'b'])
+
+    def test_create_and_undelete(self):
+        Item.create('a').deleted = True
+        DBSession.flush()
+
+        Item.create_many([u'b', u'c'])
+        Item.undelete_many([u'a'])
+
+        DBSession.flush()
+        DBSession.expire_all()
+        self.assertEqual(list(Item.iter_identifiers()),
+                         [(u'a', False), (u'b', False), (u'c', False)])
+
+    def test_create_many_marks_session_changed(self):
+        with mock.patch.object(models, 'mark_changed') as mark_changed:
+            Item.create_many([u'a'])
+        mark_changed.assert_called_once_with(DBSession())
+
+    def test_mark_many_as_deleted(self):
+        date = datetime(1970, 1, 1, 0, 0, 0)
+        fmt = make_format('oai_dc')
+        for identifier in ['a', 'b', 'c']:
+            Item.create(identifier)
+            Record.create(identifier, 'oai_dc', make_xml(fmt))
+        DBSession.commit()
+        DBSession.query(Datestamp).one().datestamp = date
+        DBSession.flush()
+
+        Item.mark_many_as_deleted([u'a', u'c'])
+
+        DBSession.flush()
+        DBSession.expire_all()
+        self.assertEqual(list(Item.iter_identifiers()),
+                         [(u'a', True), (u'b', False), (u'c', True)])
+        self.assertEqual(
+            [(r.identifier, r.deleted) for r in
+             DBSession.query(Record).order_by(Record.identifier)],
+            [(u'a', True), (u'b', False), (u'c', True)]
+        )
+        self.assertTrue(Datestamp.get() > date)
+
+    def test_mark_many_as_deleted_in_batches(self):
+        identifiers = [u'id{0:04}'.format(i) for i in xrange(1200)]
+        Item.create_many(identifiers)
+
+        # More identifiers than SQLite allows parameters in a statement.
+        Item.mark_many_as_deleted(identifiers[:1100])
+
+        self.assertEqual(
+            DBSession.query(Item).filter(Item.deleted.is_(True)).count(),
+            1100
+        )
+
+
+class TestImportJournal(ModelTestCase):
+
+    def test_begin_and_end(self):
+        first = datetime(2014, 1, 1, 12, 0, 0)
+        second = datetime(2014, 1, 2, 12, 0, 0)
+
+        self.assertEqual(ImportCheckpoint.begin(first), first)
+        ProcessedItem.create(u'a')
+        ProcessedItem.create(u'b')
+        # An unfinished import is continued.
+        self.assertEqual(ImportCheckpoint.begin(second), first)
+        self.assertEqual(ProcessedItem.identifiers(), set([u'a', u'b']))
+
+        ImportCheckpoint.end()
+
+        self.assertEqual(ProcessedItem.identifiers(), set())
+        self.assertEqual(ImportCheckpoint.begin(second), second)
+
+
 class TestCreateFormat(ModelTestCase):
 
     def test_create(self):
@@ -252,6 +361,7 @@ class TestUpdateFormats(ModelTestCase):
         Item.create('id')
         f = make_format('ddi')
         r = Record.create('id', 'ddi', make_xml(f), date)
+        DBSession.commit()
         DBSession.query(Datestamp).one().datestamp = date
 
         # redundant update
@@ -300,6 +410,7 @@ class TestMarkFormatAsDeleted(ModelTestCase):
         r1 = Record.create('id1', 'oai_dc', make_xml(fmt), date)
         r2 = Record.create('id2', 'oai_dc', make_xml(fmt), date)
         r3 = Record.create('id1', 'ead', make_xml(ead), date)
+        DBSession.commit()
         DBSession.query(Datestamp).one().datestamp = date
 
         fmt.mark_as_deleted()
@@ -313,6 +424,34 @@ class TestMarkFormatAsDeleted(ModelTestCase):
         # Datestamp should have changed.
         self.assertTrue(Datestamp.get() > date)
 
+    def test_mark_many_as_deleted(self):
+        date = datetime(2014, 4, 24, 15, 11, 0)
+        fmt = make_format('oai_dc')
+        ead = make_format('ead')
+        ddi = make_format('ddi')
+        Item.create('id1')
+        Record.create('id1', 'oai_dc', make_xml(fmt), date)
+        Record.create('id1', 'ead', make_xml(ead), date)
+        Record.create('id1', 'ddi', make_xml(ddi), date)
+        DBSession.commit()
+        DBSession.query(Datestamp).one().datestamp = date
+
+        Format.mark_many_as_deleted([u'oai_dc', u'ddi'])
+
+        DBSession.expire_all()
+        self.assertEqual(
+            [(f.prefix, f.deleted) for f in
+             DBSession.query(Format).order_by(Format.prefix)],
+            [(u'ddi', True), (u'ead', False), (u'oai_dc', True)]
+        )
+        self.assertEqual(
+            [(r.prefix, r.deleted, r.datestamp > date) for r in
+             DBSession.query(Record).order_by(Record.prefix)],
+            [(u'ddi', True, True), (u'ead', False, False),
+             (u'oai_dc', True, True)]
+        )
+        self.assertTrue(Datestamp.get() > date)
+
 
 class TestCreateRecord(ModelTestCase):
 
@@ -549,6 +688,30 @@ class TestListRecords(ModelTestCase):
             self.records[0:3]
         )
 
+    def test_case_insensitive_collation(self):
+        DBSession.flush()
+        DBSession.execute('DROP TABLE records')
+        DBSession.execute(
+            'CREATE TABLE records ('
+            'identifier VARCHAR COLLATE NOCASE NOT NULL, '
+            'prefix VARCHAR NOT NULL, '
+            'datestamp DATETIME NOT NULL, '
+            'xml TEXT, '
+            'deleted BOOLEAN NOT NULL, '
+            'PRIMARY KEY (identifier, prefix))')
+        Item.create_many([u'b', u'C', u'a', u'D'])
+        xml = self.records[0].xml
+        for identifier in [u'b', u'C', u'a', u'D']:
+            Record.create(identifier, 'fmt1', xml)
+        DBSession.flush()
+
+        self.assertEqual(
+            [r.identifier for r in Record.list()],
+            [u'C', u'D', u'a', u'b'])
+        self.assertEqual(
+            [r.identifier for r in Record.list(offset=u'D')],
+            [u'D', u'a', u'b'])
+
 
 class TestUpdateRecords(ModelTestCase):
 
@@ -647,7 +810,52 @@ class TestDatestamp(ModelTestCase):
         Datestamp.create(datetime(2015, 1, 1, 12, 0, 0))
         Datestamp.create(datetime(2015, 1, 1, 22, 0, 0))
         Datestamp.update()
+        DBSession.commit()
         self.assertEqual(len(DBSession.query(Datestamp).all()), 1)
+        self.assertEqual(Datestamp.get_version()[1], 2)
+
+    def test_version(self):
+        """The version should change with every modification."""
+        self.assertEqual(Datestamp.get_version(), (None, 0))
+        now = datetime(2016, 1, 1, 12, 0, 0)
+        with mock.patch.object(models, 'datestamp_now', return_value=now):
+            for generation in [1, 2, 3]:
+                Datestamp.update()
+                DBSession.commit()
+                self.assertEqual(Datestamp.get_version(), (now, generation))
+
+    def test_written_on_commit(self):
+        """Datestamp should be written once, when committing."""
+        Datestamp.create(datetime(2015, 1, 1, 12, 0, 0))
+        DBSession.commit()
+
+        date_mock = mock.Mock(side_effect=[datetime(2016, 1, 1, 12, 0, 0),
+                                           datetime(2016, 1, 1, 12, 0, 1)])
+        with mock.patch.object(models, 'datestamp_now', date_mock):
+            Datestamp.update()
+            Datestamp.update()
+        with mock.patch.object(Datestamp, 'write_pending',
+                               wraps=Datestamp.write_pending) as write:
+            savepoint = models.savepoint()
+            savepoint.commit()
+            self.assertEqual(write.mock_calls, [])
+
+            DBSession.commit()
+            write.assert_called_once_with()
+
+        self.assertEqual(DBSession.query(Datestamp.datestamp).scalar(),
+                         datetime(2016, 1, 1, 12, 0, 1))
+
+    def test_rollback(self):
+        """Datestamp should not be written after a rollback."""
+        Datestamp.create(datetime(2015, 1, 1, 12, 0, 0))
+        DBSession.commit()
+
+        Datestamp.update()
+        DBSession.rollback()
+        DBSession.commit()
+
+        self.assertEqual(Datestamp.get(), datetime(2015, 1, 1, 12, 0, 0))
 
     def test_datestamp_changes(self):
         """Datestamp should change whenever tokens could be invalidated."""
@@ -777,6 +985,39 @@ class TestPurgeDeleted(ModelTestCase):
         self.assertEqual(DBSession.query(Format).all(), [format_z])
         self.assertEqual(DBSession.query(Record).all(), [existing])
 
+    def test_batches(self):
+        oai_dc = make_format(u'oai_dc')
+        for index in xrange(5):
+            identifier = u'id{0}'.format(index)
+            Item.create(identifier)
+            Record.create(identifier, u'oai_dc', make_xml(oai_dc))
+        set_ = Set.create(u'a', u'A')
+        Item.create(u'kept').add_to_set(set_)
+        Item.get(u'id0').add_to_set(set_)
+        Item.mark_many_as_deleted([u'id{0}'.format(i) for i in xrange(5)])
+        after_batch = mock.Mock()
+
+        purged = models.purge_deleted(batch_size=2, after_batch=after_batch)
+
+        self.assertEqual(purged, 10)
+        # Three batches of records and three of items.
+        self.assertEqual(len(after_batch.mock_calls), 6)
+        self.assertEqual([i.identifier for i in Item.list()], [u'kept'])
+        self.assertEqual(DBSession.query(Record).all(), [])
+        self.assertEqual(
+            DBSession.query(models.item_set_association).all(),
+            [(Item.get(u'kept').id, set_.id)]
+        )
+        # The purged objects are no longer in the session.
+        self.assertEqual(len(DBSession.identity_map), 3)
+
+    def test_nothing_to_purge(self):
+        Item.create(u'id')
+        after_batch = mock.Mock()
+
+        self.assertEqual(models.purge_deleted(after_batch=after_batch), 0)
+        self.assertEqual(after_batch.mock_calls, [])
+
 
 class TestItemSetAssociations(ModelTestCase):
 
@@ -808,6 +1049,291 @@ class TestItemSetAssociations(ModelTestCase):
             []
         )
 
+    def test_memberships(self):
+        for spec in ['a', 'b', 'c']:
+            Set.create(spec, 'Set ' + spec)
+        item1 = Item.create(u'item1')
+        item1.add_to_set(DBSession.query(Set).filter_by(spec='a').one())
+        item1.add_to_set(DBSession.query(Set).filter_by(spec='b').one())
+        Item.create(u'item2')
+
+        self.assertEqual(
+            Item.set_memberships([u'item1', u'item2']),
+            {u'item1': set(['a', 'b']), u'item2': set()}
+        )
+        self.assertEqual(Item.set_memberships([]), {})
+
+        Item.update_memberships(u'item1', ['c'], ['a'], [u'b', u'c'])
+        Item.update_memberships(u'item2', ['a'], [], [u'a'])
+        Item.update_memberships(u'item2', [], [], [u'ignored'])
+
+        self.assertEqual(
+            Item.set_memberships([u'item1', u'item2']),
+            {u'item1': set(['b', 'c']), u'item2': set(['a'])}
+        )
+
+    def test_leaf_set_specs(self):
+        self.assertEqual(
+            models.leaf_set_specs([u'a:b', u'a', u'a:b:c', u'ab', u'd:e']),
+            [u'a:b:c', u'ab', u'd:e']
+        )
+        self.assertEqual(models.leaf_set_specs([]), [])
+
+    def test_record_set_specs(self):
+        fmt = make_format(u'oai_dc')
+        for spec in [u'a', u'a:b', u'c']:
+            Set.create(spec, u'Set ' + spec)
+        item1 = Item.create(u'item1')
+        Item.create(u'item2')
+        Record.create(u'item1', u'oai_dc', make_xml(fmt))
+        Record.create(u'item2', u'oai_dc', make_xml(fmt))
+        for spec in [u'a:b', u'a', u'c']:
+            item1.add_to_set(DBSession.query(Set).filter_by(spec=spec).one())
+        Item.update_memberships(u'item2', [u'a'], [], [u'a'])
+        DBSession.flush()
+        DBSession.expire_all()
+
+        records = Record.list()
+        with mock.patch.object(DBSession, 'query') as query:
+            self.assertEqual([r.set_specs for r in records],
+                             [[u'a:b', u'c'], [u'a']])
+        self.assertEqual(query.mock_calls, [])
+
+        item1.clear_sets()
+        DBSession.flush()
+        DBSession.expire_all()
+        self.assertEqual(Record.list(identifier=u'item1')[0].set_specs, [])
+
+    def test_new_set(self):
+        Item.create(u'item')
+        Set.create('new', 'New Set')
+
+        Item.update_memberships(u'item', ['new'], [], [u'new'])
+
+        self.assertEqual(
+            DBSession.query(Item.identifier, Set.spec).join(Item.sets).all(),
+            [(u'item', 'new')]
+        )
+
+
+class TestSavepoint(ModelTestCase):
+
+    def test_rollback(self):
+        Item.create('item1')
+        savepoint = models.savepoint()
+        Item.create('item2')
+        DBSession.flush()
+        savepoint.rollback()
+
+        self.assertItemsEqual(
+            [i.identifier for i in Item.list()],
+            ['item1'],
+        )
+
+    def test_failed_flush(self):
+        Item.create('item1')
+        savepoint = models.savepoint()
+        Item.create('item1')
+        with self.assertRaises(exc.IntegrityError):
+            savepoint.commit()
+        savepoint.rollback()
+
+        savepoint = models.savepoint()
+        Item.create('item2')
+        savepoint.commit()
+
+        self.assertItemsEqual(
+            [i.identifier for i in Item.list()],
+            ['item1', 'item2'],
+        )
+
+
+class TestCheckIntegrity(ModelTestCase):
+
+    def test_intact(self):
+        self.assertEqual(models.check_integrity(), [])
+
+
+class FileDatabaseTestCase(unittest.TestCase):
+    """Test cases with SQLite database files in a temporary
+    directory."""
+
+    def setUp(self):
+        DBSession.remove()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        DBSession.remove()
+        models._Base.metadata.bind.dispose()
+        models._identifier_codec = models._IdentifierCodec()
+        shutil.rmtree(self.directory)
+
+    def connect(self, name, **kwargs):
+        path = os.path.join(self.directory, name)
+        DBSession.remove()
+        models.create_engine({'sqlalchemy.url': 'sqlite:///' + path},
+                             **kwargs)
+        # Disable the ZopeTransactionExtension.
+        DBSession.configure(extension=[])
+        return path
+
+
+class TestCreateEngine(FileDatabaseTestCase):
+
+    def test_savepoints(self):
+        with mock.patch.object(models, '_enable_sqlite_savepoints') as (
+                enable):
+            self.connect('reader.sqlite')
+            self.assertEqual(enable.mock_calls, [])
+            self.connect('writer.sqlite', savepoints=True)
+            enable.assert_called_once_with(models.DBSession.get_bind())
+
+
+class TestCopyHistory(FileDatabaseTestCase):
+
+    def setUp(self):
+        super(TestCopyHistory, self).setUp()
+        self.old_time = datetime(2014, 1, 1)
+        self.old_path = self.connect('old.sqlite')
+        oai_dc = make_format(u'oai_dc')
+        make_format(u'ead')
+        parent = Set.create(u'a', u'A')
+        child = Set.create(u'a:b', u'B')
+        for identifier in [u'same', u'changed', u'removed', u'deleted']:
+            item = Item.create(identifier)
+            if identifier != u'same':
+                item.add_to_set(parent)
+                item.add_to_set(child)
+            Record.create(identifier, u'oai_dc', make_xml(oai_dc),
+                          datestamp=self.old_time)
+        Record.mark_as_deleted(identifier=u'deleted')
+        DBSession.commit()
+        DBSession.query(Record).update({'datestamp': self.old_time})
+        DBSession.query(Datestamp).update({'datestamp': self.old_time})
+        DBSession.commit()
+
+    def build(self, identifiers=(u'same', u'changed'), changed=True):
+        self.connect('new.sqlite', bulk_load=True)
+        oai_dc = make_format(u'oai_dc')
+        for identifier in identifiers:
+            Item.create(identifier)
+            xml = make_xml(oai_dc)
+            if identifier == u'changed' and changed:
+                xml = xml.replace('Test Record', 'Changed Record')
+            Record.create(identifier, u'oai_dc', xml)
+        DBSession.commit()
+
+    def records(self):
+        return dict(
+            (identifier, (deleted, datestamp == self.old_time))
+            for identifier, deleted, datestamp
+            in DBSession.query(Record.identifier, Record.deleted,
+                               Record.datestamp)
+        )
+
+    def test_keep_deleted(self):
+        self.build()
+        models.copy_history(self.old_path)
+
+        self.assertEqual(self.records(), {
+            u'same': (False, True),
+            u'changed': (False, False),
+            u'removed': (True, False),
+            u'deleted': (True, True),
+        })
+        self.assertItemsEqual(
+            [(i.identifier, i.deleted) for i in Item.list()],
+            [(u'same', False), (u'changed', False),
+             (u'removed', True), (u'deleted', True)]
+        )
+        self.assertItemsEqual(
+            [(f.prefix, f.deleted) for f in Format.list()],
+            [(u'oai_dc', False), (u'ead', True)]
+        )
+        # The removed items keep their sets.
+        self.assertItemsEqual(
+            [(i.identifier, sorted(s.spec for s in i.sets))
+             for i in Item.list()],
+            [(u'same', []), (u'changed', []),
+             (u'removed', [u'a', u'a:b']), (u'deleted', [u'a', u'a:b'])]
+        )
+        self.assertEqual(
+            dict((r.identifier, r.set_specs)
+                 for r in DBSession.query(Record))[u'removed'],
+            [u'a:b']
+        )
+        self.assertGreater(Datestamp.get(), self.old_time)
+
+    def test_purge_deleted(self):
+        self.build()
+        models.copy_history(self.old_path, keep_deleted=False)
+
+        self.assertEqual(self.records(), {
+            u'same': (False, True),
+            u'changed': (False, False),
+        })
+        self.assertEqual(len(Item.list()), 2)
+
+    def test_other_prefixes(self):
+        self.connect('new.sqlite', identifier_prefixes=[u'oai:x:'])
+        with self.assertRaises(ConfigurationError):
+            models.copy_history(self.old_path)
+
+    def test_nothing_changed(self):
+        self.build([u'same', u'changed', u'removed'], changed=False)
+        models.copy_history(self.old_path)
+        self.assertEqual(Datestamp.get(), self.old_time)
+
+    def test_generation(self):
+        old_generation = Datestamp.get_version()[1]
+        self.build()
+        models.copy_history(self.old_path)
+        self.assertGreater(Datestamp.get_version()[1], old_generation)
+
+
+class TestReplacedDatabase(FileDatabaseTestCase):
+
+    def test_reconnect(self):
+        path = os.path.join(self.directory, 'live.sqlite')
+        engine = sa.create_engine('sqlite:///' + path,
+                                  poolclass=sa.pool.QueuePool)
+        models._reconnect_when_replaced(engine)
+        DBSession.configure(bind=engine, extension=[])
+        models._Base.metadata.bind = engine
+        models._Base.metadata.create_all(engine)
+        Item.create(u'old')
+        DBSession.commit()
+        # Check the connection in to the pool.
+        DBSession.remove()
+
+        other = sa.create_engine('sqlite:///' + path + '.staging')
+        models._Base.metadata.create_all(other)
+        other.execute(Item.__table__.insert(), identifier=u'new',
+                      deleted=False)
+        other.dispose()
+        os.rename(path + '.staging', path)
+
+        self.assertEqual([i.identifier for i in Item.list()], [u'new'])
+
+    def test_other_prefixes(self):
+        path = self.connect('live.sqlite', identifier_prefixes=[u'oai:a:'])
+        Item.create(u'oai:a:1')
+        DBSession.commit()
+        DBSession.remove()
+
+        other = sa.create_engine('sqlite:///' + path + '.staging')
+        models._Base.metadata.create_all(other)
+        other.execute(models.identifier_prefix_table.insert(),
+                      prefix=u'oai:b:')
+        # Stored as compressed by the other prefix.
+        other.execute('INSERT INTO items (identifier, deleted) '
+                      'VALUES (?, 0)', u'\x021')
+        other.dispose()
+        os.rename(path + '.staging', path)
+
+        self.assertEqual([i.identifier for i in Item.list()], [u'oai:b:1'])
+
+
 class TestSets(ModelTestCase):
 
     def test_create_set(self):
@@ -843,3 +1369,223 @@ class TestSets(ModelTestCase):
             [(s.spec, s.name) for s in Set.list()],
             [('a', 'Set A'), ('b', 'Set B'), ('b:c', 'Set C')]
         )
+
+
+class TestOptimize(FileDatabaseTestCase):
+
+    def test_optimize(self):
+        path = self.connect('kuha.sqlite')
+        oai_dc = make_format(u'oai_dc')
+        for index in xrange(100):
+            identifier = u'id{0}'.format(index)
+            Item.create(identifier)
+            Record.create(identifier, u'oai_dc', make_xml(oai_dc).replace(
+                u'Test Record', u'Test Record ' * 100))
+        DBSession.commit()
+        Item.mark_many_as_deleted(
+            [u'id{0}'.format(index) for index in xrange(100)])
+        models.purge_deleted()
+        DBSession.commit()
+        size = os.path.getsize(path)
+
+        models.optimize(vacuum=True)
+
+        self.assertLess(os.path.getsize(path), size)
+        tables = [table for (table,) in DBSession.execute(
+            'SELECT tbl FROM sqlite_stat1')]
+        self.assertIn('formats', tables)
+
+
+class TestMigrateSchema(FileDatabaseTestCase):
+
+    OLD_SCHEMA = [
+        'CREATE TABLE items (identifier VARCHAR NOT NULL, '
+        'deleted BOOLEAN NOT NULL, PRIMARY KEY (identifier))',
+        'CREATE TABLE sets (spec VARCHAR NOT NULL, name VARCHAR NOT NULL, '
+        'PRIMARY KEY (spec))',
+        'CREATE TABLE item_set_association (set_spec VARCHAR, '
+        'item_identifier VARCHAR)',
+    ]
+
+    def setUp(self):
+        super(TestMigrateSchema, self).setUp()
+        self.path = os.path.join(self.directory, 'kuha.sqlite')
+        self.engine = sa.create_engine('sqlite:///' + self.path)
+        for statement in self.OLD_SCHEMA:
+            self.engine.execute(statement)
+        self.engine.execute(
+            'INSERT INTO items VALUES (?, ?)',
+            [(u'b', False), (u'a', True), (u'c', False)])
+        self.engine.execute('INSERT INTO sets VALUES (?, ?)',
+                            [(u'x', u'X'), (u'y', u'Y')])
+        self.engine.execute(
+            'INSERT INTO item_set_association VALUES (?, ?)',
+            [(u'x', u'a'), (u'y', u'b'), (u'x', u'b'), (u'x', u'b')])
+
+    def tearDown(self):
+        self.engine.dispose()
+        super(TestMigrateSchema, self).tearDown()
+
+    def test_migrate(self):
+        self.assertTrue(models.migrate_schema(self.engine))
+        self.assertFalse(models.migrate_schema(self.engine))
+        self.engine.dispose()
+
+        self.connect('kuha.sqlite')
+        self.assertEqual(
+            [(i.id, i.identifier, i.deleted)
+             for i in DBSession.query(Item).order_by(Item.id)],
+            [(1, u'a', True), (2, u'b', False), (3, u'c', False)]
+        )
+        self.assertEqual(
+            Item.set_memberships([u'a', u'b', u'c']),
+            {u'a': set([u'x']), u'b': set([u'x', u'y']), u'c': set()}
+        )
+        self.assertEqual(
+            DBSession.query(Item.identifier, Item._leaf_set_specs)
+                     .order_by(Item.id).all(),
+            [(u'a', u'x'), (u'b', u'x y'), (u'c', u'')]
+        )
+        Set.create(u'z', u'Z')
+        Item.update_memberships(u'c', [u'z'], [], [u'z'])
+        DBSession.flush()
+        self.assertEqual(Item.set_memberships([u'c']), {u'c': set([u'z'])})
+
+    def test_outdated(self):
+        with self.assertRaises(ConfigurationError):
+            self.connect('kuha.sqlite')
+
+    def test_add_leaf_set_specs(self):
+        self.assertTrue(models.migrate_schema(self.engine))
+        self.engine.execute('CREATE TABLE items_old AS '
+                            'SELECT id, identifier, deleted FROM items')
+        self.engine.execute('DROP TABLE items')
+        self.engine.execute('ALTER TABLE items_old RENAME TO items')
+        self.assertEqual(models._outdated_tables(self.engine), ['items'])
+
+        self.assertTrue(models.migrate_schema(self.engine))
+        self.assertEqual(models._outdated_tables(self.engine), [])
+        self.assertEqual(
+            self.engine.execute('SELECT identifier, leaf_set_specs '
+                                'FROM items ORDER BY id').fetchall(),
+            [(u'a', u'x'), (u'b', u'x y'), (u'c', u'')]
+        )
+
+    def test_add_datestamp_generation(self):
+        self.engine.execute('CREATE TABLE datestamp (datestamp DATETIME '
+                            'NOT NULL, PRIMARY KEY (datestamp))')
+        self.engine.execute("INSERT INTO datestamp "
+                            "VALUES ('2015-01-01 12:00:00.000000')")
+        self.assertIn('datestamp', models._outdated_tables(self.engine))
+
+        self.assertTrue(models.migrate_schema(self.engine))
+        self.assertEqual(models._outdated_tables(self.engine), [])
+        self.engine.dispose()
+        self.connect('kuha.sqlite')
+        self.assertEqual(Datestamp.get_version(),
+                         (datetime(2015, 1, 1, 12, 0, 0), 0))
+
+
+class TestIdentifierCodec(unittest.TestCase):
+
+    IDENTIFIERS = [
+        u'', u'a', u'oai', u'oai:', u'oai:a', u'oai:a:', u'oai:a:1',
+        u'oai:a:b:1', u'oai:a;', u'oai:b:', u'oai:b:1', u'oai:c',
+        u'oai:c:1', u'oai:d:\xe4', u'p', u'\xe4',
+    ]
+
+    def test_order(self):
+        codec = models._IdentifierCodec([u'oai:c:', u'oai:a:'])
+        encoded = [codec.encode(i) for i in self.IDENTIFIERS]
+        self.assertEqual(sorted(encoded), encoded)
+        self.assertEqual([codec.decode(e) for e in encoded],
+                         self.IDENTIFIERS)
+        self.assertEqual(codec.encode(u'oai:a:1'), u'\x021')
+        self.assertEqual(codec.encode(u'oai:b:1'), u'\x03oai:b:1')
+
+    def test_no_prefixes(self):
+        codec = models._IdentifierCodec()
+        self.assertEqual(codec.encode(u'oai:a:1'), u'oai:a:1')
+        self.assertEqual(codec.decode(u'oai:a:1'), u'oai:a:1')
+
+    def test_invalid_prefixes(self):
+        for prefixes in [[u'oai:a:', u'oai:a:b:'], [u'', u'oai:a:'],
+                         [u'p{0}'.format(i) for i in xrange(16)]]:
+            with self.assertRaises(ValueError):
+                models._IdentifierCodec(prefixes)
+
+
+class TestIdentifierPrefixes(FileDatabaseTestCase):
+
+    def stored_identifiers(self, path, table):
+        engine = sa.create_engine('sqlite:///' + path)
+        try:
+            return sorted(i for (i,) in engine.execute(
+                'SELECT identifier FROM {0}'.format(table)))
+        finally:
+            engine.dispose()
+
+    def test_compressed(self):
+        path = self.connect('kuha.sqlite', identifier_prefixes=[u'oai:a:'])
+        oai_dc = make_format(u'oai_dc')
+        for identifier in [u'oai:a:2', u'oai:b:1', u'oai:a:1', u'a']:
+            Item.create(identifier)
+            Record.create(identifier, u'oai_dc', make_xml(oai_dc))
+        DBSession.commit()
+
+        self.assertEqual(
+            [r.identifier for r in Record.list(offset=u'oai:a:10')],
+            [u'oai:a:2', u'oai:b:1']
+        )
+        self.assertEqual(self.stored_identifiers(path, 'records'),
+                         [u'\x01a', u'\x021', u'\x022', u'\x03oai:b:1'])
+
+        # The stored prefixes are used when none are configured.
+        self.connect('kuha.sqlite')
+        self.assertEqual([i for (i, _) in Item.iter_identifiers()],
+                         [u'a', u'oai:a:1', u'oai:a:2', u'oai:b:1'])
+
+        with self.assertRaises(ConfigurationError):
+            self.connect('kuha.sqlite', identifier_prefixes=[])
+
+    def test_migrate(self):
+        path = self.connect('kuha.sqlite', identifier_prefixes=[u'oai:a:'])
+        oai_dc = make_format(u'oai_dc')
+        for identifier in [u'oai:a:1', u'oai:b:1']:
+            Item.create(identifier)
+            Record.create(identifier, u'oai_dc', make_xml(oai_dc))
+        DBSession.commit()
+        engine = DBSession.get_bind()
+
+        self.assertTrue(models.migrate_schema(engine, [u'oai:b:']))
+        self.assertFalse(models.migrate_schema(engine, [u'oai:b:']))
+
+        self.assertEqual(self.stored_identifiers(path, 'items'),
+                         [u'\x01oai:a:1', u'\x021'])
+        self.connect('kuha.sqlite', identifier_prefixes=[u'oai:b:'])
+        self.assertEqual(
+            [(r.identifier, r.prefix) for r in Record.list()],
+            [(u'oai:a:1', u'oai_dc'), (u'oai:b:1', u'oai_dc')]
+        )
+
+    def test_recoded_while_connected(self):
+        path = self.connect('kuha.sqlite', identifier_prefixes=[u'oai:a:'])
+        oai_dc = make_format(u'oai_dc')
+        for identifier in [u'oai:a:1', u'oai:b:1']:
+            Item.create(identifier)
+            Record.create(identifier, u'oai_dc', make_xml(oai_dc))
+        DBSession.commit()
+        DBSession.remove()
+
+        # Like kuha_migrate run while the server is running.
+        other = sa.create_engine('sqlite:///' + path)
+        try:
+            models._recode_identifiers(other, [u'oai:b:'])
+        finally:
+            other.dispose()
+        models._identifier_codec = models._IdentifierCodec([u'oai:a:'])
+
+        self.assertEqual([r.identifier for r in Record.list()],
+                         [u'oai:a:1', u'oai:b:1'])
+        self.assertEqual(models._identifier_codec.prefixes, [u'oai:b:'])
+
@@ -20,6 +20,7 @@ if __name__ == '__main__':
         'pyramid_chameleon',
         'pyramid_debugtoolbar',
         'pyramid_tm',
+        'scandir',
         'SQLAlchemy',
         'transaction',
         'waitress',
@@ -28,7 +29,7 @@ if __name__ == '__main__':
 
     setup(
         name='Kuha',
-        version='0.0',
+        version='0.1',
         description='An OAI-PMH Data Provider implementation',
         long_description=README + '\n\n' + CHANGES,
         classifiers=[
@@ -54,6 +55,8 @@ if __name__ == '__main__':
 
             'console_scripts': [
                 'kuha_import = kuha.importer:main',
+                'kuha_migrate = kuha.importer.migrate:main',
+                'kuha_precompile = kuha.oai.precompile:main',
             ],
         },
     )